@@ -1,199 +1,468 @@
+import argparse
+import functools
+import logging
+import os
+import threading
+
 import gradio as gr
 from downloader import (
+    warm_up,
     download_audio_and_metadata,
     add_metadata,
     process_playlist,
+    sync_playlist,
+    retag_folder,
     video_pipeline,
+    output_storage,
+    publish_output,
 )
-from search import search_videos  # Import the search function
+from search import (
+    search_videos,
+    stream_search_videos,
+    download_audio,
+)  # Import the search functions
+from jobs import job_manager, follow_job, JobQueueFull
+from metrics import start_metrics_server
+import storage
+from storage import file_url, start_file_server
+
+# The file server started by main, or None if it isn't running
+file_server = None
+
+
+def run_in_background(kind, function, output_count, keywords=()):
+    """
+    Wraps a download function in a Gradio handler that runs it as a background job.
+
+    The handler yields the job's progress into an extra progress output while it runs, then
+    the function's results. Stopping the handler, e.g. with a cancel button, cancels the job.
+
+    Args:
+        kind (str): A short name for the kind of job, e.g. "playlist".
+        function (callable): The download function, see jobs.JobManager.submit.
+        output_count (int): The number of values the function returns.
+        keywords (tuple, optional): Names of keyword arguments taken from the last inputs,
+            for options that don't follow the function's positional arguments.
+
+    Returns:
+        callable: The Gradio handler.
+    """
+
+    def handler(*inputs):
+        args = inputs[: len(inputs) - len(keywords)]
+        kwargs = dict(zip(keywords, inputs[len(args) :]))
+        try:
+            job = job_manager.submit(kind, function, *args, **kwargs)
+        except JobQueueFull as error:
+            raise gr.Error(str(error))
+
+        link_partial = getattr(function, "link_partial", None)
+        partial_linked = False
+        for progress in follow_job(job):
+            # A playlist zip can be downloaded while it's still being built
+            if link_partial and job.partial_output and not partial_linked:
+                partial = link_partial(job.partial_output)
+                if partial:
+                    partial_linked = True
+                    yield *partial, progress
+                    continue
+            yield *[gr.skip()] * output_count, progress
+
+        if job.status != "done":
+            raise gr.Error(job.describe())
+        result = job.result if output_count > 1 else (job.result,)
+        yield *result, job.describe()
+
+    return handler
+
+
+def link_output(function):
+    """
+    Wraps a download function so it stores its output and returns a link to it.
+
+    Returning the path to a gr.File would make Gradio copy the whole file into its own
+    cache before serving it. The link points at the file server (see
+    storage.start_file_server), which serves the stored file itself. If the file server
+    isn't running, e.g. because its port was taken, the link goes to the storage's own
+    URL, or the file is handed to a gr.File after all.
+
+    The wrapper's link_partial(name) returns the outputs linking to a zip that's still
+    being built, or None if it can't be linked before it's finished.
+
+    Args:
+        function (callable): A download function that returns the path to one file.
+
+    Returns:
+        callable: The wrapped function, which returns a Markdown link and a path for a
+        gr.File, one of which is empty.
+    """
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        name = publish_output(function(*args, **kwargs))
+        backend = output_storage()
+        url = file_url(name) if file_server is not None else backend.url(name)
+        if url:
+            return f"[{os.path.basename(name)}]({url})", None
+        local_path = backend.local_path(name)
+        if local_path is None:
+            return f"Stored at `{backend.location(name)}`", None
+        return "", local_path
+
+    def link_partial(name):
+        if file_server is None:
+            return None
+        return f"[{os.path.basename(name)}]({file_url(name)}) (still growing)", None
+
+    wrapper.link_partial = link_partial
+    return wrapper
+
 
-# Gradio interface
-with gr.Blocks() as interface:
-    # Create a tabbed interface
-    gr.Markdown(
-        """
+def build_interface():
+    """
+    Builds the Gradio interface. Nothing is created until this is called, so importing
+    this module stays cheap.
+
+    Returns:
+        gr.Blocks: The interface, ready to launch.
+    """
+    # Gradio interface
+    with gr.Blocks() as interface:
+        # Create a tabbed interface
+        gr.Markdown(
+            """
                 <img src="https://raw.githubusercontent.com/ColourlessSpearmint/DownloadDynamo/refs/heads/main/images/icon/icon-256.png" alt="icon" width="192"/>
                 <h1>DownloadDynamo
                 <h3>By Ethan Marks
                 """
-    )
-    with gr.Tabs():
-        # First Tab: Download Single
-        with gr.Tab("Download Single"):
-            gr.Markdown(
-                "This tab downloads the audio of a single video. Upon completion, it will fill out the metadata fields. You can manually edit the fields; press `Apply Metadata` to attach the new metadata to the audio file."
-            )
-            youtube_url = gr.Textbox(
-                label="YouTube URL", placeholder="Enter YouTube link here"
-            )
-            extract_btn = gr.Button("Extract Audio and Metadata")
-
-            # Audio output with playback and download
-            audio_output = gr.Audio(type="filepath", show_download_button=True)
-
-            # Thumbnail preview
-            thumbnail_output = gr.Image(
-                label="Thumbnail Preview", type="filepath"
-            )  # Use 'filepath' for local file reference
-
-            # Metadata input fields, pre-filled from yt-dlp
-            with gr.Row():
-                title = gr.Textbox(label="Title", placeholder="Enter title")
-                artist = gr.Textbox(label="Artist", placeholder="Enter artist name")
-                album = gr.Textbox(label="Album", placeholder="Enter album name")
-                album_artist = gr.Textbox(
-                    label="Album Artist", placeholder="Enter album artist name"
-                )
-                release_year = gr.Textbox(
-                    label="Release Year", placeholder="Enter release year"
-                )
-                genre = gr.Textbox(label="Genre", placeholder="Enter genre (optional)")
-
-            add_metadata_btn = gr.Button("Apply Metadata")
-
-            # Audio extraction functionality with metadata pre-filling
-            extract_btn.click(
-                download_audio_and_metadata,
-                inputs=youtube_url,
-                outputs=[
-                    audio_output,
-                    thumbnail_output,
-                    title,
-                    artist,
-                    album,
-                    album_artist,
-                    release_year,
-                    genre,
-                ],
-            )
-
-            # Metadata functionality
-            add_metadata_btn.click(
-                add_metadata,
-                inputs=[
-                    audio_output,
-                    title,
-                    artist,
-                    album,
-                    album_artist,
-                    release_year,
-                    genre,
-                    thumbnail_output,
-                ],
-                outputs=audio_output,
-            )
-
-        # Second Tab: Download Playlist
-        with gr.Tab("Download Playlist"):
-            gr.Markdown(
-                "This tab will iterate through every video in a playlist, downloading the audio, attaching the metadata, and compressing to a .zip file. This tab does not include metadata preview or editing."
-            )
-            youtube_url = gr.Textbox(
-                label="YouTube URL", placeholder="Enter YouTube playlist link here"
-            )
-            playlist_btn = gr.Button("Download Playlist")
-            zip_output = gr.File(label="Playlist", type="filepath")
-
-            playlist_btn.click(process_playlist, inputs=youtube_url, outputs=zip_output)
-
-        # Third Tab: Search by Keyword
-        with gr.Tab("Search Videos"):
-            gr.Markdown(
-                "This tab will search YouTube's database and display the top three results. It will download the audio, but will not attach metadata. Copy the url and paste it into another tab for a more feature-rich download"
-            )
-            search_keyword = gr.Textbox(
-                label="Search Keyword", placeholder="Enter keyword to search"
-            )
-            search_btn = gr.Button("Search Videos")
-
-            # Display outputs for the top 3 videos, each in its own row
-            def create_video_row(index):
+        )
+        with gr.Tabs():
+            # First Tab: Download Single
+            with gr.Tab("Download Single"):
+                gr.Markdown(
+                    "This tab downloads the audio of a single video. Upon completion, it will fill out the metadata fields. You can manually edit the fields; press `Apply Metadata` to attach the new metadata to the audio file."
+                )
+                youtube_url = gr.Textbox(
+                    label="YouTube URL", placeholder="Enter YouTube link here"
+                )
+                audio_format = gr.Radio(
+                    ["mp3", "native"],
+                    value="mp3",
+                    label="Audio Format",
+                    info="native keeps YouTube's own codec (Opus or AAC) without re-encoding",
+                )
+                extract_btn = gr.Button("Extract Audio and Metadata")
+
+                # Audio output with playback and download
+                audio_output = gr.Audio(type="filepath", show_download_button=True)
+
+                # Thumbnail preview
+                thumbnail_output = gr.Image(
+                    label="Thumbnail Preview", type="filepath"
+                )  # Use 'filepath' for local file reference
+
+                # Metadata input fields, pre-filled from yt-dlp
                 with gr.Row():
-                    # Create a row for each video
-                    title_output = gr.Textbox(
-                        label=f"Title {index + 1}", interactive=False
-                    )  # Make non-interactive
-                    artist_output = gr.Textbox(
-                        label=f"Artist {index + 1}", interactive=False
-                    )  # Make non-interactive
-                    release_year_output = gr.Textbox(
-                        label=f"Release Year {index + 1}", interactive=False
-                    )  # Make non-interactive
-                    audio_output = gr.Audio(
-                        label=f"Audio {index + 1}",
-                        type="filepath",
-                        show_download_button=True,
+                    title = gr.Textbox(label="Title", placeholder="Enter title")
+                    artist = gr.Textbox(label="Artist", placeholder="Enter artist name")
+                    album = gr.Textbox(label="Album", placeholder="Enter album name")
+                    album_artist = gr.Textbox(
+                        label="Album Artist", placeholder="Enter album artist name"
                     )
-                    thumbnail_output = gr.Image(
-                        label=f"Thumbnail {index + 1}", type="filepath"
+                    release_year = gr.Textbox(
+                        label="Release Year", placeholder="Enter release year"
                     )
-                    url_output = gr.Textbox(
-                        label=f"URL {index + 1}", interactive=False
-                    )  # URL output, non-interactive
-
-                    return (
-                        title_output,
-                        artist_output,
-                        release_year_output,
+                    genre = gr.Textbox(label="Genre", placeholder="Enter genre (optional)")
+
+                add_metadata_btn = gr.Button("Apply Metadata")
+                single_progress = gr.Textbox(label="Progress", interactive=False)
+
+                # Audio extraction functionality with metadata pre-filling
+                extract_btn.click(
+                    run_in_background(
+                        "audio", download_audio_and_metadata, 8, ("audio_format",)
+                    ),
+                    inputs=[youtube_url, audio_format],
+                    outputs=[
                         audio_output,
                         thumbnail_output,
-                        url_output,
-                    )
+                        title,
+                        artist,
+                        album,
+                        album_artist,
+                        release_year,
+                        genre,
+                        single_progress,
+                    ],
+                    concurrency_limit=None,  # The handler only waits for the job
+                )
+
+                # Metadata functionality
+                add_metadata_btn.click(
+                    add_metadata,
+                    inputs=[
+                        audio_output,
+                        title,
+                        artist,
+                        album,
+                        album_artist,
+                        release_year,
+                        genre,
+                        thumbnail_output,
+                    ],
+                    outputs=audio_output,
+                )
+
+            # Second Tab: Download Playlist
+            with gr.Tab("Download Playlist"):
+                gr.Markdown(
+                    "This tab will iterate through every video in a playlist, downloading the audio, attaching the metadata, and compressing to a .zip file. This tab does not include metadata preview or editing."
+                )
+                youtube_url = gr.Textbox(
+                    label="YouTube URL", placeholder="Enter YouTube playlist link here"
+                )
+                playlist_format = gr.Radio(
+                    ["mp3", "native"],
+                    value="mp3",
+                    label="Audio Format",
+                    info="native keeps YouTube's own codec (Opus or AAC) without re-encoding",
+                )
+                prune = gr.Checkbox(
+                    label="When syncing, delete videos that were removed from the playlist"
+                )
+                playlist_btn = gr.Button("Download Playlist")
+                sync_btn = gr.Button("Sync Playlist (only download new videos)")
+                playlist_cancel_btn = gr.Button("Cancel")
+                playlist_progress = gr.Textbox(label="Progress", interactive=False)
+                zip_output = gr.Markdown()  # A link to the playlist zip
+                zip_file = gr.File(label="Playlist Zip")  # Without the file server
+
+                playlist_event = playlist_btn.click(
+                    run_in_background(
+                        "playlist",
+                        link_output(process_playlist),
+                        2,
+                        ("audio_format",),
+                    ),
+                    inputs=[youtube_url, playlist_format],
+                    outputs=[zip_output, zip_file, playlist_progress],
+                    concurrency_limit=None,  # The handler only waits for the job
+                )
+                sync_event = sync_btn.click(
+                    run_in_background(
+                        "sync", link_output(sync_playlist), 2, ("audio_format",)
+                    ),
+                    inputs=[youtube_url, prune, playlist_format],
+                    outputs=[zip_output, zip_file, playlist_progress],
+                    concurrency_limit=None,
+                )
+                playlist_cancel_btn.click(None, cancels=[playlist_event, sync_event])
+
+            # Third Tab: Search by Keyword
+            with gr.Tab("Search Videos"):
+                gr.Markdown(
+                    "This tab will search YouTube's database and display the top three results. Press `Load Audio` to download the audio of a result, or tick the checkbox to download every result, but note that it will not attach metadata. Copy the url and paste it into another tab for a more feature-rich download"
+                )
+                search_keyword = gr.Textbox(
+                    label="Search Keyword", placeholder="Enter keyword to search"
+                )
+                download_all = gr.Checkbox(
+                    label="Download the audio of every result right away"
+                )
+                search_btn = gr.Button("Search Videos")
+
+                # Display outputs for the top 3 videos, each in its own row
+                def create_video_row(index):
+                    with gr.Row():
+                        # Create a row for each video
+                        title_output = gr.Textbox(
+                            label=f"Title {index + 1}", interactive=False
+                        )  # Make non-interactive
+                        artist_output = gr.Textbox(
+                            label=f"Artist {index + 1}", interactive=False
+                        )  # Make non-interactive
+                        release_year_output = gr.Textbox(
+                            label=f"Release Year {index + 1}", interactive=False
+                        )  # Make non-interactive
+                        audio_output = gr.Audio(
+                            label=f"Audio {index + 1}",
+                            type="filepath",
+                            show_download_button=True,
+                        )
+                        thumbnail_output = gr.Image(
+                            label=f"Thumbnail {index + 1}", type="filepath"
+                        )
+                        url_output = gr.Textbox(
+                            label=f"URL {index + 1}", interactive=False
+                        )  # URL output, non-interactive
+                        load_audio_btn = gr.Button(f"Load Audio {index + 1}")
+
+                        # Only download the audio of a result once it is selected
+                        load_audio_btn.click(
+                            download_audio, inputs=url_output, outputs=audio_output
+                        )
+
+                        return (
+                            title_output,
+                            artist_output,
+                            release_year_output,
+                            audio_output,
+                            thumbnail_output,
+                            url_output,
+                        )
+
+                # Create placeholders for video outputs
+                video_outputs = [create_video_row(i) for i in range(3)]
+                titles_output = [output[0] for output in video_outputs]
+                artists_output = [output[1] for output in video_outputs]
+                release_years_output = [output[2] for output in video_outputs]
+                audio_output_search = [output[3] for output in video_outputs]
+                thumbnails_output = [output[4] for output in video_outputs]
+                urls_output = [output[5] for output in video_outputs]  # URL outputs
+
+                # Search functionality
+                def update_outputs(keyword, download_all):
+                    if download_all:
+                        # Fill in each row as soon as its downloads finish
+                        results = stream_search_videos(keyword)
+                    else:
+                        results = [search_videos(keyword, lazy=True)]
+                    for columns in results:
+                        titles, artists, release_years, audio_paths, thumbnails, urls = (
+                            columns
+                        )
+                        yield (
+                            *titles,
+                            *artists,
+                            *release_years,
+                            *audio_paths,
+                            *thumbnails,
+                            *urls,
+                        )  # Return URLs as well
+
+                search_btn.click(
+                    update_outputs,
+                    inputs=[search_keyword, download_all],
+                    outputs=[
+                        *titles_output,
+                        *artists_output,
+                        *release_years_output,
+                        *audio_output_search,
+                        *thumbnails_output,
+                        *urls_output,
+                    ],
+                )
+
+            # Fourth Tab: Video
+            with gr.Tab("Download Video"):
+                gr.Markdown(
+                    "This tab downloads the audio and video from a provided url. It does not attach metadata, nor does it include previews. It does have the ability to differenciate between videos and playlists."
+                )
+                youtube_url_pipeline = gr.Textbox(
+                    label="YouTube URL",
+                    placeholder="Enter YouTube video or playlist link here",
+                )
+                pipeline_btn = gr.Button("Process Video/Playlist")
+                pipeline_cancel_btn = gr.Button("Cancel")
+                pipeline_progress = gr.Textbox(label="Progress", interactive=False)
+
+                # Outputs for video or playlist zip
+                video_output = gr.Markdown()  # A link to the video or playlist zip
+                video_file = gr.File(label="Video or Playlist Zip")
+
+                # Functionality for processing video or playlist
+                pipeline_event = pipeline_btn.click(
+                    run_in_background("video", link_output(video_pipeline), 2),
+                    inputs=youtube_url_pipeline,
+                    outputs=[video_output, video_file, pipeline_progress],
+                    concurrency_limit=None,  # The handler only waits for the job
+                )
+                pipeline_cancel_btn.click(None, cancels=[pipeline_event])
+
+            # Fifth Tab: Bulk Metadata
+            with gr.Tab("Bulk Metadata"):
+                gr.Markdown(
+                    "This tab sets the same metadata on every audio file in a folder, e.g. a synced playlist in `downloads/library`. Empty fields are left as they are. Fields can use the current tags and the file's position, e.g. `{artist} - {title}` or `{index}` as the track number."
+                )
+                bulk_folder = gr.Textbox(
+                    label="Folder", placeholder="Enter the folder with the audio files"
+                )
+                with gr.Row():
+                    bulk_title = gr.Textbox(label="Title")
+                    bulk_artist = gr.Textbox(label="Artist")
+                    bulk_album = gr.Textbox(label="Album")
+                    bulk_album_artist = gr.Textbox(label="Album Artist")
+                with gr.Row():
+                    bulk_release_year = gr.Textbox(label="Release Year")
+                    bulk_genre = gr.Textbox(label="Genre")
+                    bulk_track_number = gr.Textbox(label="Track Number")
+                bulk_btn = gr.Button("Apply to All Files")
+                bulk_results = gr.Dataframe(
+                    headers=["File", "Status", "Tags or Error"], interactive=False
+                )
+
+                bulk_btn.click(
+                    retag_folder,
+                    inputs=[
+                        bulk_folder,
+                        bulk_title,
+                        bulk_artist,
+                        bulk_album,
+                        bulk_album_artist,
+                        bulk_release_year,
+                        bulk_genre,
+                        bulk_track_number,
+                    ],
+                    outputs=bulk_results,
+                )
+
+    return interface
+
+
+def main(argv=None):
+    """Starts the metrics endpoint, the file server and the interface."""
+    global file_server
+    parser = argparse.ArgumentParser(description="Runs the DownloadDynamo interface")
+    parser.add_argument(
+        "--files-port",
+        type=int,
+        default=storage.FILES_PORT,
+        help=f"Port of the file server (default: {storage.FILES_PORT})",
+    )
+    parser.add_argument(
+        "--files-host",
+        default=storage.FILES_HOST,
+        help="Address the file server listens on (default: this machine only)",
+    )
+    parser.add_argument(
+        "--files-url",
+        default=storage.FILES_URL,
+        help="Address browsers reach the file server at, e.g. behind a proxy "
+        "(default: http://localhost:<files port>)",
+    )
+    parser.add_argument(
+        "--no-file-server",
+        action="store_true",
+        help="Hand finished downloads to the interface instead of linking to them",
+    )
+    args = parser.parse_args(argv)
+    storage.FILES_PORT, storage.FILES_HOST = args.files_port, args.files_host
+    storage.FILES_URL = args.files_url
+
+    # Log pipeline stages as JSON lines and serve Prometheus metrics next to the interface
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    start_metrics_server()
+
+    # Serve finished playlists and videos straight from storage
+    if not args.no_file_server:
+        file_server = start_file_server(output_storage())
+
+    # Load yt-dlp while the interface starts, instead of on the first download
+    threading.Thread(target=warm_up, daemon=True).start()
+
+    # Launch the interface
+    build_interface().launch(inbrowser=True, favicon_path="images\icon\icon-64.png")
+
 
-            # Create placeholders for video outputs
-            video_outputs = [create_video_row(i) for i in range(3)]
-            titles_output = [output[0] for output in video_outputs]
-            artists_output = [output[1] for output in video_outputs]
-            release_years_output = [output[2] for output in video_outputs]
-            audio_output_search = [output[3] for output in video_outputs]
-            thumbnails_output = [output[4] for output in video_outputs]
-            urls_output = [output[5] for output in video_outputs]  # URL outputs
-
-            # Search functionality
-            def update_outputs(keyword):
-                titles, artists, release_years, audio_paths, thumbnails, urls = (
-                    search_videos(keyword)
-                )
-                return (
-                    *titles,
-                    *artists,
-                    *release_years,
-                    *audio_paths,
-                    *thumbnails,
-                    *urls,
-                )  # Return URLs as well
-
-            search_btn.click(
-                update_outputs,
-                inputs=search_keyword,
-                outputs=[
-                    *titles_output,
-                    *artists_output,
-                    *release_years_output,
-                    *audio_output_search,
-                    *thumbnails_output,
-                    *urls_output,
-                ],
-            )
-
-        # Fourth Tab: Video
-        with gr.Tab("Download Video"):
-            gr.Markdown(
-                "This tab downloads the audio and video from a provided url. It does not attach metadata, nor does it include previews. It does have the ability to differenciate between videos and playlists."
-            )
-            youtube_url_pipeline = gr.Textbox(
-                label="YouTube URL",
-                placeholder="Enter YouTube video or playlist link here",
-            )
-            pipeline_btn = gr.Button("Process Video/Playlist")
-
-            # Outputs for video or playlist zip
-            video_output = gr.File(label="Downloaded Video/Playlist", type="filepath")
-
-            # Functionality for processing video or playlist
-            pipeline_btn.click(
-                video_pipeline, inputs=youtube_url_pipeline, outputs=video_output
-            )
-
-# Launch the interface
-interface.launch(inbrowser=True, favicon_path="images\icon\icon-64.png")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+import os
+import shutil
+import threading
+import zipfile
+
+# Size of the chunks members are copied in when a zip is rewritten, and of the chunks
+# handed out by StreamingZip.iter_bytes
+CHUNK_SIZE = 1024 * 1024
+
+# How long a reader waits for more data before checking the archive again
+POLL_INTERVAL = 0.2
+
+
+class ArchiveDiscarded(Exception):
+    """Raised when an archive that is being read is discarded before it is finished."""
+
+
+class _AppendOnlyFile:
+    """
+    Wraps a file so zipfile treats it as unseekable.
+
+    zipfile then writes sizes and checksums in data descriptors after each member instead
+    of seeking back to patch the local headers, so bytes are never rewritten once written
+    and the archive can be read while it is still growing.
+    """
+
+    def __init__(self, file):
+        self._file = file
+
+    def write(self, data):
+        return self._file.write(data)
+
+    def flush(self):
+        self._file.flush()
+
+    def tell(self):
+        raise OSError("append-only file is not seekable")
+
+
+class StreamingZip:
+    """
+    A zip archive that is built one file at a time and can be streamed while it grows.
+
+    Each file can be removed as soon as it is added.
+
+    Members are stored without compression, since MP3 and MP4 files don't compress.
+    """
+
+    def __init__(self, path):
+        """
+        Creates the archive.
+
+        Args:
+            path (str): The path of the zip file to write. An existing file is truncated.
+        """
+        self.path = path
+        self.count = 0
+        self._names = set()
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+        self._discarded = False
+        self._file = open(path, "wb")
+        self._zipf = zipfile.ZipFile(
+            _AppendOnlyFile(self._file), "w", compression=zipfile.ZIP_STORED
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
+
+    def add(self, file_path, arcname=None, remove=False):
+        """
+        Appends a file to the archive and makes its bytes available to readers.
+
+        Args:
+            file_path (str): The path of the file to add.
+            arcname (str, optional): The name inside the archive. Defaults to the file name.
+                A counter is appended if the name is already used (e.g. "Song (2).mp3").
+            remove (bool, optional): Delete the file once it is archived. Defaults to False.
+        """
+        with self._lock:
+            self._zipf.write(
+                file_path, self._unique_name(arcname or os.path.basename(file_path))
+            )
+            self._file.flush()
+            self.count += 1
+        if remove:
+            os.remove(file_path)
+
+    def _unique_name(self, arcname):
+        base, ext = os.path.splitext(arcname)
+        name, counter = arcname, 1
+        while name in self._names:
+            counter += 1
+            name = f"{base} ({counter}){ext}"
+        self._names.add(name)
+        return name
+
+    def close(self):
+        """Writes the central directory and closes the archive."""
+        with self._lock:
+            if self._finished.is_set():
+                return
+            self._zipf.close()
+            self._file.close()
+            self._finished.set()
+
+    def discard(self):
+        """
+        Closes the archive and deletes it, e.g. when the job building it failed.
+
+        Readers stop with ArchiveDiscarded instead of seeing the archive end early.
+        """
+        self._discarded = True
+        self.close()
+        try:
+            os.remove(self.path)
+        except PermissionError:
+            pass  # Still open in a reader on Windows, which removes it when done
+
+    def iter_bytes(self, chunk_size=CHUNK_SIZE):
+        """
+        Yields the archive's bytes as they are written, until the archive is closed.
+
+        This can be sent as a chunked HTTP response (see storage.FilesHandler), so a
+        client starts receiving the archive as soon as the first track is added.
+
+        Args:
+            chunk_size (int, optional): The maximum size of each yielded chunk.
+
+        Yields:
+            bytes: The next chunk of the archive.
+
+        Raises:
+            ArchiveDiscarded: If the archive is discarded before it is finished.
+        """
+        try:
+            with open(self.path, "rb") as reader:
+                while True:
+                    finished = self._finished.is_set()
+                    if self._discarded:
+                        raise ArchiveDiscarded(f"{self.path} was discarded")
+                    chunk = reader.read(chunk_size)
+                    if chunk:
+                        yield chunk
+                    elif finished:
+                        return  # Everything written before closing has been read
+                    else:
+                        self._finished.wait(POLL_INTERVAL)
+        except FileNotFoundError:
+            raise ArchiveDiscarded(f"{self.path} was discarded")
+        finally:
+            if self._discarded and os.path.exists(self.path):
+                try:
+                    os.remove(self.path)
+                except OSError:
+                    pass
+
+
+def zip_members(path):
+    """
+    Returns the names of the members of a zip archive.
+
+    Returns:
+        set: The member names, or None if the file doesn't exist or is not a valid zip.
+    """
+    try:
+        with zipfile.ZipFile(path) as zipf:
+            return set(zipf.namelist())
+    except (FileNotFoundError, zipfile.BadZipFile):
+        return None
+
+
+def update_zip(path, add_files, remove_names=()):
+    """
+    Brings an existing zip archive up to date without rebuilding it from scratch.
+
+    New files are appended to the archive in place. Only when members have to be removed
+    is the archive rewritten, copying the remaining members' stored bytes across.
+
+    Args:
+        path (str): The path of the zip file. It is created if it doesn't exist.
+        add_files (list): The paths of the files to append, named after their file names.
+        remove_names (list, optional): The names of the members to remove.
+    """
+    remove_names = set(remove_names)
+    if remove_names and os.path.exists(path):
+        temp_path = path + ".tmp"
+        with zipfile.ZipFile(path) as old_zipf, zipfile.ZipFile(
+            temp_path, "w", compression=zipfile.ZIP_STORED
+        ) as new_zipf:
+            for info in old_zipf.infolist():
+                if info.filename in remove_names:
+                    continue
+                with old_zipf.open(info) as source, new_zipf.open(info, "w") as target:
+                    shutil.copyfileobj(source, target, CHUNK_SIZE)
+        os.replace(temp_path, path)
+
+    with zipfile.ZipFile(path, "a", compression=zipfile.ZIP_STORED) as zipf:
+        for file_path in add_files:
+            zipf.write(file_path, os.path.basename(file_path))
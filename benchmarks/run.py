@@ -0,0 +1,480 @@
+"""
+Offline benchmarks for the download pipeline.
+
+yt-dlp is replaced by the fake from tests/fakes.py, extended to download synthetic audio
+files over HTTP from a local, bandwidth-limited server that also serves thumbnails. Each
+scenario runs in a fresh process and reports its wall time, throughput, the time spent in
+each pipeline stage, peak RSS and disk usage as JSON, so runs on different commits can be
+compared:
+
+    python benchmarks/run.py --output before.json
+    git checkout other-branch
+    python benchmarks/run.py --baseline before.json
+"""
+
+import argparse
+import contextlib
+import functools
+import http.server
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "tests")]
+
+import requests
+from PIL import Image
+
+import archive
+import cache
+import downloader
+import fakes
+import search
+import thumbnails
+
+# Scenarios in the order they run
+SCENARIOS = ("single", "playlist", "search", "zip")
+
+# Default size of each synthetic audio file, in bytes (about 4 minutes of 128k audio)
+TRACK_BYTES = 4 * 1024 * 1024
+
+# Default number of tracks in the playlist and zip scenarios
+PLAYLIST_TRACKS = 20
+
+# Default bandwidth of each connection to the local server, in bytes per second; 0 means
+# unlimited. Limiting it makes concurrency visible the way a real network would.
+BANDWIDTH = 16 * 1024 * 1024
+
+# Size of the chunks the server sends and the fake downloader reads
+CHUNK_SIZE = 64 * 1024
+
+# How often disk usage is sampled, in seconds
+DISK_SAMPLE_INTERVAL = 0.05
+
+
+class StageTimer:
+    """Adds up the calls and time spent in each pipeline stage, across all threads."""
+
+    def __init__(self):
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self._lock:
+            totals = self.stages.setdefault(stage, {"calls": 0, "seconds": 0.0})
+            totals["calls"] += 1
+            totals["seconds"] += seconds
+
+    def wrap(self, stage, function):
+        """Returns function wrapped so its calls are recorded under stage."""
+
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - start)
+
+        return timed
+
+
+class DiskSampler(threading.Thread):
+    """Tracks the peak size of a directory tree while a scenario runs."""
+
+    def __init__(self, directory):
+        super().__init__(daemon=True)
+        self.directory = directory
+        self.peak = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.peak = max(self.peak, directory_size(self.directory))
+            self._stop_event.wait(DISK_SAMPLE_INTERVAL)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.peak = max(self.peak, directory_size(self.directory))
+
+
+def directory_size(directory):
+    """Returns the total size of the files under a directory, in bytes."""
+    total = 0
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                pass  # Removed while walking
+    return total
+
+
+def peak_rss_mb():
+    """Returns the peak resident set size of this process in MiB, where available."""
+    try:
+        import resource
+    except ImportError:
+        return None  # Not available on Windows
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere
+    return round(peak / 1024**2 if sys.platform == "darwin" else peak / 1024, 1)
+
+
+def throttled_handler(directory, bandwidth):
+    """Returns a request handler serving directory, sending at most bandwidth bytes/s."""
+
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=directory, **kwargs)
+
+        def copyfile(self, source, outputfile):
+            while True:
+                start = time.perf_counter()
+                chunk = source.read(CHUNK_SIZE)
+                if not chunk:
+                    return
+                outputfile.write(chunk)
+                if bandwidth:
+                    delay = len(chunk) / bandwidth - (time.perf_counter() - start)
+                    if delay > 0:
+                        time.sleep(delay)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+class ServedYoutubeDL(fakes.FakeYoutubeDL):
+    """The offline fake yt-dlp, downloading each video's audio from the local server."""
+
+    timer = None
+
+    def extract_info(self, url, download=True, process=True, ie_key=None):
+        start = time.perf_counter()
+        try:
+            return super().extract_info(url, download=False, process=process)
+        finally:
+            self.timer.record("extract", time.perf_counter() - start)
+
+    def process_ie_result(self, info_dict, download=True):
+        if self.params.get("merge_output_format"):
+            info_dict["ext"] = self.params["merge_output_format"]
+        if not download:
+            return info_dict
+
+        start = time.perf_counter()
+        fakes.DOWNLOADED.append(info_dict["id"])
+        filename = self.prepare_filename(info_dict)
+        with requests.get(info_dict["url"], stream=True) as response:
+            response.raise_for_status()
+            total = int(response.headers.get("Content-Length", 0))
+            downloaded = 0
+            with open(filename, "wb") as target:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    target.write(chunk)
+                    downloaded += len(chunk)
+                    for hook in self.params.get("progress_hooks", []):
+                        hook(
+                            {
+                                "status": "downloading",
+                                "filename": filename,
+                                "downloaded_bytes": downloaded,
+                                "total_bytes": total,
+                            }
+                        )
+        self.timer.record("download", time.perf_counter() - start)
+        return info_dict
+
+
+def make_media(directory, count, track_bytes, decodable=False):
+    """
+    Writes count synthetic audio files and a thumbnail for the server to serve.
+
+    The audio is random bytes of the given size, or with decodable set, a sine tone
+    encoded to Opus by ffmpeg, so the real transcode step can run on it.
+    """
+    os.makedirs(directory, exist_ok=True)
+    # A noisy thumbnail compresses about as badly as a real maxres one
+    thumbnail = Image.effect_noise((1280, 720), 64).convert("RGB")
+    thumbnail.save(os.path.join(directory, "thumbnail.jpg"), quality=90)
+    for index in range(count):
+        audio_file = os.path.join(directory, f"audio{index}.webm")
+        if decodable:
+            # Roughly track_bytes of 128 kbps audio
+            duration = max(1, track_bytes * 8 // 128000)
+            subprocess.run(
+                ["ffmpeg", "-v", "error", "-y", "-f", "lavfi"]
+                + ["-i", f"sine=frequency=440:duration={duration}"]
+                + ["-c:a", "libopus", "-b:a", "128k", audio_file],
+                check=True,
+            )
+        else:
+            with open(audio_file, "wb") as audio:
+                audio.write(os.urandom(track_bytes))
+
+
+def register_videos(base_url, count):
+    """Registers count fake videos whose audio and thumbnail are on the local server."""
+    video_urls = []
+    for index in range(count):
+        video_url = fakes.add_video(f"bench{index}", f"Benchmark Track {index}")
+        fakes.VIDEOS[video_url]["url"] = f"{base_url}/audio{index}.webm"
+        # Every video gets its own thumbnail URL, so the thumbnail cache doesn't hide fetches
+        fakes.VIDEOS[video_url]["thumbnail"] = f"{base_url}/thumbnail.jpg?v={index}"
+        video_urls.append(video_url)
+    return video_urls
+
+
+@contextlib.contextmanager
+def patched(target, name, value):
+    """Temporarily replaces an attribute."""
+    original = getattr(target, name)
+    setattr(target, name, value)
+    try:
+        yield
+    finally:
+        setattr(target, name, original)
+
+
+def run_scenario(name, options):
+    """
+    Runs one scenario in the current process, against a fresh temporary directory.
+
+    Args:
+        name (str): One of SCENARIOS.
+        options (dict): The parsed command line options.
+
+    Returns:
+        dict: The scenario's measurements.
+    """
+    tracks = 1 if name == "single" else options["tracks"]
+    if name == "search":
+        tracks = min(tracks, 3)
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    media_dir = os.path.join(workdir, "media")
+    output_dir = os.path.join(workdir, "output")
+    os.makedirs(output_dir)
+    make_media(media_dir, tracks, options["track_bytes"], options["ffmpeg"])
+
+    server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0), throttled_handler(media_dir, options["bandwidth"])
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    fakes.reset()
+    video_urls = register_videos(base_url, tracks)
+    timer = StageTimer()
+    ServedYoutubeDL.timer = timer
+
+    # Route everything through the fakes, fresh caches and the scenario's directories
+    download_cache = cache.DownloadCache(os.path.join(output_dir, ".cache"))
+    info_cache = cache.InfoCache()
+    patches = [
+        (downloader.yt_dlp, "YoutubeDL", ServedYoutubeDL),
+        (downloader, "DOWNLOADS_DIR", output_dir),
+        (thumbnails, "THUMBNAIL_CACHE_DIR", os.path.join(output_dir, ".thumbnails")),
+        (search, "thread_state", threading.local()),
+        (search, "audio_downloads", {}),
+        (
+            downloader,
+            "fetch_thumbnail",
+            timer.wrap("thumbnail", thumbnails.fetch_thumbnail),
+        ),
+        (
+            search,
+            "fetch_thumbnail",
+            timer.wrap("thumbnail", thumbnails.fetch_thumbnail),
+        ),
+        (
+            downloader,
+            "prepare_cover_art",
+            timer.wrap("cover_art", downloader.prepare_cover_art),
+        ),
+        (downloader, "write_tags", timer.wrap("tag", downloader.write_tags)),
+        (archive.StreamingZip, "add", timer.wrap("zip", archive.StreamingZip.add)),
+    ]
+    for module in (downloader, search):
+        patches.append((module, "download_cache", download_cache))
+        patches.append((module, "info_cache", info_cache))
+    if not options["ffmpeg"]:
+        # The synthetic audio isn't decodable; time the stand-in so the stage still shows
+        patches.append(
+            (
+                downloader,
+                "transcode_audio",
+                timer.wrap("transcode", fakes.fake_transcode_audio),
+            )
+        )
+    else:
+        patches.append(
+            (
+                downloader,
+                "transcode_audio",
+                timer.wrap("transcode", downloader.transcode_audio),
+            )
+        )
+
+    sampler = DiskSampler(output_dir)
+    with contextlib.ExitStack() as stack:
+        for target, attribute, value in patches:
+            stack.enter_context(patched(target, attribute, value))
+        sampler.start()
+        start = time.perf_counter()
+        if name == "single":
+            downloader.download_audio_and_metadata(video_urls[0])
+        elif name == "playlist":
+            playlist_url = fakes.add_playlist("benchmark", "Benchmark", video_urls)
+            downloader.process_playlist(
+                playlist_url,
+                download_workers=options["download_workers"],
+                postprocess_workers=options["postprocess_workers"],
+            )
+        elif name == "search":
+            fakes.add_search("benchmark", video_urls)
+            search.get_video_info(
+                "benchmark", tracks, os.path.join(output_dir, "search")
+            )
+        elif name == "zip":
+            sources = [
+                os.path.join(media_dir, f"audio{index}.webm") for index in range(tracks)
+            ]
+            with archive.StreamingZip(os.path.join(output_dir, "bench.zip")) as zipf:
+                for source in sources:
+                    zipf.add(source)
+        seconds = time.perf_counter() - start
+        sampler.stop()
+
+    server.shutdown()
+    result = {
+        "seconds": round(seconds, 3),
+        "tracks": tracks,
+        "tracks_per_min": round(tracks / seconds * 60, 1),
+        "stages": {
+            stage: {"calls": totals["calls"], "seconds": round(totals["seconds"], 3)}
+            for stage, totals in sorted(timer.stages.items())
+        },
+        "peak_rss_mb": peak_rss_mb(),
+        "peak_disk_bytes": sampler.peak,
+        "final_disk_bytes": directory_size(output_dir),
+    }
+    shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+def run_in_child(name, options):
+    """Runs a scenario in a fresh process, so its peak RSS isn't shared with others."""
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1) as pool:
+        return pool.apply(run_scenario, (name, options))
+
+
+def current_commit():
+    """Returns the commit being benchmarked, or None outside a git checkout."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """Prints how each scenario's time and throughput changed relative to a baseline."""
+    for name, result in results["scenarios"].items():
+        before = baseline.get("scenarios", {}).get(name)
+        if not before:
+            continue
+        change = (result["seconds"] - before["seconds"]) / before["seconds"] * 100
+        print(
+            f"{name}: {before['seconds']}s -> {result['seconds']}s ({change:+.1f}%), "
+            f"{before['tracks_per_min']} -> {result['tracks_per_min']} tracks/min",
+            file=sys.stderr,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "scenarios",
+        nargs="*",
+        help=f"Scenarios to run, any of {', '.join(SCENARIOS)} (default: all)",
+    )
+    parser.add_argument("--tracks", type=int, default=PLAYLIST_TRACKS)
+    parser.add_argument("--track-bytes", type=int, default=TRACK_BYTES)
+    parser.add_argument(
+        "--bandwidth",
+        type=int,
+        default=BANDWIDTH,
+        help="Bytes/s per connection, 0 = unlimited",
+    )
+    parser.add_argument(
+        "--download-workers", type=int, default=downloader.DOWNLOAD_WORKERS
+    )
+    parser.add_argument(
+        "--postprocess-workers", type=int, default=downloader.POSTPROCESS_WORKERS
+    )
+    parser.add_argument(
+        "--ffmpeg",
+        action="store_true",
+        help="Serve real Opus audio and time the real transcode step (needs ffmpeg)",
+    )
+    parser.add_argument("--output", help="Write the JSON results to this file")
+    parser.add_argument(
+        "--baseline", help="JSON results of an earlier run to compare with"
+    )
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario: {name}")
+
+    options = vars(args)
+    results = {
+        "commit": current_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "options": {
+            key: options[key]
+            for key in (
+                "tracks",
+                "track_bytes",
+                "bandwidth",
+                "download_workers",
+                "postprocess_workers",
+                "ffmpeg",
+            )
+        },
+        "scenarios": {
+            name: run_in_child(name, options) for name in args.scenarios or SCENARIOS
+        },
+    }
+
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            output_file.write(report + "\n")
+    else:
+        print(report)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as baseline_file:
+            compare(results, json.load(baseline_file))
+
+
+if __name__ == "__main__":
+    main()
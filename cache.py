@@ -0,0 +1,385 @@
+import collections
+import concurrent.futures
+import copy
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+from metrics import registry, timed
+from ratelimit import with_retries
+
+# Directory holding cached downloads and their index
+CACHE_DIR = os.path.join("downloads", ".cache")
+
+# Total size of the cached files before the least recently used ones are evicted
+CACHE_MAX_BYTES = 2 * 1024**3
+
+# How long extracted video information stays valid, in seconds. Stream URLs in the
+# extracted formats expire after a few hours, so this must stay well below that.
+INFO_CACHE_TTL = 30 * 60
+
+# How many extraction results are kept in memory before the least recently used go
+INFO_CACHE_ENTRIES = 1024
+
+# Keys yt-dlp's format selection adds to a video besides those of the selected format
+SELECTION_KEYS = {"requested_formats", "requested_downloads", "format", "format_id"}
+
+
+def unselect_formats(info_dict):
+    """
+    Removes what yt-dlp's format selection copied into an extracted video, in place.
+
+    A processed video carries the streams picked for the caller's "format" option, e.g.
+    "requested_formats" for bestvideo+bestaudio, which processing it again with another
+    option would keep. Without them every caller selects from "formats" itself.
+
+    Args:
+        info_dict (dict): The extracted video or playlist.
+
+    Returns:
+        dict: The same dictionary.
+    """
+    for entry in info_dict.get("entries") or ():
+        if isinstance(entry, dict):
+            unselect_formats(entry)
+    formats = info_dict.get("formats")
+    if formats:
+        selected = set(SELECTION_KEYS)
+        for stream in formats:
+            selected.update(stream)
+        for key in selected - {"formats"}:
+            info_dict.pop(key, None)
+    return info_dict
+
+
+def link_or_copy(source, destination):
+    """Hard-links source to destination, or copies it if the file system can't link."""
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def unshare_file(path):
+    """
+    Gives a hard-linked file its own copy of its data, so it can be modified in place
+    without changing the other links, e.g. a media index's stored copy.
+    """
+    if os.stat(path).st_nlink > 1:
+        temp_path = path + ".tmp"
+        shutil.copy2(path, temp_path)
+        os.replace(temp_path, path)
+
+
+class DownloadCache:
+    """
+    A persistent cache of downloaded media, keyed by video ID, format and quality.
+
+    Files are kept in a directory with a JSON index recording their size and when they were
+    last used. When the cache grows beyond its size limit, the least recently used files
+    are evicted.
+    """
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        """
+        Creates the cache. Nothing is read or written until the cache is first used.
+
+        Args:
+            directory (str, optional): The directory to store cached files in.
+            max_bytes (int, optional): The maximum total size of the cached files.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._index = None
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _key(video_id, media_format, quality):
+        return f"{video_id}-{media_format}-{quality}"
+
+    def _index_path(self):
+        return os.path.join(self.directory, "index.json")
+
+    def _load(self):
+        # Read the index on first use
+        if self._index is None:
+            os.makedirs(self.directory, exist_ok=True)
+            try:
+                with open(self._index_path(), "r", encoding="utf-8") as index_file:
+                    self._index = json.load(index_file)
+            except (FileNotFoundError, ValueError):
+                self._index = {}
+        return self._index
+
+    def _save(self):
+        # Write to a temporary file first so a crash never leaves a truncated index
+        temp_path = self._index_path() + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as index_file:
+            json.dump(self._index, index_file)
+        os.replace(temp_path, self._index_path())
+
+    def get(self, video_id, media_format, quality, destination, link=False):
+        """
+        Places a cached file at destination if one exists.
+
+        Args:
+            video_id (str): The ID of the video.
+            media_format (str): The format of the cached file, e.g. "mp3".
+            quality (str): The quality of the cached file, e.g. "192".
+            destination (str): The path to place the cached file at.
+            link (bool, optional): Hard-link instead of copying. Only use this when the
+                file at destination won't be modified. Defaults to False.
+
+        Returns:
+            bool: True on a cache hit, False on a miss.
+        """
+        key = self._key(video_id, media_format, quality)
+        with self._lock:
+            entry = self._load().get(key)
+            cached_file = entry and os.path.join(self.directory, entry["file"])
+            if not entry or not os.path.exists(cached_file):
+                self._index.pop(key, None)
+                self.misses += 1
+                return False
+
+            if link:
+                link_or_copy(cached_file, destination)
+            else:
+                shutil.copyfile(cached_file, destination)
+            entry["last_used"] = time.time()
+            self._save()
+            self.hits += 1
+            return True
+
+    def put(self, video_id, media_format, quality, file_path, link=False):
+        """
+        Stores a copy of a file in the cache, evicting old files if the cache is full.
+
+        Args:
+            video_id (str): The ID of the video.
+            media_format (str): The format of the file, e.g. "mp3".
+            quality (str): The quality of the file, e.g. "192".
+            file_path (str): The path of the file to store. It is left in place.
+            link (bool, optional): Hard-link instead of copying. Only use this when the
+                file at file_path won't be modified. Defaults to False.
+        """
+        key = self._key(video_id, media_format, quality)
+        cached_name = key + os.path.splitext(file_path)[1]
+        with self._lock:
+            self._load()
+            temp_path = os.path.join(self.directory, cached_name + ".tmp")
+            if link:
+                link_or_copy(file_path, temp_path)
+            else:
+                shutil.copyfile(file_path, temp_path)
+            os.replace(temp_path, os.path.join(self.directory, cached_name))
+            self._index[key] = {
+                "file": cached_name,
+                "size": os.path.getsize(file_path),
+                "last_used": time.time(),
+            }
+            self._evict()
+            self._save()
+
+    def _evict(self):
+        # Remove least recently used files until the cache fits its size limit
+        total = sum(entry["size"] for entry in self._index.values())
+        for key, entry in sorted(
+            self._index.items(), key=lambda item: item[1]["last_used"]
+        ):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, entry["file"]))
+            except FileNotFoundError:
+                pass
+            del self._index[key]
+            total -= entry["size"]
+
+    def stats(self):
+        """
+        Returns the cache's hit and miss counters and its current size.
+
+        Returns:
+            dict: Contains hits, misses, entries and bytes.
+        """
+        with self._lock:
+            index = self._load()
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(index),
+                "bytes": sum(entry["size"] for entry in index.values()),
+            }
+
+
+class InfoCache:
+    """
+    A time-limited cache of yt-dlp extraction results, so each URL is resolved only once.
+
+    Results are kept in memory and, if a directory is given, also written to disk so they
+    survive a restart. Concurrent misses for the same URL share a single extraction.
+    """
+
+    def __init__(
+        self, ttl=INFO_CACHE_TTL, directory=None, max_entries=INFO_CACHE_ENTRIES
+    ):
+        """
+        Creates the cache.
+
+        Args:
+            ttl (float, optional): How long a result stays valid, in seconds.
+            directory (str, optional): A directory to persist results in. Defaults to None,
+                which keeps results in memory only.
+            max_entries (int, optional): How many results to keep in memory. Persisted results
+                are read back from disk when they are needed again.
+        """
+        self.ttl = ttl
+        self.directory = directory
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        digest = hashlib.sha1(json.dumps(key).encode()).hexdigest()
+        return os.path.join(self.directory, f"{digest}.json")
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None and self.directory:
+            try:
+                with open(self._path(key), "r", encoding="utf-8") as entry_file:
+                    entry = json.load(entry_file)
+            except (FileNotFoundError, ValueError):
+                entry = None
+        if entry is None:
+            return None
+        if entry["expires"] < time.time():
+            self._forget(key)
+            return None
+        self._remember(key, entry)
+        return entry["info"]
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _forget(self, key):
+        self._entries.pop(key, None)
+        if self.directory:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def _store(self, key, info_dict):
+        entry = {"expires": time.time() + self.ttl, "info": info_dict}
+        self._remember(key, entry)
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            temp_path = self._path(key) + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as entry_file:
+                json.dump(entry, entry_file)
+            os.replace(temp_path, self._path(key))
+
+    def extract_info(self, ydl, url):
+        """
+        Returns the information yt-dlp extracts for a URL without downloading it.
+
+        The result can be passed to ydl.process_ie_result(info_dict, download=True) to
+        download the media without extracting it again. Formats are not selected in it
+        (see unselect_formats), so callers with different "format" options share it.
+
+        Args:
+            ydl (yt_dlp.YoutubeDL): The downloader to extract with on a cache miss. Whether it
+                extracts playlists flat is part of the cache key.
+            url (str): The URL of the video, playlist or search to extract.
+
+        Returns:
+            dict: A copy of the extracted information, safe to modify.
+        """
+        flat = bool(ydl.params.get("extract_flat"))
+        key = (url, flat)
+        with self._lock:
+            info_dict = self._lookup(key)
+            if info_dict is not None:
+                self.hits += 1
+                return copy.deepcopy(info_dict)
+            pending = self._pending.get(key)
+            if pending is None:
+                self.misses += 1
+                self._pending[key] = extraction = concurrent.futures.Future()
+            else:
+                self.hits += 1
+
+        # Another thread is extracting the same URL, so wait for its result
+        if pending is not None:
+            return copy.deepcopy(pending.result())
+
+        try:
+            with timed("extract", url=url, flat=flat):
+                info_dict = unselect_formats(
+                    ydl.sanitize_info(
+                        with_retries(ydl.extract_info, url, download=False, url=url)
+                    )
+                )
+            self.add(url, info_dict, flat)
+        except BaseException as error:
+            extraction.set_exception(error)
+            raise
+        else:
+            extraction.set_result(info_dict)
+        finally:
+            with self._lock:
+                del self._pending[key]
+        return copy.deepcopy(info_dict)
+
+    def add(self, url, info_dict, flat=False):
+        """
+        Stores information that was extracted elsewhere, e.g. a video from search results.
+
+        Args:
+            url (str): The URL the information belongs to.
+            info_dict (dict): The extracted information. It must be JSON serializable, see
+                yt_dlp.YoutubeDL.sanitize_info.
+            flat (bool, optional): Whether playlist entries were extracted flat.
+        """
+        info_dict = unselect_formats(copy.deepcopy(info_dict))
+        with self._lock:
+            self._store((url, flat), info_dict)
+            # Flat extraction only changes how playlist entries are resolved
+            if "entries" not in info_dict:
+                self._store((url, not flat), info_dict)
+
+    def clear(self):
+        """Forgets every result held in memory."""
+        with self._lock:
+            self._entries.clear()
+
+
+# Shared caches used by the downloader and search modules
+download_cache = DownloadCache()
+info_cache = InfoCache()
+
+# Report the shared caches' counters along with the other metrics
+for name, shared_cache in (("download", download_cache), ("info", info_cache)):
+    registry.register_callback(
+        "downloaddynamo_cache_hits_total",
+        lambda shared_cache=shared_cache: shared_cache.hits,
+        cache=name,
+    )
+    registry.register_callback(
+        "downloaddynamo_cache_misses_total",
+        lambda shared_cache=shared_cache: shared_cache.misses,
+        cache=name,
+    )
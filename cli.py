@@ -0,0 +1,187 @@
+"""
+Runs downloads from the command line, without starting the web interface.
+
+URLs are read from the arguments and from a file (one per line, "#" starts a comment),
+downloaded a few at a time, and a JSON manifest records the outcome of each one:
+
+    python cli.py --input urls.txt --workers 4 --manifest results.json
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from downloader import (
+    AUDIO_FORMATS,
+    audio_pipeline,
+    output_storage,
+    video_pipeline,
+)
+from metrics import log_event, start_metrics_server
+
+# Number of URLs downloaded at the same time. Playlists also download their own
+# entries in parallel, so this stays low.
+BATCH_WORKERS = 2
+
+
+def read_urls(path):
+    """
+    Reads URLs from a file, skipping blank lines and comments.
+
+    Args:
+        path (str): The path to the file, or "-" for standard input.
+
+    Returns:
+        list: The URLs, in file order.
+    """
+    if path == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(path, "r", encoding="utf-8") as url_file:
+            lines = url_file.read().splitlines()
+    urls = (line.split("#", 1)[0].strip() for line in lines)
+    return [url for url in urls if url]
+
+
+def run_one(url, kind, audio_format="mp3", sync=False, storage=None):
+    """
+    Downloads a single URL, catching its error so the rest of the batch carries on.
+
+    The output is handed to the storage backend (see storage.open_storage), and the
+    manifest records where it was stored.
+
+    Returns:
+        dict: The URL's entry in the result manifest.
+    """
+    start = time.perf_counter()
+    try:
+        if kind == "video":
+            output = video_pipeline(url)
+        else:
+            output = audio_pipeline(url, audio_format=audio_format, sync=sync)
+        backend = output_storage(storage)
+        location = backend.location(backend.put(output))
+        result = {"url": url, "status": "done", "output": location}
+    except Exception as error:
+        result = {"url": url, "status": "failed", "error": str(error) or repr(error)}
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    log_event("batch_item", **result)
+    return result
+
+
+def run_batch(
+    urls,
+    kind="audio",
+    audio_format="mp3",
+    sync=False,
+    workers=BATCH_WORKERS,
+    storage=None,
+):
+    """
+    Downloads a list of URLs, workers at a time.
+
+    A URL that fails is recorded as failed; it doesn't stop the others.
+
+    Args:
+        urls (list): YouTube video or playlist URLs.
+        kind (str, optional): "audio" or "video". Defaults to "audio".
+        audio_format (str, optional): One of downloader.AUDIO_FORMATS. Defaults to "mp3".
+        sync (bool, optional): Sync playlists into the library instead of downloading
+            them in full. Defaults to False.
+        workers (int, optional): The number of URLs downloaded at the same time.
+        storage (str, optional): Where to keep the outputs, see storage.open_storage.
+            Defaults to storage.STORAGE.
+
+    Returns:
+        dict: The result manifest, with one result per URL in input order.
+    """
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        results = list(
+            pool.map(lambda url: run_one(url, kind, audio_format, sync, storage), urls)
+        )
+    return {
+        "started": started,
+        "finished": time.time(),
+        "kind": kind,
+        "audio_format": audio_format,
+        "done": sum(result["status"] == "done" for result in results),
+        "failed": sum(result["status"] == "failed" for result in results),
+        "results": results,
+    }
+
+
+def write_manifest(manifest, path):
+    """Writes the result manifest as JSON, to standard output if path is "-"."""
+    report = json.dumps(manifest, indent=2)
+    if path == "-":
+        print(report)
+        return
+    # Write to a temporary file first so readers never see a truncated manifest
+    temp_path = path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as manifest_file:
+        manifest_file.write(report + "\n")
+    os.replace(temp_path, path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("urls", nargs="*", help="YouTube video or playlist URLs")
+    parser.add_argument(
+        "-i", "--input", help='File of URLs, one per line ("-" for standard input)'
+    )
+    parser.add_argument("--kind", choices=("audio", "video"), default="audio")
+    parser.add_argument("--format", choices=AUDIO_FORMATS, default="mp3")
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        help="Sync playlists into the library instead of downloading them in full",
+    )
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS)
+    parser.add_argument(
+        "--manifest",
+        default="-",
+        help='Where to write the JSON results ("-" for stdout)',
+    )
+    parser.add_argument(
+        "--storage",
+        help='Where to keep the outputs: "shared:<path>", "s3://<bucket>/<prefix>" or '
+        '"s3-local:<path>" (default: the downloads directory)',
+    )
+    parser.add_argument(
+        "--metrics-port", type=int, help="Serve Prometheus metrics on this port"
+    )
+    parser.add_argument(
+        "--metrics-host",
+        default="127.0.0.1",
+        help="Address the metrics endpoint listens on (default: this machine only)",
+    )
+    args = parser.parse_args(argv)
+
+    urls = list(args.urls)
+    if args.input:
+        urls.extend(read_urls(args.input))
+    if not urls:
+        parser.error("no URLs given")
+
+    # Structured logs go to stderr, so stdout only carries the manifest
+    logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stderr)
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port, args.metrics_host)
+
+    # The pipeline prints progress notes; keep them out of a manifest written to stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        manifest = run_batch(
+            urls, args.kind, args.format, args.sync, args.workers, args.storage
+        )
+    write_manifest(manifest, args.manifest)
+    return 1 if manifest["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
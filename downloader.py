@@ -1,15 +1,110 @@
-import yt_dlp
-from mutagen.easyid3 import EasyID3
-from mutagen.id3 import ID3, APIC
-import requests
-from PIL import Image
 from io import BytesIO
+from archive import StreamingZip, update_zip, zip_members
+from cache import download_cache, info_cache
+from fragments import (
+    FRAGMENT_WORKERS,
+    PARALLEL_MIN_SIZE,
+    RangesNotSupported,
+    StreamProgress,
+    download_ranges,
+)
+from lazy import LazyModule
+from library import INDEX_FILENAME, PlaylistLibrary, media_index, reserve_path
+from manifest import PlaylistManifest
+from metrics import logger, registry, timed
+from postprocessing import ffmpeg_scheduler
+from ratelimit import RETRIES, host_limits, with_retries
+from storage import LocalStorage, get_storage, serve_while_growing
+from tagging import TAG_WRITERS, apply_tags, set_track_number, write_tags
+from thumbnails import fetch_thumbnail
+import collections
+import contextlib
+import copy
+import hashlib
+import itertools
+import json
 import os
-import zipfile
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Heavy modules are imported on first use, so importing this module stays fast
+yt_dlp = LazyModule("yt_dlp")
+Image = LazyModule("PIL.Image")
+
+# yt-dlp extractors that are loaded; every URL this app handles is a YouTube one, and
+# skipping the other extractors makes creating each YoutubeDL several times faster
+ALLOWED_EXTRACTORS = ["youtube.*"]
 
 # Define the downloads directory
 DOWNLOADS_DIR = "downloads"
 
+# Codec and bitrate (kbps) of the downloaded audio
+AUDIO_CODEC = "mp3"
+AUDIO_QUALITY = "192"
+
+# Audio output formats: "mp3" converts to AUDIO_CODEC, "native" keeps the source codec and
+# only remuxes it into a taggable container, so no CPU-heavy re-encode is needed
+AUDIO_FORMATS = ("mp3", "native")
+
+# Codec that FFmpegExtractAudio is asked for, and the extension it produces, for each
+# source codec in the "native" format. Asking for the source's own codec makes ffmpeg
+# copy the stream; other codecs can't be kept natively.
+NATIVE_CODECS = {
+    "opus": ("opus", "opus"),
+    "mp4a": ("m4a", "m4a"),
+    "aac": ("m4a", "m4a"),
+    "vorbis": ("vorbis", "ogg"),
+    "mp3": ("mp3", "mp3"),
+    "flac": ("flac", "flac"),
+}
+
+# Maximum width and height of embedded album art, and its JPEG quality. YouTube's maxres
+# thumbnails would otherwise add hundreds of KB to every file.
+COVER_ART_MAX_SIZE = 600
+COVER_ART_QUALITY = 85
+
+# Number of playlist entries downloaded at the same time
+DOWNLOAD_WORKERS = 4
+
+# Number of playlist entries converted and tagged at the same time (ffmpeg is CPU-bound)
+POSTPROCESS_WORKERS = os.cpu_count() or 1
+
+# Maximum number of playlist entries in flight (downloading, converting or waiting to be
+# zipped) at a time, so memory and disk use don't grow with the playlist's length
+PLAYLIST_WINDOW = 16
+
+# Number of playlist entries read from yt-dlp and recorded in the manifest at a time
+PLAYLIST_PAGE_SIZE = 100
+
+# How long finished downloads handed out by publish_output (e.g. "playlist (2).zip")
+# are kept, in seconds. None keeps them until they are deleted by hand.
+OUTPUT_RETENTION = None
+
+# File in the downloads directory recording the published downloads, see prune_outputs
+PUBLISHED_FILENAME = ".published.json"
+
+# Seconds between two clean-ups of the published downloads, see maybe_prune_outputs
+PRUNE_INTERVAL = 10 * 60
+
+# When the published downloads of each downloads directory were last cleaned up; the
+# lock also guards the record of published downloads
+last_pruned = {}
+prune_lock = threading.Lock()
+
+
+def warm_up():
+    """
+    Imports yt-dlp and loads its YouTube extractors ahead of the first download.
+
+    Meant to run on a background thread once the interface is up, so the first request
+    doesn't pay for the imports.
+    """
+    yt_dlp.YoutubeDL({"quiet": True, "allowed_extractors": ALLOWED_EXTRACTORS}).close()
+    Image.init()
+
 
 def ensure_downloads_directory():
     """Ensure the downloads directory exists."""
@@ -17,7 +112,508 @@ def ensure_downloads_directory():
         os.makedirs(DOWNLOADS_DIR)
 
 
-def download_audio_and_metadata(youtube_url, track_number=None, album=None):
+def create_work_directory():
+    """
+    Creates a private scratch directory for a single download job.
+
+    The directory lives inside the downloads directory, so finished files can be moved
+    into place with an atomic rename.
+
+    Returns:
+        str: The path to the new, empty work directory.
+    """
+    work_root = os.path.join(DOWNLOADS_DIR, ".work")
+    os.makedirs(work_root, exist_ok=True)
+    return tempfile.mkdtemp(prefix="job-", dir=work_root)
+
+
+def remove_work_directory(work_dir):
+    """Removes a work directory created by create_work_directory and everything left in it."""
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def unique_output_path(filename):
+    """
+    Reserves a path in the downloads directory that no other job is using.
+
+    If the name is taken, a counter is appended (e.g. "Song (2).mp3"). The path is
+    reserved by creating an empty placeholder file, so concurrent jobs never get the
+    same path.
+
+    Args:
+        filename (str): The desired file name.
+
+    Returns:
+        str: The reserved path.
+    """
+    return reserve_path(DOWNLOADS_DIR, filename)
+
+
+def move_to_downloads(work_file, filename, key=None, details=None):
+    """
+    Atomically moves a finished file from a work directory into the downloads directory.
+
+    With a key, the file is stored through the downloads directory's media index instead:
+    if a file with the same content is already stored, the new one is dropped, and the
+    file can later be looked up by the key. Either way the caller gets its own copy, which
+    it may tag or delete without affecting other callers.
+
+    Args:
+        work_file (str): The path to the finished file.
+        filename (str): The desired file name in the downloads directory.
+        key (str, optional): The media index key, see library.MediaIndex.
+        details (dict, optional): Details stored with the key.
+
+    Returns:
+        str: The final path of the file.
+    """
+    if key is not None:
+        return media_index(DOWNLOADS_DIR).store(work_file, filename, key, details)
+    output_path = unique_output_path(filename)
+    os.replace(work_file, output_path)  # Replaces the placeholder in one step
+    return output_path
+
+
+def output_storage(spec=None):
+    """Returns the backend finished downloads are kept in, see storage.open_storage."""
+    return get_storage(DOWNLOADS_DIR, spec)
+
+
+def publish_output(path, spec=None):
+    """
+    Hands a finished download to the storage backend, which takes ownership of it.
+
+    With the default local storage the file is already in place and nothing is copied.
+    With an OUTPUT_RETENTION, the file is recorded so prune_outputs removes it later.
+
+    Args:
+        path (str): The path to the finished file, e.g. a playlist zip.
+        spec (str, optional): The storage, see storage.open_storage. Defaults to
+            storage.STORAGE.
+
+    Returns:
+        str: The name of the stored file.
+    """
+    name = output_storage(spec).put(path)
+    # Synced libraries are updated in place, so they are never recorded
+    if OUTPUT_RETENTION is not None and not name.startswith("library/"):
+        with prune_lock:
+            published = read_published()
+            published.append({"name": name, "storage": spec, "published": time.time()})
+            write_published(published)
+        maybe_prune_outputs()
+    return name
+
+
+def read_published():
+    """Returns the record of published downloads, see publish_output."""
+    try:
+        with open(
+            os.path.join(DOWNLOADS_DIR, PUBLISHED_FILENAME), "r", encoding="utf-8"
+        ) as published_file:
+            return json.load(published_file)
+    except (FileNotFoundError, ValueError):
+        return []
+
+
+def write_published(published):
+    """Replaces the record of published downloads in one step."""
+    ensure_downloads_directory()
+    path = os.path.join(DOWNLOADS_DIR, PUBLISHED_FILENAME)
+    with open(path + ".tmp", "w", encoding="utf-8") as published_file:
+        json.dump(published, published_file, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def prune_outputs(max_age=None):
+    """
+    Removes published downloads that are older than max_age.
+
+    Every job publishes a new file, e.g. "playlist (2).zip" next to an earlier
+    "playlist.zip", so files that were served or superseded would otherwise pile up. Only
+    files recorded by publish_output are removed, from the storage they were published
+    to; anything else in the downloads directory is never touched.
+
+    Args:
+        max_age (float, optional): The longest a published download is kept, in
+            seconds. Defaults to OUTPUT_RETENTION.
+
+    Returns:
+        int: The number of downloads removed.
+    """
+    max_age = OUTPUT_RETENTION if max_age is None else max_age
+    if max_age is None:
+        return 0
+    cutoff = time.time() - max_age
+    removed = 0
+    with prune_lock:
+        published = read_published()
+        kept = []
+        try:
+            for output in published:
+                if output["published"] > cutoff:
+                    kept.append(output)
+                    continue
+                try:
+                    output_storage(output["storage"]).remove(output["name"])
+                except FileNotFoundError:
+                    pass  # Already deleted by hand
+                removed += 1
+        finally:
+            # Outputs that weren't reached, e.g. after a storage error, are kept
+            write_published(kept + published[len(kept) + removed :])
+    return removed
+
+
+def maybe_prune_outputs():
+    """Runs prune_outputs, unless it ran in the last PRUNE_INTERVAL."""
+    now = time.monotonic()
+    with prune_lock:
+        if now - last_pruned.get(DOWNLOADS_DIR, -PRUNE_INTERVAL) < PRUNE_INTERVAL:
+            return
+        last_pruned[DOWNLOADS_DIR] = now
+    try:
+        prune_outputs()
+    except Exception as error:
+        # A storage that can't be reached mustn't stop the download that started this
+        logger.warning(f"Finished downloads not cleaned up: {error}")
+
+
+@contextlib.contextmanager
+def stream_archive(archive, progress_hook=None):
+    """
+    Lets the file server stream a playlist zip while the job is still adding to it.
+
+    Only zips that the output storage serves in place, e.g. with the default local
+    storage, can be streamed. The job is told the zip's storage name with a {"status":
+    "archive_started", "name"} progress event, so the interface can link to it right
+    away.
+
+    Args:
+        archive (archive.StreamingZip): The zip.
+        progress_hook (callable, optional): The job's progress hook.
+    """
+    storage = output_storage()
+    name = storage.name_of(archive.path) if isinstance(storage, LocalStorage) else None
+    if name is None:
+        yield
+        return
+    with serve_while_growing(name, archive):
+        if progress_hook:
+            progress_hook({"status": "archive_started", "name": name})
+        yield
+
+
+def media_key(kind, video_id, *variant):
+    """Returns the media index key of a download, e.g. "audio:<id>:mp3:<album>:"."""
+    return ":".join(
+        [kind, video_id, *("" if part is None else str(part) for part in variant)]
+    )
+
+
+def playlist_key(playlist_url, playlist_info):
+    """Returns a file-name-safe key identifying a playlist, based on its ID."""
+    playlist_id = (
+        playlist_info.get("id") or hashlib.sha1(playlist_url.encode()).hexdigest()
+    )
+    return sanitize_filename(playlist_id)
+
+
+def open_playlist_manifest(kind, playlist_url, playlist_info):
+    """
+    Opens the manifest of a playlist job and records the playlist's entries in it.
+
+    Args:
+        kind (str): The kind of job, e.g. "audio" or "video", so several kinds of job can
+            run for one playlist.
+        playlist_url (str): The URL of the playlist.
+        playlist_info (dict): The flat yt-dlp info dictionary of the playlist.
+
+    Returns:
+        tuple: The manifest, which the caller must close, and the playlist's (entry ID,
+        URL) pairs in playlist order.
+    """
+    manifest = PlaylistManifest(
+        os.path.join(DOWNLOADS_DIR, ".jobs"),
+        f"{kind}-{playlist_key(playlist_url, playlist_info)}",
+    )
+    entries = [
+        (
+            entry.get("id") or hashlib.sha1(entry["url"].encode()).hexdigest(),
+            entry["url"],
+        )
+        for entry in playlist_info["entries"]
+    ]
+    try:
+        manifest.add_entries(entries)
+    except BaseException:
+        manifest.close()
+        raise
+    return manifest, entries
+
+
+def open_lazy_playlist(playlist_url):
+    """
+    Extracts a playlist without resolving its entries up front.
+
+    yt-dlp fetches the playlist's pages as the returned entries are iterated, so a
+    playlist or channel with thousands of entries is never held in memory at once.
+
+    Args:
+        playlist_url (str): The URL of the playlist.
+
+    Returns:
+        tuple: The playlist's info dictionary without its entries, and a generator of its
+        flat entries. Close the generator if it isn't read to the end.
+    """
+    ydl_opts = {
+        "extract_flat": True,
+        "allowed_extractors": ALLOWED_EXTRACTORS,
+        # The pages are fetched while the entries are read, outside with_retries
+        **host_limits.ydl_params(retries=RETRIES),
+    }
+    ydl = host_limits.limit(yt_dlp.YoutubeDL(ydl_opts))
+    try:
+        with timed("extract", url=playlist_url, flat=True):
+            playlist_info = ydl.extract_info(
+                playlist_url, download=False, process=False
+            )
+            # Follow redirects, e.g. from a watch URL with a list parameter to the playlist
+            while playlist_info.get("_type") in ("url", "url_transparent"):
+                playlist_info = ydl.extract_info(
+                    playlist_info["url"],
+                    download=False,
+                    process=False,
+                    ie_key=playlist_info.get("ie_key"),
+                )
+        entries = playlist_info.pop("entries", None)
+        if entries is None:
+            raise ValueError(f"{playlist_url} is not a playlist")
+    except BaseException:
+        ydl.close()
+        raise
+
+    def iter_entries():
+        # The downloader fetches the pages, so it is closed once the entries are read or
+        # the iterator is closed
+        try:
+            yield  # Started right away, so closing it early still closes the downloader
+            yield from entries
+        finally:
+            ydl.close()
+
+    entries_iterator = iter_entries()
+    next(entries_iterator)
+    return playlist_info, entries_iterator
+
+
+def iter_manifest_entries(manifest, entries):
+    """
+    Records a playlist's entries in its manifest a page at a time, as they are read.
+
+    Args:
+        manifest (manifest.PlaylistManifest): The job's manifest.
+        entries (iterator): The playlist's flat entries, see open_lazy_playlist.
+
+    Yields:
+        tuple: The track number, entry ID and URL of each entry, in playlist order.
+    """
+    track_number = 1
+    while True:
+        page = [
+            (
+                entry.get("id") or hashlib.sha1(entry["url"].encode()).hexdigest(),
+                entry["url"],
+            )
+            for entry in itertools.islice(entries, PLAYLIST_PAGE_SIZE)
+        ]
+        if not page:
+            return
+        manifest.add_entries(page, start=track_number)
+        for entry_id, url in page:
+            yield track_number, entry_id, url
+            track_number += 1
+
+
+def sanitize_filename(title):
+    """Removes characters that are unsafe in file names from a title."""
+    return "".join(c for c in title if c.isalnum() or c in (" ", ".", "_")).rstrip()
+
+
+def output_extension(info_dict, audio_format):
+    """
+    Determines the file extension a video's audio ends up with.
+
+    Args:
+        info_dict (dict): The yt-dlp info dictionary of the video, with its format selected.
+        audio_format (str): One of AUDIO_FORMATS.
+
+    Returns:
+        str: The extension, without a dot.
+
+    Raises:
+        ValueError: If the audio format is unknown, or the video's codec can't be kept in
+            the "native" format.
+    """
+    if audio_format not in AUDIO_FORMATS:
+        raise ValueError(f"Unknown audio format: {audio_format}")
+    if audio_format == "native":
+        return native_codec(info_dict)[1]
+    return AUDIO_CODEC
+
+
+def native_codec(info_dict):
+    """
+    Returns the postprocessor codec and extension that keep a video's audio codec.
+
+    Raises:
+        ValueError: If the codec is not in NATIVE_CODECS.
+    """
+    codec = (info_dict.get("acodec") or "").split(".")[0]  # e.g. "mp4a.40.2"
+    if codec not in NATIVE_CODECS:
+        raise ValueError(
+            f"The audio codec {info_dict.get('acodec')!r} can't be kept natively; "
+            "use the mp3 format"
+        )
+    return NATIVE_CODECS[codec]
+
+
+def cache_quality(audio_format):
+    """Returns the download cache quality key for audio in the given format."""
+    return AUDIO_QUALITY if audio_format == "mp3" else audio_format
+
+
+def progress_hooks(progress_hook=None):
+    """Returns yt-dlp's progress hooks for a download: the caller's and the bandwidth cap."""
+    hooks = [host_limits.progress_hook()]
+    if progress_hook:
+        hooks.append(progress_hook)
+    return hooks
+
+
+def stream_url(info_dict):
+    """Returns the URL of one of an extracted video's streams, or None if it has none."""
+    streams = info_dict.get("requested_formats") or info_dict.get("formats")
+    return (streams[-1] if streams else info_dict).get("url")
+
+
+def download_extracted(ydl, info_dict, url=None):
+    """
+    Downloads an extracted video, retrying transient failures like 429s with backoff.
+
+    Each attempt waits for the request rate limit of the host serving the video's streams,
+    which is usually not the host of the video's page.
+
+    Args:
+        ydl (yt_dlp.YoutubeDL): The downloader to use.
+        info_dict (dict): The video's extracted information.
+        url (str, optional): The video's URL, for the rate limit if the information has no
+            stream URLs.
+
+    Returns:
+        dict: The processed info dictionary, see yt_dlp.YoutubeDL.process_ie_result.
+    """
+    # Every attempt starts from a fresh copy, since yt-dlp fills in the info it is given;
+    # partial downloads are resumed from their .part files
+    return with_retries(
+        lambda: ydl.process_ie_result(copy.deepcopy(info_dict), download=True),
+        url=stream_url(info_dict) or url,
+    )
+
+
+def fetch_audio(youtube_url, work_dir, progress_hook=None, audio_format="mp3"):
+    """
+    Downloads the best available audio stream of a YouTube video without converting it.
+
+    If the video's converted audio is in the download cache, the cached file is copied into
+    the work directory instead and nothing is downloaded.
+
+    Args:
+        youtube_url (str): The URL of the YouTube video to download audio from.
+        work_dir (str): The job's work directory, see create_work_directory.
+        progress_hook (callable, optional): Called with yt-dlp's progress dictionaries while
+            downloading. Defaults to None.
+        audio_format (str, optional): One of AUDIO_FORMATS. Defaults to "mp3".
+
+    Returns:
+        tuple: Contains the yt-dlp info dictionary and the path to the downloaded source file.
+    """
+    # Set options for yt-dlp; conversion happens separately in transcode_audio
+    ydl_opts = {
+        "format": "bestaudio/best",
+        "outtmpl": os.path.join(work_dir, "audio.%(ext)s"),
+        "allowed_extractors": ALLOWED_EXTRACTORS,
+        **host_limits.ydl_params(),
+        "progress_hooks": progress_hooks(progress_hook),
+    }
+
+    with host_limits.limit(yt_dlp.YoutubeDL(ydl_opts)) as ydl:
+        info_dict = info_cache.extract_info(ydl, youtube_url)
+
+        # Serve the converted audio from the cache if we have it
+        extension = output_extension(info_dict, audio_format)
+        quality = cache_quality(audio_format)
+        cached_file = os.path.join(work_dir, f"audio.{extension}")
+        if download_cache.get(info_dict["id"], extension, quality, cached_file):
+            return info_dict, cached_file
+
+        with timed("download", video_id=info_dict["id"]):
+            info_dict = download_extracted(ydl, info_dict, youtube_url)
+        source_file = ydl.prepare_filename(info_dict)
+    registry.inc(
+        "downloaddynamo_downloaded_bytes_total",
+        os.path.getsize(source_file),
+        kind="audio",
+    )
+
+    # A stream that is already in its output container needs no conversion, so cache it now
+    if source_file.endswith(f".{extension}"):
+        download_cache.put(info_dict["id"], extension, quality, source_file)
+
+    return info_dict, source_file
+
+
+def transcode_audio(info_dict, source_file, audio_format="mp3"):
+    """
+    Converts a downloaded audio stream using yt-dlp's FFmpegExtractAudio postprocessor.
+
+    In the "native" format the stream is copied into a container matching its codec (e.g.
+    Opus from WebM into .opus, AAC into .m4a) instead of being re-encoded.
+
+    Args:
+        info_dict (dict): The yt-dlp info dictionary of the downloaded video.
+        source_file (str): The path to the downloaded source file.
+        audio_format (str, optional): One of AUDIO_FORMATS. Defaults to "mp3".
+
+    Returns:
+        str: The path to the converted file. The source file is removed.
+    """
+    from yt_dlp.postprocessor import FFmpegExtractAudioPP
+
+    ydl_opts = {
+        "quiet": True,
+        "allowed_extractors": ALLOWED_EXTRACTORS,
+        **ffmpeg_scheduler.ydl_params(),
+    }
+    with host_limits.limit(yt_dlp.YoutubeDL(ydl_opts)) as ydl:
+        if audio_format == "native":
+            # The source's own codec makes ffmpeg copy the stream instead of re-encoding
+            codec, _ = native_codec(info_dict)
+            postprocessor = FFmpegExtractAudioPP(ydl, preferredcodec=codec)
+        else:
+            postprocessor = FFmpegExtractAudioPP(
+                ydl, preferredcodec=AUDIO_CODEC, preferredquality=AUDIO_QUALITY
+            )
+        # Wait for a free ffmpeg slot, so parallel jobs don't oversubscribe the CPU
+        with ffmpeg_scheduler.slot("transcode", video_id=info_dict["id"]):
+            info_dict = ydl.run_pp(postprocessor, dict(info_dict, filepath=source_file))
+
+    return info_dict["filepath"]
+
+
+def download_audio_and_metadata(
+    youtube_url, track_number=None, album=None, progress_hook=None, audio_format="mp3"
+):
     """
     Downloads audio from a YouTube video and applies metadata including title, artist,
     album, and thumbnail as album art.
@@ -26,99 +622,192 @@ def download_audio_and_metadata(youtube_url, track_number=None, album=None):
         youtube_url (str): The URL of the YouTube video to download audio from.
         track_number (int, optional): The track number for playlist downloads. Defaults to None.
         album (str, optional): The album name to apply to the audio metadata.
+        progress_hook (callable, optional): Called with yt-dlp's progress dictionaries while
+            downloading. Defaults to None.
+        audio_format (str, optional): One of AUDIO_FORMATS. Defaults to "mp3".
 
     Returns:
         tuple: Contains the path to the downloaded audio file, thumbnail image (if available),
         the title, artist, album, album artist, release year, and genre (empty string by default).
     """
-    # Ensure downloads directory exists
-    ensure_downloads_directory()
+    # Serve a download that was finished before and is still intact. The video ID is
+    # read from the URL, so this makes no request at all.
+    video_id = video_id_of(youtube_url)
+    if video_id:
+        stored = find_stored_audio(
+            media_key("audio", video_id, audio_format, album, track_number)
+        )
+        if stored:
+            return stored
 
-    # Set options for yt-dlp
-    ydl_opts = {
-        "format": "bestaudio/best",
-        "outtmpl": os.path.join(DOWNLOADS_DIR, "audio.%(ext)s"),
-        "postprocessors": [
-            {
-                "key": "FFmpegExtractAudio",
-                "preferredcodec": "mp3",
-                "preferredquality": "192",
-            }
-        ],
-    }
+    work_dir = create_work_directory()
+    try:
+        info_dict, source_file = fetch_audio(
+            youtube_url, work_dir, progress_hook, audio_format
+        )
+        key = media_key("audio", info_dict["id"], audio_format, album, track_number)
+        stored = None if video_id else find_stored_audio(key)
+        if stored:
+            return stored  # The URL didn't tell the video ID, but the extraction did
+        return finish_audio(
+            youtube_url,
+            info_dict,
+            source_file,
+            track_number,
+            album,
+            audio_format=audio_format,
+            index_key=key,
+        )
+    finally:
+        remove_work_directory(work_dir)
 
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info_dict = ydl.extract_info(youtube_url, download=True)
-        audio_file = ydl.prepare_filename(info_dict).replace(".webm", ".mp3")
 
-        # Extract metadata from YouTube video
-        title = info_dict.get("title", "Unknown Title")
-        artist = info_dict.get("uploader", "Unknown Artist")
-        if "music.youtube.com" in youtube_url:
-            artist = artist.replace(" - Topic", "")  # Remove ' - Topic' from artist
-
-        # Use playlist title as album if provided, otherwise default to video title
-        album = album if album else title
-        album_artist = artist  # Default album artist to the uploader/artist
-
-        # Rename the audio file to the title of the song
-        safe_title = "".join(
-            c for c in title if c.isalnum() or c in (" ", ".", "_")
-        ).rstrip()  # Sanitize title
-        new_audio_title = os.path.join(DOWNLOADS_DIR, f"{safe_title}.mp3")
-        if os.path.exists(new_audio_title):  # Overwrite if file exists
-            os.remove(new_audio_title)
-        os.rename(audio_file, new_audio_title)  # Rename the file
-        audio_file = new_audio_title
-
-        # Extract release year from 'upload_date' if available (format is YYYYMMDD)
-        upload_date = info_dict.get("upload_date", None)
-        release_year = upload_date[:4] if upload_date else "Unknown Year"
-
-        # Extract thumbnail URL
-        thumbnail_url = info_dict.get("thumbnail", None)
-
-        # Save thumbnail to thumbnail.jpg
-        thumbnail_file = os.path.join(
-            DOWNLOADS_DIR, "thumbnail.jpg"
-        )  # Always use this filename
-
-        if thumbnail_url:
-            response = requests.get(thumbnail_url)
-            if response.status_code == 200:
-                img = Image.open(BytesIO(response.content))
-                if "music.youtube.com" in youtube_url:
-                    img = crop_image_to_square(img)  # Crop to square
-                img.save(thumbnail_file)  # Save the image
-            else:
-                thumbnail_file = None  # In case of an unsuccessful response
-        else:
-            thumbnail_file = None  # No thumbnail URL available
+def video_id_of(url):
+    """Returns the ID of the YouTube video a URL points to, or None if the URL doesn't tell."""
+    from yt_dlp.extractor.youtube import YoutubeIE
 
-        # Automatically add metadata
-        add_metadata(
-            audio_file,
-            title,
-            artist,
-            album,
-            album_artist,
-            release_year,
-            "",
-            thumbnail_file,
-            track_number,
+    return YoutubeIE.get_temp_id(url)
+
+
+def find_stored_audio(key):
+    """
+    Looks up audio that finish_audio stored under a media index key.
+
+    Returns:
+        tuple: The same values as download_audio_and_metadata, with the caller's own copies
+        of the files, or None if the audio or its thumbnail is not stored.
+    """
+    index = media_index(DOWNLOADS_DIR)
+    stored = index.find(key)
+    if stored is None:
+        return None
+    thumbnail_file = None
+    if stored["thumbnail"]:
+        thumbnail = index.find(key + ":thumbnail")
+        if thumbnail is None:
+            os.remove(stored["path"])  # Make the audio and its thumbnail again
+            return None
+        thumbnail_file = thumbnail["path"]
+    return (stored["path"], thumbnail_file, *stored["fields"])
+
+
+def finish_audio(
+    youtube_url,
+    info_dict,
+    source_file,
+    track_number=None,
+    album=None,
+    save_thumbnail=True,
+    audio_format="mp3",
+    index_key=None,
+):
+    """
+    Converts a downloaded audio stream to its output format, applies metadata including the
+    thumbnail as album art, and moves the finished files into the downloads directory.
+
+    The thumbnail is turned into album art in memory and embedded directly; it is only
+    written to disk if save_thumbnail is set, for the interface to preview.
+
+    Args:
+        youtube_url (str): The URL of the YouTube video the audio was downloaded from.
+        info_dict (dict): The yt-dlp info dictionary returned by fetch_audio.
+        source_file (str): The path to the downloaded source file in the job's work directory.
+        track_number (int, optional): The track number for playlist downloads. Defaults to None.
+        album (str, optional): The album name to apply to the audio metadata.
+        save_thumbnail (bool, optional): Save the album art next to the audio file.
+            Defaults to True.
+        audio_format (str, optional): One of AUDIO_FORMATS. Defaults to "mp3".
+        index_key (str, optional): Store the finished files through the media index under
+            this key, see move_to_downloads. Playlist tracks, which are removed once they
+            are zipped, are not indexed. Defaults to None.
+
+    Returns:
+        tuple: The same values as download_audio_and_metadata. The thumbnail path is None
+        if save_thumbnail is not set.
+    """
+    if source_file.endswith(f".{output_extension(info_dict, audio_format)}"):
+        # Already in its output format, e.g. served from the download cache
+        audio_file = source_file
+    else:
+        with timed("transcode", video_id=info_dict["id"], audio_format=audio_format):
+            audio_file = transcode_audio(info_dict, source_file, audio_format)
+        # Cache the converted file before it is tagged for this particular request
+        extension = os.path.splitext(audio_file)[1][1:]
+        download_cache.put(
+            info_dict["id"], extension, cache_quality(audio_format), audio_file
         )
 
-        # Return audio file path, thumbnail file path, and extracted metadata
-        return (
-            audio_file,
+    # Extract metadata from YouTube video
+    title = info_dict.get("title", "Unknown Title")
+    artist = info_dict.get("uploader", "Unknown Artist")
+    if "music.youtube.com" in youtube_url:
+        artist = artist.replace(" - Topic", "")  # Remove ' - Topic' from artist
+
+    # Use playlist title as album if provided, otherwise default to video title
+    album = album if album else title
+    album_artist = artist  # Default album artist to the uploader/artist
+
+    # Intermediate files stay in the work directory; finished files are named after the song
+    work_dir = os.path.dirname(audio_file)
+    safe_title = sanitize_filename(title)
+
+    # Extract release year from 'upload_date' if available (format is YYYYMMDD)
+    upload_date = info_dict.get("upload_date", None)
+    release_year = upload_date[:4] if upload_date else "Unknown Year"
+
+    # Extract thumbnail URL
+    thumbnail_url = info_dict.get("thumbnail", None)
+
+    # Turn the thumbnail into album art; YouTube Music covers are cropped to a square
+    thumbnail_data = None
+    if thumbnail_url:
+        with timed("thumbnail", video_id=info_dict["id"]):
+            thumbnail_data = fetch_thumbnail(thumbnail_url)
+    cover_art = None
+    if thumbnail_data:
+        with timed("cover_art", video_id=info_dict["id"]):
+            cover_art = prepare_cover_art(
+                thumbnail_data, square="music.youtube.com" in youtube_url
+            )
+
+    # Save the album art next to the audio in the work directory for previewing
+    thumbnail_file = None
+    if cover_art and save_thumbnail:
+        thumbnail_file = os.path.join(work_dir, "thumbnail.jpg")
+        with open(thumbnail_file, "wb") as img_file:
+            img_file.write(cover_art)
+
+    # Automatically add metadata
+    add_metadata(
+        audio_file,
+        title,
+        artist,
+        album,
+        album_artist,
+        release_year,
+        "",
+        None,
+        track_number,
+        cover_art=cover_art,
+    )
+
+    # Move the finished files into the downloads directory, named after the song
+    fields = [title, artist, album, album_artist, release_year, ""]
+    if thumbnail_file:
+        thumbnail_file = move_to_downloads(
             thumbnail_file,
-            title,
-            artist,
-            album,
-            album_artist,
-            release_year,
-            "",
+            f"{safe_title}.jpg",
+            index_key and index_key + ":thumbnail",
         )
+    audio_file = move_to_downloads(
+        audio_file,
+        safe_title + os.path.splitext(audio_file)[1],
+        index_key,
+        {"thumbnail": thumbnail_file is not None, "fields": fields},
+    )
+
+    # Return audio file path, thumbnail file path, and extracted metadata
+    return (audio_file, thumbnail_file, *fields)
 
 
 def crop_image_to_square(image):
@@ -143,6 +832,38 @@ def crop_image_to_square(image):
     return image.crop((left, top, right, bottom))
 
 
+def prepare_cover_art(
+    image_data,
+    square=False,
+    max_size=COVER_ART_MAX_SIZE,
+    quality=COVER_ART_QUALITY,
+):
+    """
+    Turns an image of any format into JPEG album art, entirely in memory.
+
+    Args:
+        image_data (bytes): The encoded source image, e.g. a WebP or JPEG thumbnail.
+        square (bool, optional): Crop the image to a square first. Defaults to False.
+        max_size (int, optional): The maximum width and height of the album art.
+        quality (int, optional): The JPEG quality, from 1 to 95.
+
+    Returns:
+        bytes: The JPEG encoded album art.
+    """
+    img = Image.open(BytesIO(image_data))
+    if square:
+        img = crop_image_to_square(img)  # Crop to square
+    img.thumbnail((max_size, max_size), Image.LANCZOS)  # Shrink, keeping proportions
+
+    # JPEG has no transparency, so flatten images that have any
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+
+    output = BytesIO()
+    img.save(output, format="JPEG", quality=quality, optimize=True)
+    return output.getvalue()
+
+
 def add_metadata(
     audio_file,
     title,
@@ -152,11 +873,17 @@ def add_metadata(
     release_year,
     genre,
     thumbnail_file,
-    track_number,
+    track_number=None,
+    cover_art=None,
 ):
     """
     Adds metadata to an audio file, such as title, artist, album, and optionally attaches a thumbnail as album art.
 
+    The complete tag, including the album art, is built in memory and written with a single
+    save. Padding is reserved after the tag, so later edits (e.g. from the "Apply Metadata"
+    button) overwrite the tag in place instead of rewriting the whole audio stream. MP3, M4A,
+    Opus, Ogg Vorbis and FLAC files are supported, see tagging.write_tags.
+
     Args:
         audio_file (str): The path to the audio file to which metadata will be added.
         title (str): The title of the audio track.
@@ -167,185 +894,889 @@ def add_metadata(
         genre (str): The genre of the audio track (optional).
         thumbnail_file (str): The path to the thumbnail image (if available).
         track_number (int, optional): The track number for playlist downloads. Defaults to None.
+        cover_art (bytes, optional): JPEG album art to attach instead of thumbnail_file,
+            see prepare_cover_art. Defaults to None.
 
     Returns:
         str: The path to the audio file with metadata added.
     """
-    # Add metadata using mutagen
-    audio = EasyID3(audio_file)
-    audio["title"] = title
-    audio["artist"] = artist
-    audio["album"] = album
-    audio["albumartist"] = album_artist
-    audio["date"] = release_year
-    if genre:
-        audio["genre"] = genre
+    # Read the thumbnail if no album art was passed in
+    if cover_art is None and thumbnail_file and os.path.exists(thumbnail_file):
+        with open(thumbnail_file, "rb") as img_file:
+            cover_art = img_file.read()
+        if not cover_art.startswith(b"\xff\xd8"):  # Not a JPEG, e.g. a PNG upload
+            cover_art = prepare_cover_art(cover_art)
+
+    # Write everything in the tag format of the file's container
+    with timed("tag", file=os.path.basename(audio_file)):
+        write_tags(
+            audio_file,
+            {
+                "title": title,
+                "artist": artist,
+                "album": album,
+                "album_artist": album_artist,
+                "release_year": release_year,
+                "genre": genre or None,  # Keep an existing genre if none is given
+                "track_number": track_number,
+            },
+            cover_art,
+        )
 
-    # Add track number if provided
-    if track_number is not None:
-        audio["tracknumber"] = str(track_number)
+    return audio_file  # Return the updated file with metadata and thumbnail
 
-    audio.save()
 
-    # Attach thumbnail as album art using ID3
-    if thumbnail_file and os.path.exists(thumbnail_file):
-        with open(thumbnail_file, "rb") as img_file:
-            audio_tags = ID3(audio_file)
-            audio_tags["APIC"] = APIC(
-                encoding=3,  # UTF-8
-                mime="image/jpeg",  # Image MIME type
-                type=3,  # Front cover
-                desc="Cover",
-                data=img_file.read(),
-            )
-            audio_tags.save()
+def retag_folder(
+    folder, title, artist, album, album_artist, release_year, genre, track_number
+):
+    """
+    Applies the same tags to every audio file in a folder, e.g. a synced playlist.
 
-    return audio_file  # Return the updated file with metadata and thumbnail
+    Files are taken in track order for a playlist library folder, and by name otherwise.
+    Empty fields are left as they are; fields can be templates, see tagging.apply_tags.
+    The retagged tracks of a library folder are also replaced in the playlist's zip.
 
+    Args:
+        folder (str): The folder holding the audio files. It must be in the downloads
+            directory, and not in one of its hidden working directories.
+        title, artist, album, album_artist, release_year, genre, track_number (str): The
+            tags to set.
+
+    Returns:
+        list: A [file name, status, tags or error] row per file.
 
-def process_playlist(playlist_url):
+    Raises:
+        ValueError: If the folder doesn't exist or is outside the downloads directory.
+    """
+    # The tags are written by the server, so only its own downloads may be edited
+    downloads_dir = os.path.realpath(DOWNLOADS_DIR)
+    resolved = os.path.realpath(folder)
+    if os.path.commonpath([resolved, downloads_dir]) != downloads_dir or any(
+        part.startswith(".")
+        for part in os.path.relpath(resolved, downloads_dir).split(os.sep)
+        if part != os.curdir
+    ):
+        raise ValueError(f"{folder} is not a folder in {DOWNLOADS_DIR}")
+    if not os.path.isdir(folder):
+        raise ValueError(f"{folder} is not a folder")
+    library_zips = []
+    if os.path.exists(os.path.join(folder, INDEX_FILENAME)):
+        audio_files = PlaylistLibrary(folder).ordered_paths()
+        library_zips = [
+            os.path.join(folder, name)
+            for name in os.listdir(folder)
+            if name.endswith(".zip")
+        ]
+    else:
+        audio_files = sorted(
+            os.path.join(folder, name)
+            for name in os.listdir(folder)
+            if os.path.splitext(name)[1].lower() in TAG_WRITERS
+        )
+
+    fields = {
+        "title": title,
+        "artist": artist,
+        "album": album,
+        "album_artist": album_artist,
+        "release_year": release_year,
+        "genre": genre,
+        "track_number": track_number,
+    }
+    with timed("bulk_tag", files=len(audio_files)):
+        results = apply_tags(
+            audio_files, {name: value or None for name, value in fields.items()}
+        )
+
+    # Replace the retagged tracks in the playlist's zip, so it doesn't keep the old tags
+    retagged = [result["file"] for result in results if result["status"] == "ok"]
+    for zip_path in library_zips:
+        with timed("zip", added=len(retagged), removed=len(retagged)):
+            update_zip(
+                zip_path, retagged, [os.path.basename(path) for path in retagged]
+            )
+
+    return [
+        [
+            os.path.basename(result["file"]),
+            result["status"],
+            result.get("error")
+            or ", ".join(f"{k}={v}" for k, v in result["tags"].items()),
+        ]
+        for result in results
+    ]
+
+
+def process_playlist(
+    playlist_url,
+    download_workers=DOWNLOAD_WORKERS,
+    postprocess_workers=POSTPROCESS_WORKERS,
+    archive=None,
+    keep_files=False,
+    progress_hook=None,
+    audio_format="mp3",
+    window=PLAYLIST_WINDOW,
+):
     """
     Processes a YouTube playlist by downloading the audio for each video, applying metadata,
     and zipping all the audio files.
 
+    Downloads run on a pool of download_workers threads. As soon as a download finishes,
+    its conversion and tagging is handed to a separate pool of postprocess_workers, so the
+    network and ffmpeg stages overlap. Each track is appended to the zip as soon as it and
+    the tracks before it are finished, so the zip keeps the playlist's track order and can
+    be streamed while the playlist is still running.
+
+    The playlist's entries are read page by page while the job runs, and at most window
+    tracks are in flight at a time. Each track's file is removed as soon as it is zipped,
+    so memory and disk use stay flat however long the playlist is.
+
+    Progress is checkpointed in a manifest in the downloads directory. If the job is
+    interrupted, running it again skips the tracks that were finished and not yet zipped,
+    resumes partial downloads and builds a fresh zip; an incomplete zip is deleted. Tracks
+    that were already zipped are no longer in the manifest, so they are downloaded again
+    unless the download cache still holds them.
+
+    Requests are rate limited per host and transient failures like 429s are retried with
+    backoff (see ratelimit). A track that still fails is left out of the zip and reported
+    with a "track_failed" progress event, and the rest of the playlist carries on; only if
+    every track fails is the error raised.
+
     Args:
         playlist_url (str): The URL of the YouTube playlist to process.
+        download_workers (int, optional): The number of concurrent downloads.
+        postprocess_workers (int, optional): The number of concurrent conversions.
+        archive (archive.StreamingZip, optional): The archive to append tracks to, e.g. one
+            that is being streamed to a client. It is closed when the playlist is done.
+            Defaults to a new playlist.zip in the downloads directory.
+        keep_files (bool, optional): Keep the audio files next to the zip. Otherwise they
+            are removed once the zip is complete. Defaults to False.
+        progress_hook (callable, optional): Called with yt-dlp's progress dictionaries while
+            downloading, with {"status": "track_done", "track_number", "tracks",
+            "filename"} whenever a track is added to the zip, and with {"status":
+            "track_failed", "track_number", "tracks", "error"} whenever a track is left
+            out. "tracks" is the playlist's length, or the number of entries read so
+            far if the playlist doesn't tell. Defaults to None.
+        audio_format (str, optional): One of AUDIO_FORMATS. Defaults to "mp3".
+        window (int, optional): The maximum number of tracks in flight. Defaults to
+            PLAYLIST_WINDOW.
 
     Returns:
         str: The path to the zip file containing the downloaded audio files.
     """
-    # Extract video URLs from the playlist
-    ydl_opts = {"extract_flat": True}
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        playlist_info = ydl.extract_info(playlist_url, download=False)
-        video_urls = [entry["url"] for entry in playlist_info["entries"]]
-
-        playlist_title = playlist_info.get("title", "Unknown Playlist")
-    # Store audio files for zipping
-    audio_files = []
-
-    # Download each video and modify metadata
-    for track_number, video_url in enumerate(video_urls, start=1):
-        audio_file, thumbnail_file, _, _, _, _, _, _ = download_audio_and_metadata(
-            video_url, track_number, playlist_title
+    # Page through the playlist's entries instead of extracting them all up front
+    playlist_info, entries = open_lazy_playlist(playlist_url)
+    playlist_title = playlist_info.get("title", "Unknown Playlist")
+    # Not known for every playlist; until the entries are read to the end, progress events
+    # then count the entries read so far
+    track_count = playlist_info.get("playlist_count")
+
+    # The manifest remembers finished tracks, so a restarted job picks up where it stopped
+    with contextlib.closing(entries), PlaylistManifest(
+        os.path.join(DOWNLOADS_DIR, ".jobs"),
+        f"audio-{playlist_key(playlist_url, playlist_info)}",
+    ) as manifest:
+
+        def download_track(track_number, entry_id, video_url):
+            # A stable work directory per track lets yt-dlp resume a partial download
+            work_dir = manifest.work_directory(entry_id)
+            try:
+                info_dict, source_file = fetch_audio(
+                    video_url, work_dir, progress_hook, audio_format
+                )
+            except Exception as error:
+                manifest.mark_failed(entry_id, error)
+                raise
+            return postprocess_pool.submit(
+                finish_track, track_number, entry_id, video_url, info_dict, source_file
+            )
+
+        def finish_track(track_number, entry_id, video_url, info_dict, source_file):
+            try:
+                audio_file = finish_audio(
+                    video_url,
+                    info_dict,
+                    source_file,
+                    track_number,
+                    playlist_title,
+                    # Only the album art embedded in the file is needed
+                    save_thumbnail=False,
+                    audio_format=audio_format,
+                )[0]
+            except Exception as error:
+                manifest.mark_failed(entry_id, error)
+                raise
+            manifest.mark_done(entry_id, audio_file)
+            return audio_file
+
+        own_archive = archive is None
+        if own_archive:
+            archive = StreamingZip(unique_output_path("playlist.zip"))
+
+        # Track numbers and errors of the tracks that failed and were left out of the zip
+        failures = []
+
+        def zip_track(track_number, entry_id, download):
+            if isinstance(download, str):
+                audio_file = download
+            else:
+                try:
+                    audio_file = download.result().result()
+                except Exception as error:
+                    if is_cancellation(error):
+                        raise
+                    # Leave the track out and carry on; the manifest keeps it for a rerun
+                    failures.append((track_number, error))
+                    report_track_failure(
+                        progress_hook, track_number, track_count or entries_read, error
+                    )
+                    return
+            # The file is removed once it is zipped rather than kept on disk until the end;
+            # an interrupted job gets it back from the download cache, if it's still there
+            with timed("zip", file=os.path.basename(audio_file)):
+                archive.add(audio_file, remove=not keep_files)
+            if keep_files and isinstance(download, str):
+                # Claimed from an earlier run, so it is in the job's work directory
+                move_to_downloads(audio_file, os.path.basename(audio_file))
+            elif not keep_files:
+                manifest.forget(entry_id)  # Nothing is left of it to resume
+            if progress_hook:
+                progress_hook(
+                    {
+                        "status": "track_done",
+                        "track_number": track_number,
+                        "tracks": track_count or entries_read,
+                        "filename": os.path.basename(audio_file),
+                    }
+                )
+
+        # Tracks that were started but are not zipped yet, in track order
+        in_flight = collections.deque()
+        entries_read = 0
+        # Clients can download the zip while tracks are still being added
+        with stream_archive(archive, progress_hook):
+            try:
+                with ThreadPoolExecutor(
+                    max_workers=max(1, postprocess_workers)
+                ) as postprocess_pool, ThreadPoolExecutor(
+                    max_workers=max(1, download_workers)
+                ) as download_pool:
+                    try:
+                        for track_number, entry_id, url in iter_manifest_entries(
+                            manifest, entries
+                        ):
+                            entries_read = track_number
+                            # Zip the oldest track before starting another once the window
+                            # is full
+                            if len(in_flight) >= max(1, window):
+                                zip_track(*in_flight.popleft())
+                            # Tracks finished by an earlier run are taken from the manifest
+                            download = manifest.finished_output(
+                                entry_id
+                            ) or download_pool.submit(
+                                download_track, track_number, entry_id, url
+                            )
+                            in_flight.append((track_number, entry_id, download))
+                        while in_flight:
+                            zip_track(*in_flight.popleft())
+                        if failures and not archive.count:
+                            # Nothing worked, e.g. the network is down
+                            raise failures[0][1]
+                    except BaseException:
+                        # Don't start the remaining tracks if the job is cancelled
+                        for _, _, download in in_flight:
+                            if not isinstance(download, str):
+                                download.cancel()
+                        raise
+            except BaseException:
+                if own_archive:
+                    archive.discard()  # An incomplete zip is of no use
+                else:
+                    archive.close()
+                raise
+            archive.close()
+
+        if failures:
+            # Keep the manifest, so running the job again retries the failed tracks
+            print_failures(failures)
+        else:
+            manifest.remove()  # Zipped files are already removed
+
+        print(f"Zipped {archive.count} audio files into {archive.path}")
+
+        return archive.path
+
+
+def sync_playlist(
+    playlist_url,
+    prune=False,
+    download_workers=DOWNLOAD_WORKERS,
+    progress_hook=None,
+    audio_format="mp3",
+):
+    """
+    Brings the local library copy of a playlist up to date and returns its zip.
+
+    The playlist's flat entry list is compared with the library index, so only entries
+    added since the last sync are downloaded. Tracks whose position changed get their
+    track number retagged in place, and the zip is updated in place, so a recurring sync
+    costs time proportional to the change rather than to the playlist. A track that fails
+    is left out and reported with a "track_failed" progress event; the next sync retries it.
+
+    Args:
+        playlist_url (str): The URL of the YouTube playlist to sync.
+        prune (bool, optional): Delete tracks that were removed from the playlist.
+            Defaults to False.
+        download_workers (int, optional): The number of concurrent downloads.
+        progress_hook (callable, optional): Called with yt-dlp's progress dictionaries while
+            downloading, and with a "track_done" or "track_failed" dictionary (see
+            process_playlist) whenever a new track is added to the library or left out.
+            Defaults to None.
+        audio_format (str, optional): One of AUDIO_FORMATS, used for new tracks.
+            Defaults to "mp3".
+
+    Returns:
+        str: The path to the zip file of the library.
+    """
+    # Extract the playlist's current entries without extracting every video
+    ydl_opts = {
+        "extract_flat": True,
+        "allowed_extractors": ALLOWED_EXTRACTORS,
+        **host_limits.ydl_params(),
+    }
+    with host_limits.limit(yt_dlp.YoutubeDL(ydl_opts)) as ydl:
+        playlist_info = info_cache.extract_info(ydl, playlist_url)
+    playlist_title = playlist_info.get("title", "Unknown Playlist")
+
+    # The manifest lets an interrupted sync resume; the library holds the finished tracks
+    manifest, entries = open_playlist_manifest("sync", playlist_url, playlist_info)
+    with manifest:
+        library = PlaylistLibrary(
+            os.path.join(
+                DOWNLOADS_DIR, "library", playlist_key(playlist_url, playlist_info)
+            )
+        )
+        track_numbers = {
+            entry_id: track_number
+            for track_number, (entry_id, _) in enumerate(entries, start=1)
+        }
+        added, removed = library.diff([entry_id for entry_id, _ in entries])
+        zip_path = os.path.join(
+            library.directory, f"{sanitize_filename(playlist_title)}.zip"
         )
-        audio_files.append(audio_file)
-        if thumbnail_file and os.path.exists(thumbnail_file):
-            os.remove(thumbnail_file)  # Remove thumbnail after processing to clean up
 
-    # Zip the audio files
-    zip_filename = os.path.join(DOWNLOADS_DIR, "playlist.zip")
-    with zipfile.ZipFile(zip_filename, "w") as zipf:
-        for audio_file in audio_files:
-            zipf.write(
-                audio_file, os.path.basename(audio_file)
-            )  # Add the file to the zip
+        def sync_track(entry_id, video_url):
+            audio_file = manifest.finished_output(entry_id)
+            if audio_file is None:
+                work_dir = manifest.work_directory(entry_id)
+                try:
+                    info_dict, source_file = fetch_audio(
+                        video_url, work_dir, progress_hook, audio_format
+                    )
+                    audio_file = finish_audio(
+                        video_url,
+                        info_dict,
+                        source_file,
+                        track_numbers[entry_id],
+                        playlist_title,
+                        save_thumbnail=False,
+                        audio_format=audio_format,
+                    )[0]
+                except Exception as error:
+                    manifest.mark_failed(entry_id, error)
+                    raise
+                manifest.mark_done(entry_id, audio_file)
+            return audio_file
+
+        # Download only the entries the library doesn't have yet
+        urls = dict(entries)
+        new_files = []
+        failures = []
+        with ThreadPoolExecutor(max_workers=max(1, download_workers)) as pool:
+            futures = [
+                (entry_id, pool.submit(sync_track, entry_id, urls[entry_id]))
+                for entry_id in added
+            ]
+            try:
+                for entry_id, future in futures:
+                    track_number = track_numbers[entry_id]
+                    try:
+                        audio_file = future.result()
+                    except Exception as error:
+                        if is_cancellation(error):
+                            raise
+                        # Leave the track out of the library; the next sync retries it
+                        failures.append((track_number, error))
+                        report_track_failure(
+                            progress_hook, track_number, len(entries), error
+                        )
+                        continue
+                    new_files.append(library.add(entry_id, audio_file, track_number))
+                    if progress_hook:
+                        progress_hook(
+                            {
+                                "status": "track_done",
+                                "track_number": track_number,
+                                "tracks": len(entries),
+                                "filename": os.path.basename(new_files[-1]),
+                            }
+                        )
+                if failures and len(failures) == len(futures):
+                    raise failures[0][1]  # Nothing worked, e.g. the network is down
+            except BaseException:
+                for _, future in futures:
+                    future.cancel()
+                raise
+            finally:
+                library.save()  # Keep the tracks that did finish
+
+        # Tracks that moved within the playlist only need their track number rewritten, and
+        # their copy in the zip replaced
+        removed_names = []
+        for entry_id, track in library.tracks.items():
+            if (
+                entry_id in track_numbers
+                and track["track_number"] != track_numbers[entry_id]
+            ):
+                track["track_number"] = track_numbers[entry_id]
+                set_track_number(library.path(entry_id), track["track_number"])
+                removed_names.append(track["filename"])
+                new_files.append(library.path(entry_id))
+
+        if prune:
+            for entry_id in removed:
+                removed_names.append(library.tracks[entry_id]["filename"])
+                library.remove(entry_id)
+        library.save()
+
+        # Compare the library with the zip itself: a sync that failed or was interrupted
+        # after saving the library may have left tracks out of the zip, or removed ones in it
+        members = zip_members(zip_path)
+        if members is None:
+            # First sync, or the zip was deleted or damaged
+            if os.path.exists(zip_path):
+                os.remove(zip_path)
+            new_files, removed_names = library.ordered_paths(), []
+        else:
+            filenames = {track["filename"] for track in library.tracks.values()}
+            removed_names += [name for name in members if name not in filenames]
+            new_files += [
+                path
+                for path in library.ordered_paths()
+                if os.path.basename(path) not in members and path not in new_files
+            ]
+        with timed("zip", added=len(new_files), removed=len(removed_names)):
+            update_zip(zip_path, new_files, removed_names)
+        if failures:
+            # Keep the manifest, so the next sync resumes the failed tracks
+            print_failures(failures)
+        else:
+            manifest.remove()
+
+        print(
+            f"Synced {playlist_title}: {len(added)} added, "
+            f"{len(removed) if prune else 0} removed, {len(library.tracks)} tracks"
+        )
 
-    print(f"Zipped {len(audio_files)} audio files into {zip_filename}")
+        return zip_path
 
-    return zip_filename
 
+def is_cancellation(error):
+    """Returns whether an error means the job was cancelled, which stops a whole playlist."""
+    from yt_dlp.utils import DownloadCancelled
 
-def download_video(youtube_url):
+    return isinstance(error, DownloadCancelled)
+
+
+def report_track_failure(progress_hook, track_number, tracks, error):
+    """Counts a track that was left out of a playlist and reports it as "track_failed"."""
+    registry.inc("downloaddynamo_playlist_failures_total")
+    if progress_hook:
+        progress_hook(
+            {
+                "status": "track_failed",
+                "track_number": track_number,
+                "tracks": tracks,
+                "error": str(error),
+            }
+        )
+
+
+def print_failures(failures):
+    """Prints the (track number, error) pairs of the tracks a playlist job left out."""
+    print(
+        f"Skipped {len(failures)} tracks that failed: "
+        + ", ".join(f"{number} ({error})" for number, error in failures)
+    )
+
+
+def finish_playlist_job(manifest, output_files, keep_files):
+    """Forgets a completed playlist job and removes its files once they are zipped."""
+    manifest.remove()
+    if not keep_files:
+        for output_file in output_files:
+            os.remove(output_file)
+
+
+def download_stream(ydl, stream_info, path, progress_hook=None):
+    """
+    Downloads one stream of a video, e.g. its video or its audio track.
+
+    A large plain HTTP stream is split into parallel ranged requests; anything else, or a
+    server that doesn't support ranges, is left to yt-dlp's own downloader.
+
+    Args:
+        ydl (yt_dlp.YoutubeDL): The downloader the stream's format was selected with.
+        stream_info (dict): One of the formats in the video's "requested_formats".
+        path (str): Where to write the stream.
+        progress_hook (callable, optional): Called with yt-dlp's progress dictionaries.
+    """
+    size = stream_info.get("filesize") or 0
+    if stream_info.get("protocol") in ("http", "https") and size >= PARALLEL_MIN_SIZE:
+        try:
+            with_retries(
+                download_ranges,
+                stream_info["url"],
+                path,
+                size,
+                stream_info.get("http_headers"),
+                progress_hook=progress_hook,
+            )
+            return
+        except RangesNotSupported:
+            pass
+    with_retries(ydl.dl, path, stream_info, url=stream_info["url"])
+
+
+def merge_streams(ydl, info_dict, stream_files, video_file):
+    """Merges separately downloaded video and audio streams into one file with ffmpeg."""
+    from yt_dlp.postprocessor import FFmpegMergerPP
+
+    info_dict = dict(
+        info_dict,
+        filepath=video_file,
+        __files_to_merge=stream_files,
+        requested_formats=[
+            dict(stream_info, filepath=stream_file)
+            for stream_info, stream_file in zip(
+                info_dict["requested_formats"], stream_files
+            )
+        ],
+    )
+    # Wait for a free ffmpeg slot, so parallel jobs don't oversubscribe the CPU
+    with ffmpeg_scheduler.slot("merge", video_id=info_dict.get("id")):
+        FFmpegMergerPP(ydl).run(info_dict)
+    for stream_file in stream_files:
+        os.remove(stream_file)
+
+
+def download_video_streams(ydl, info_dict, work_dir, progress_hook=None):
+    """
+    Downloads a video's video and audio streams at the same time, then merges them.
+
+    yt-dlp fetches the streams of a "bestvideo+bestaudio" format one after the other, so
+    they are downloaded here in parallel instead. A video that only has a single
+    combined stream is downloaded by yt-dlp as usual.
+
+    Args:
+        ydl (yt_dlp.YoutubeDL): The downloader, created with download_video's options.
+        info_dict (dict): The video's extracted information.
+        work_dir (str): The job's work directory.
+        progress_hook (callable, optional): Called with yt-dlp's progress dictionaries.
+            A fragments.StreamProgress is told about both streams up front, so it reports
+            one total for the video.
+
+    Returns:
+        str: The path to the merged mp4 file in the work directory.
+    """
+    selected = ydl.process_ie_result(copy.deepcopy(info_dict), download=False)
+    streams = selected.get("requested_formats")
+    if not streams:
+        info_dict = download_extracted(ydl, info_dict, info_dict.get("webpage_url"))
+        return (
+            ydl.prepare_filename(info_dict)
+            .replace(".mkv", ".mp4")
+            .replace(".webm", ".mp4")
+        )
+
+    stream_files = [
+        os.path.join(work_dir, f"video.f{stream['format_id']}.{stream['ext']}")
+        for stream in streams
+    ]
+    if isinstance(progress_hook, StreamProgress):
+        for stream, stream_file in zip(streams, stream_files):
+            total = stream.get("filesize") or stream.get("filesize_approx")
+            progress_hook.expect(stream_file, total)
+    with ThreadPoolExecutor(max_workers=len(streams)) as pool:
+        downloads = [
+            pool.submit(download_stream, ydl, stream, stream_file, progress_hook)
+            for stream, stream_file in zip(streams, stream_files)
+        ]
+        for download in downloads:
+            download.result()
+
+    video_file = os.path.join(work_dir, "video.mp4")
+    merge_streams(ydl, selected, stream_files, video_file)
+    return video_file
+
+
+def download_video(youtube_url, progress_hook=None, work_dir=None):
     """
     Downloads a video from YouTube in mp4 format.
 
+    Videos are stored in the download cache, so a video that was downloaded before is
+    served from local storage.
+
     Args:
         youtube_url (str): The URL of the YouTube video to download.
+        progress_hook (callable, optional): Called with yt-dlp's progress dictionaries while
+            downloading. Defaults to None.
+        work_dir (str, optional): A work directory owned by the caller, kept after the
+            download so a partial download can be resumed. Defaults to a new private one.
 
     Returns:
         str: The path to the downloaded mp4 video file.
     """
-    # Ensure downloads directory exists
-    ensure_downloads_directory()
+    # Download into a private work directory so concurrent jobs don't clobber each other
+    own_work_dir = work_dir is None
+    if own_work_dir:
+        work_dir = create_work_directory()
+
+    # The video and audio streams are reported as one download
+    progress = StreamProgress(progress_hook)
 
-    # Set options for yt-dlp to download video in mp4 format
+    # Set options for yt-dlp to download video in mp4 format; DASH and HLS streams are
+    # fetched FRAGMENT_WORKERS fragments at a time
     ydl_opts = {
         "format": "bestvideo+bestaudio",
-        "outtmpl": os.path.join(DOWNLOADS_DIR, "video.%(ext)s"),
+        "outtmpl": os.path.join(work_dir, "video.%(ext)s"),
         "merge_output_format": "mp4",
+        "concurrent_fragment_downloads": FRAGMENT_WORKERS,
+        "allowed_extractors": ALLOWED_EXTRACTORS,
+        **host_limits.ydl_params(),
+        "progress_hooks": progress_hooks(progress),
+        **ffmpeg_scheduler.ydl_params(),  # Limits the threads of the merge
     }
 
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info_dict = ydl.extract_info(youtube_url, download=True)
-        video_file = (
-            ydl.prepare_filename(info_dict)
-            .replace(".mkv", ".mp4")
-            .replace(".webm", ".mp4")
-        )
-
-        # Rename the video file to the title of the video
+    try:
+        # The fixups and merges yt-dlp runs itself also wait for an ffmpeg slot
+        with ffmpeg_scheduler.postprocessor_hook(
+            url=youtube_url
+        ) as postprocessor_hook, host_limits.limit(
+            yt_dlp.YoutubeDL(dict(ydl_opts, postprocessor_hooks=[postprocessor_hook]))
+        ) as ydl:
+            info_dict = info_cache.extract_info(ydl, youtube_url)
+
+            # Serve a single video that was finished before and is still intact
+            key = media_key("video", info_dict["id"], "mp4") if own_work_dir else None
+            stored = key and media_index(DOWNLOADS_DIR).find(key)
+            if stored:
+                return stored["path"]
+
+            # Serve the video from the cache if we have it
+            video_file = os.path.join(work_dir, "video.mp4")
+            if not download_cache.get(
+                info_dict["id"], "mp4", "best", video_file, link=True
+            ):
+                with timed("download", video_id=info_dict["id"], kind="video"):
+                    video_file = download_video_streams(
+                        ydl, info_dict, work_dir, progress
+                    )
+                registry.inc(
+                    "downloaddynamo_downloaded_bytes_total",
+                    os.path.getsize(video_file),
+                    kind="video",
+                )
+                download_cache.put(
+                    info_dict["id"], "mp4", "best", video_file, link=True
+                )
+
+        # Move the video file into the downloads directory, named after the video
         title = info_dict.get("title", "Unknown Title")
-        safe_title = "".join(
-            c for c in title if c.isalnum() or c in (" ", ".", "_")
-        ).rstrip()  # Sanitize title
-        new_video_title = os.path.join(DOWNLOADS_DIR, f"{safe_title}.mp4")
-        if os.path.exists(new_video_title):  # Overwrite if file exists
-            os.remove(new_video_title)
-        os.rename(video_file, new_video_title)  # Rename the file
-        video_file = new_video_title
+        video_file = move_to_downloads(
+            video_file, f"{sanitize_filename(title)}.mp4", key
+        )
+    finally:
+        if own_work_dir:
+            remove_work_directory(work_dir)
 
-        # Return the video file path
-        return video_file
+    # Return the video file path
+    return video_file
 
 
-def process_video_playlist(playlist_url):
+def process_video_playlist(
+    playlist_url, archive=None, keep_files=False, progress_hook=None
+):
     """
     Processes a YouTube playlist by downloading the videos and zipping them into a single file.
 
+    Each video is appended to the zip as soon as it is downloaded, so the zip can be streamed
+    while the playlist is still running. Like process_playlist, the job is checkpointed, so
+    running it again after an interruption skips the videos that were finished, and a video
+    that fails is left out and reported with a "track_failed" progress event.
+
     Args:
         playlist_url (str): The URL of the YouTube playlist to process.
+        archive (archive.StreamingZip, optional): The archive to append videos to. It is closed
+            when the playlist is done. Defaults to a new videos_playlist.zip.
+        keep_files (bool, optional): Keep the video files next to the zip. Otherwise they
+            are removed once the zip is complete. Defaults to False.
+        progress_hook (callable, optional): Called with yt-dlp's progress dictionaries while
+            downloading, and with a "track_done" or "track_failed" dictionary (see
+            process_playlist) whenever a video is added to the zip or left out. Defaults to
+            None.
 
     Returns:
         str: The path to the zip file containing the downloaded video files.
     """
     # Extract video URLs from the playlist
-    ydl_opts = {"extract_flat": True}
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        playlist_info = ydl.extract_info(playlist_url, download=False)
-        video_urls = [entry["url"] for entry in playlist_info["entries"]]
-
-    # Store video files for zipping
-    video_files = []
-
-    # Download each video
-    for i, video_url in enumerate(video_urls, start=1):
-        video_file = download_video(video_url)
-        video_files.append(video_file)
-
-    # Zip the video files
-    zip_filename = os.path.join(DOWNLOADS_DIR, "videos_playlist.zip")
-    with zipfile.ZipFile(zip_filename, "w") as zipf:
-        for video_file in video_files:
-            zipf.write(
-                video_file, os.path.basename(video_file)
-            )  # Add the file to the zip
+    ydl_opts = {
+        "extract_flat": True,
+        "allowed_extractors": ALLOWED_EXTRACTORS,
+        **host_limits.ydl_params(),
+    }
+    with host_limits.limit(yt_dlp.YoutubeDL(ydl_opts)) as ydl:
+        playlist_info = info_cache.extract_info(ydl, playlist_url)
+
+    # The manifest remembers finished videos, so a restarted job picks up where it stopped
+    manifest, entries = open_playlist_manifest("video", playlist_url, playlist_info)
+    with manifest:
+
+        own_archive = archive is None
+        if own_archive:
+            archive = StreamingZip(unique_output_path("videos_playlist.zip"))
+
+        # Download each video and add it to the zip right away
+        video_files = []
+        failures = []
+        # Clients can download the zip while tracks are still being added
+        with stream_archive(archive, progress_hook):
+            try:
+                for track_number, (entry_id, video_url) in enumerate(entries, start=1):
+                    video_file = manifest.finished_output(entry_id)
+                    claimed = video_file is not None
+                    if not claimed:
+                        try:
+                            video_file = download_video(
+                                video_url,
+                                progress_hook,
+                                manifest.work_directory(entry_id),
+                            )
+                        except Exception as error:
+                            manifest.mark_failed(entry_id, error)
+                            if is_cancellation(error):
+                                raise
+                            # Leave the video out and carry on; the manifest keeps it
+                            failures.append((track_number, error))
+                            report_track_failure(
+                                progress_hook, track_number, len(entries), error
+                            )
+                            continue
+                        manifest.mark_done(entry_id, video_file)
+                    with timed("zip", file=os.path.basename(video_file)):
+                        archive.add(video_file)
+                    if keep_files and claimed:
+                        # Claimed from an earlier run, so it is in the job's work directory
+                        video_file = move_to_downloads(
+                            video_file, os.path.basename(video_file)
+                        )
+                    video_files.append(video_file)
+                    if progress_hook:
+                        progress_hook(
+                            {
+                                "status": "track_done",
+                                "track_number": track_number,
+                                "tracks": len(entries),
+                                "filename": os.path.basename(video_file),
+                            }
+                        )
+                if failures and not archive.count:
+                    raise failures[0][1]  # Nothing worked, e.g. the network is down
+            except BaseException:
+                if own_archive:
+                    archive.discard()  # An incomplete zip is of no use
+                else:
+                    archive.close()
+                raise
+            archive.close()
+
+        if failures:
+            # Keep the manifest and the finished videos, so running the job again only
+            # downloads the failed ones
+            print_failures(failures)
+        else:
+            finish_playlist_job(manifest, video_files, keep_files)
 
-    print(f"Zipped {len(video_files)} videos into {zip_filename}")
+        print(f"Zipped {archive.count} videos into {archive.path}")
 
-    return zip_filename
+        return archive.path
 
 
-def video_pipeline(url):
+def video_pipeline(url, progress_hook=None):
     """
     Determines if the provided URL is a video or a playlist and processes it accordingly.
 
     Args:
         url (str): The URL of the YouTube video or playlist to process.
+        progress_hook (callable, optional): Called with yt-dlp's progress dictionaries while
+            downloading. Defaults to None.
 
     Returns:
         str: The path to the zip file containing the downloaded files.
     """
     # Set options for yt-dlp to check if the URL is a playlist or video
-    ydl_opts = {"extract_flat": True}
+    ydl_opts = {
+        "extract_flat": True,
+        "allowed_extractors": ALLOWED_EXTRACTORS,
+        **host_limits.ydl_params(),
+    }
 
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info_dict = ydl.extract_info(url, download=False)
+    with host_limits.limit(yt_dlp.YoutubeDL(ydl_opts)) as ydl:
+        info_dict = info_cache.extract_info(ydl, url)
 
     # Check if the URL is a playlist
     if "entries" in info_dict:  # It's a playlist
         print(f"Processing playlist: {info_dict.get('title')}")
-        return process_video_playlist(url)  # Process the playlist
+        return process_video_playlist(
+            url, progress_hook=progress_hook
+        )  # Process the playlist
     else:  # It's a single video
         print(f"Downloading video: {info_dict.get('title')}")
-        return download_video(url)  # Download the single video
+        return download_video(url, progress_hook)  # Download the single video
+
+
+def audio_pipeline(url, progress_hook=None, audio_format="mp3", sync=False):
+    """
+    Determines if the provided URL is a video or a playlist and downloads its audio.
+
+    Args:
+        url (str): The URL of the YouTube video or playlist to process.
+        progress_hook (callable, optional): Called with yt-dlp's progress dictionaries while
+            downloading. Defaults to None.
+        audio_format (str, optional): One of AUDIO_FORMATS. Defaults to "mp3".
+        sync (bool, optional): Sync playlists into the library (see sync_playlist) instead
+            of downloading them in full. Defaults to False.
+
+    Returns:
+        str: The path to the audio file, or to the playlist's zip file.
+    """
+    ydl_opts = {
+        "extract_flat": True,
+        "allowed_extractors": ALLOWED_EXTRACTORS,
+        **host_limits.ydl_params(),
+    }
+
+    with host_limits.limit(yt_dlp.YoutubeDL(ydl_opts)) as ydl:
+        info_dict = info_cache.extract_info(ydl, url)
+
+    if "entries" in info_dict:
+        if sync:
+            return sync_playlist(
+                url, progress_hook=progress_hook, audio_format=audio_format
+            )
+        return process_playlist(
+            url, progress_hook=progress_hook, audio_format=audio_format
+        )
+    return download_audio_and_metadata(
+        url, progress_hook=progress_hook, audio_format=audio_format
+    )[0]
@@ -0,0 +1,225 @@
+import contextlib
+import os
+import threading
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from urllib.parse import urlsplit
+
+from ratelimit import host_limits
+from thumbnails import REQUEST_TIMEOUT, get_session
+
+# Number of ranged requests a single stream is downloaded with at the same time
+FRAGMENT_WORKERS = 4
+
+# Size of each ranged request, in bytes
+FRAGMENT_SIZE = 8 * 1024 * 1024
+
+# Streams smaller than this are downloaded with a single request, in bytes
+PARALLEL_MIN_SIZE = 32 * 1024 * 1024
+
+# Maximum number of ranged requests open to a single host, across all jobs
+HOST_CONNECTIONS = 8
+
+# Size of the blocks a fragment is written in, in bytes
+WRITE_BLOCK_SIZE = 256 * 1024
+
+
+class RangesNotSupported(Exception):
+    """Raised when a server answers a ranged request with the whole file."""
+
+
+class HostLimiter:
+    """
+    Caps the number of connections open to each host.
+
+    Several jobs can split streams from the same CDN host at once, so the cap is shared
+    between them rather than applied per stream.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def connection(self, url):
+        """Waits for a free connection slot to the URL's host and holds it."""
+        host = urlsplit(url).netloc
+        with self._lock:
+            semaphore = self._semaphores.get(host)
+            if semaphore is None:
+                semaphore = self._semaphores[host] = threading.BoundedSemaphore(
+                    self.limit
+                )
+        with semaphore:
+            yield
+
+
+# Shared limiter for every ranged download
+host_limiter = HostLimiter(HOST_CONNECTIONS)
+
+
+class StreamProgress:
+    """
+    Combines the progress of several streams downloaded at once into one progress hook.
+
+    The video and audio streams of a video are downloaded in parallel and each reports its
+    own bytes and total, so passing them on as they are would make the progress jump
+    between the two. This reports the sum of all streams instead.
+    """
+
+    def __init__(self, progress_hook=None):
+        """
+        Args:
+            progress_hook (callable, optional): Called with the combined yt-dlp style
+                progress dictionaries. Defaults to None.
+        """
+        self.progress_hook = progress_hook
+        self._streams = {}
+        self._lock = threading.Lock()
+
+    def expect(self, filename, total_bytes=None):
+        """Adds a stream before it starts, so the total covers it from the start."""
+        with self._lock:
+            self._streams.setdefault(
+                filename, {"downloaded": 0, "total": total_bytes, "status": None}
+            )
+
+    def __call__(self, progress):
+        if not self.progress_hook:
+            return
+        filename = progress.get("filename")
+        with self._lock:
+            stream = self._streams.setdefault(
+                filename, {"downloaded": 0, "total": None, "status": None}
+            )
+            stream["downloaded"] = progress.get("downloaded_bytes") or 0
+            stream["total"] = (
+                progress.get("total_bytes")
+                or progress.get("total_bytes_estimate")
+                or stream["total"]
+            )
+            stream["status"] = progress.get("status")
+            stream["speed"] = progress.get("speed")
+            streams = list(self._streams.values())
+        totals = [stream["total"] for stream in streams]
+        finished = all(stream["status"] == "finished" for stream in streams)
+        speeds = [
+            stream.get("speed") or 0
+            for stream in streams
+            if stream["status"] == "downloading"
+        ]
+        self.progress_hook(
+            {
+                "status": "finished" if finished else "downloading",
+                "filename": filename,
+                "downloaded_bytes": sum(stream["downloaded"] for stream in streams),
+                "total_bytes": sum(totals) if all(totals) else None,
+                "speed": sum(speeds) or None,
+            }
+        )
+
+
+def fragment_ranges(size, fragment_size=FRAGMENT_SIZE):
+    """Splits size bytes into inclusive (start, end) byte ranges of fragment_size."""
+    return [
+        (start, min(start + fragment_size, size) - 1)
+        for start in range(0, size, fragment_size)
+    ]
+
+
+def download_ranges(
+    url,
+    path,
+    size,
+    headers=None,
+    workers=FRAGMENT_WORKERS,
+    fragment_size=FRAGMENT_SIZE,
+    progress_hook=None,
+):
+    """
+    Downloads a file over HTTP as parallel ranged requests, written in place.
+
+    A single connection is often throttled well below the link's bandwidth, so a large
+    stream is split into fragments that are fetched over several connections and written
+    straight to their offset in the output file.
+
+    Args:
+        url (str): The URL of the file.
+        path (str): Where to write the file.
+        size (int): The size of the file in bytes.
+        headers (dict, optional): Extra HTTP headers, e.g. yt-dlp's http_headers.
+        workers (int, optional): The number of fragments downloaded at the same time.
+        fragment_size (int, optional): The size of each fragment in bytes.
+        progress_hook (callable, optional): Called with yt-dlp style progress dictionaries.
+            Defaults to None.
+
+    Raises:
+        RangesNotSupported: If the server ignores the Range header.
+        requests.RequestException: If a fragment fails after the session's retries.
+    """
+    session = get_session()
+    progress = {"downloaded_bytes": 0}
+    progress_lock = threading.Lock()
+    # Set when a fragment fails, so the others stop instead of finishing for nothing
+    stop = threading.Event()
+
+    # Reserve the whole file up front, so every fragment can be written at its offset
+    with open(path, "wb") as output_file:
+        output_file.truncate(size)
+
+    def report(status, downloaded_bytes):
+        if progress_hook:
+            progress_hook(
+                {
+                    "status": status,
+                    "filename": path,
+                    "downloaded_bytes": downloaded_bytes,
+                    "total_bytes": size,
+                }
+            )
+
+    def fetch(byte_range):
+        if stop.is_set():
+            return
+        start, end = byte_range
+        range_headers = dict(headers or {}, Range=f"bytes={start}-{end}")
+        with host_limiter.connection(url):
+            host_limits.request(url)
+            with session.get(
+                url, headers=range_headers, timeout=REQUEST_TIMEOUT, stream=True
+            ) as response:
+                response.raise_for_status()
+                if response.status_code != 206:
+                    raise RangesNotSupported(f"{urlsplit(url).netloc} ignored Range")
+                with open(path, "r+b") as output_file:
+                    output_file.seek(start)
+                    for block in response.iter_content(WRITE_BLOCK_SIZE):
+                        if stop.is_set():
+                            return
+                        output_file.write(block)
+                        host_limits.transfer(url, len(block))
+                        with progress_lock:
+                            progress["downloaded_bytes"] += len(block)
+                            downloaded_bytes = progress["downloaded_bytes"]
+                        report("downloading", downloaded_bytes)
+                    written = output_file.tell() - start
+        if written != end - start + 1:
+            raise OSError(f"Fragment {start}-{end} of {url} was cut short")
+
+    pool = ThreadPoolExecutor(max_workers=max(1, workers))
+    try:
+        fragments = [
+            pool.submit(fetch, byte_range)
+            for byte_range in fragment_ranges(size, fragment_size)
+        ]
+        # Returns once every fragment is done, or as soon as one fails
+        done, _ = wait(fragments, return_when=FIRST_EXCEPTION)
+        for fragment in done:
+            fragment.result()  # Raises the fragment's error
+    except BaseException:
+        stop.set()
+        pool.shutdown(wait=True, cancel_futures=True)
+        os.remove(path)
+        raise
+    pool.shutdown()
+    report("finished", size)
@@ -0,0 +1,308 @@
+import collections
+import queue
+import threading
+import time
+import uuid
+
+from metrics import log_event, registry
+
+# Number of long jobs (playlists, syncs and videos, which may be playlists too) that
+# run at the same time
+JOB_WORKERS = 2
+
+# Number of other jobs, e.g. single audio downloads, that run at the same time. They
+# have their own workers, so they never wait behind hours of playlist downloads.
+QUICK_JOB_WORKERS = 4
+
+# Kinds of jobs that run on the long job workers
+LONG_JOB_KINDS = ("playlist", "sync", "video")
+
+# Number of jobs of each length that can wait for a worker before new ones are refused
+MAX_QUEUED_JOBS = 32
+
+# Number of progress events kept per job
+MAX_EVENTS = 100
+
+# Number of finished jobs remembered for status lookups
+FINISHED_JOBS_KEPT = 100
+
+# How often follow_job reports progress, in seconds
+POLL_INTERVAL = 0.5
+
+
+class JobQueueFull(Exception):
+    """Raised when a job is submitted while the job queue is full."""
+
+
+class Job:
+    """
+    A download running in the background.
+
+    The job's progress_hook is passed to the download function, which passes it on to
+    yt-dlp. Every call records a progress event, and raises DownloadCancelled once the
+    job is cancelled, which stops the download.
+    """
+
+    def __init__(self, kind, function, args, kwargs):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = "queued"  # queued, running, done, failed or cancelled
+        self.result = None
+        self.error = None
+        self.events = collections.deque(maxlen=MAX_EVENTS)
+        self.tracks_done = 0
+        self.tracks_failed = 0
+        self.partial_output = None  # The storage name of an output that's still growing
+        self.created = time.time()
+        self.started = None
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._finished = threading.Event()
+
+    def progress_hook(self, progress):
+        """
+        Records a yt-dlp progress dictionary, or a "track_done", "track_failed" or
+        "archive_started" event.
+        """
+        if self._cancelled.is_set():
+            from yt_dlp.utils import DownloadCancelled  # Loaded with yt-dlp by now
+
+            raise DownloadCancelled("The job was cancelled")
+
+        event = {
+            "time": time.time(),
+            "status": progress.get("status"),
+            "filename": progress.get("filename"),
+            "downloaded_bytes": progress.get("downloaded_bytes"),
+            "total_bytes": progress.get("total_bytes")
+            or progress.get("total_bytes_estimate"),
+            "speed": progress.get("speed"),
+        }
+        with self._lock:
+            if progress.get("status") == "track_done":
+                self.tracks_done += 1
+                event["tracks"] = progress["tracks"]
+            elif progress.get("status") == "track_failed":
+                self.tracks_failed += 1
+            elif progress.get("status") == "archive_started":
+                self.partial_output = progress["name"]
+            self.events.append(event)
+
+    def cancel(self):
+        """Asks the job to stop. A queued job never starts; a running one stops soon."""
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    @property
+    def finished(self):
+        return self._finished.is_set()
+
+    def wait(self, timeout=None):
+        """Waits for the job to finish and returns True if it did."""
+        return self._finished.wait(timeout)
+
+    def run(self):
+        """Runs the job on the calling thread. Used by the job workers."""
+        if self.cancelled:
+            self._finish("cancelled")
+            return
+        self.status = "running"
+        self.started = time.time()
+        try:
+            self.result = self.function(
+                *self.args, progress_hook=self.progress_hook, **self.kwargs
+            )
+        except Exception as error:
+            if self.cancelled:
+                self._finish("cancelled")
+            else:
+                self.error = str(error)
+                self._finish("failed")
+        else:
+            self._finish("done")
+
+    def _finish(self, status):
+        self.status = status
+        registry.inc("downloaddynamo_jobs_total", kind=self.kind, status=status)
+        if self.started:
+            seconds = time.time() - self.started
+            registry.observe("downloaddynamo_job_seconds", seconds, kind=self.kind)
+            log_event(
+                "job",
+                id=self.id,
+                kind=self.kind,
+                status=status,
+                seconds=round(seconds, 3),
+            )
+        self._finished.set()
+
+    def describe(self):
+        """
+        Describes the job's state in one line, for showing in the interface.
+
+        Returns:
+            str: e.g. "Downloading audio.webm: 45% at 2.1 MiB/s (3 tracks done)".
+        """
+        with self._lock:
+            event = self.events[-1] if self.events else None
+            tracks_done = self.tracks_done
+            tracks_failed = self.tracks_failed
+
+        if self.status == "queued":
+            return "Waiting for a free worker"
+        if self.status in ("failed", "cancelled"):
+            return f"Job {self.status}" + (f": {self.error}" if self.error else "")
+
+        description = "Done" if self.status == "done" else "Starting"
+        if self.status == "running" and event:
+            if event["status"] == "downloading":
+                description = f"Downloading {event['filename']}"
+                if event["total_bytes"]:
+                    percent = 100 * event["downloaded_bytes"] / event["total_bytes"]
+                    description += f": {percent:.0f}%"
+                if event["speed"]:
+                    description += f" at {event['speed'] / 1024**2:.1f} MiB/s"
+            else:
+                description = "Processing"
+        if tracks_done or tracks_failed:
+            counts = [f"{tracks_done} tracks done"]
+            if tracks_failed:
+                counts.append(f"{tracks_failed} failed")
+            description += f" ({', '.join(counts)})"
+        return description
+
+
+class JobManager:
+    """
+    Runs download jobs on a fixed number of worker threads, with bounded queues.
+
+    Request handlers submit jobs and return immediately, so long playlists don't hold on
+    to a request worker while they download. Long jobs and quick jobs have separate
+    workers and queues, so a single download starts even while playlists are running.
+    """
+
+    def __init__(
+        self,
+        workers=JOB_WORKERS,
+        max_queued=MAX_QUEUED_JOBS,
+        quick_workers=QUICK_JOB_WORKERS,
+        long_kinds=LONG_JOB_KINDS,
+    ):
+        """
+        Creates the job manager. Worker threads are started on the first submit.
+
+        Args:
+            workers (int, optional): The number of long jobs that run at the same time.
+            max_queued (int, optional): The number of long jobs, and of quick jobs, that
+                can wait for a worker.
+            quick_workers (int, optional): The number of quick jobs that run at the same
+                time.
+            long_kinds (tuple, optional): The kinds of jobs that are long.
+        """
+        self.workers = workers
+        self.quick_workers = quick_workers
+        self.long_kinds = long_kinds
+        self._queues = {
+            "long": queue.Queue(maxsize=max_queued),
+            "quick": queue.Queue(maxsize=max_queued),
+        }
+        self._jobs = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._threads = {"long": [], "quick": []}
+
+    def submit(self, kind, function, *args, **kwargs):
+        """
+        Queues a download function to run in the background.
+
+        Args:
+            kind (str): A short name for the kind of job, e.g. "playlist".
+            function (callable): The download function. It must accept a progress_hook
+                keyword argument.
+            *args: Positional arguments for the function.
+            **kwargs: Keyword arguments for the function.
+
+        Returns:
+            Job: The queued job.
+
+        Raises:
+            JobQueueFull: If MAX_QUEUED_JOBS jobs of the same length are already waiting.
+        """
+        job = Job(kind, function, args, kwargs)
+        lane = "long" if kind in self.long_kinds else "quick"
+        with self._lock:
+            self._start_workers(lane)
+            try:
+                self._queues[lane].put_nowait(job)
+            except queue.Full:
+                raise JobQueueFull("Too many jobs are waiting, try again later")
+            self._jobs[job.id] = job
+            self._forget_finished_jobs()
+        return job
+
+    def get(self, job_id):
+        """Returns the job with the given ID, or None if it is unknown."""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """Cancels the job with the given ID, if it exists."""
+        job = self.get(job_id)
+        if job:
+            job.cancel()
+
+    def queue_depth(self):
+        """Returns the number of jobs waiting for a worker."""
+        return sum(job_queue.qsize() for job_queue in self._queues.values())
+
+    def _start_workers(self, lane):
+        threads = self._threads[lane]
+        workers = self.workers if lane == "long" else self.quick_workers
+        while len(threads) < workers:
+            thread = threading.Thread(
+                target=self._work, args=(self._queues[lane],), daemon=True
+            )
+            thread.start()
+            threads.append(thread)
+
+    def _forget_finished_jobs(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[: max(0, len(finished) - FINISHED_JOBS_KEPT)]:
+            del self._jobs[job_id]
+
+    def _work(self, job_queue):
+        while True:
+            job_queue.get().run()
+
+
+def follow_job(job, poll_interval=POLL_INTERVAL):
+    """
+    Yields the job's progress description until it finishes.
+
+    If the consumer stops iterating early, e.g. because the user cancelled the request in
+    the interface, the job is cancelled too.
+
+    Args:
+        job (Job): The job to follow.
+        poll_interval (float, optional): How often to report progress, in seconds.
+
+    Yields:
+        str: The job's current progress description, see Job.describe.
+    """
+    try:
+        while not job.wait(poll_interval):
+            yield job.describe()
+        yield job.describe()
+    finally:
+        if not job.finished:
+            job.cancel()
+
+
+# Shared job manager used by the interface
+job_manager = JobManager()
+registry.register_callback("downloaddynamo_job_queue_depth", job_manager.queue_depth)
@@ -0,0 +1,46 @@
+import importlib
+import threading
+
+
+class LazyModule:
+    """
+    A stand-in for a module that is only imported when one of its attributes is first used.
+
+    yt-dlp, Pillow, mutagen and requests take a noticeable part of a second to import
+    together, which every process would otherwise pay at startup, whether or not it ever
+    downloads anything. Setting an attribute (e.g. when a test patches
+    yt_dlp.YoutubeDL) sets it on the real module.
+    """
+
+    def __init__(self, name):
+        """
+        Creates the stand-in without importing anything.
+
+        Args:
+            name (str): The full name of the module, e.g. "PIL.Image".
+        """
+        object.__setattr__(self, "_name", name)
+        object.__setattr__(self, "_module", None)
+        object.__setattr__(self, "_lock", threading.Lock())
+
+    def _load(self):
+        module = object.__getattribute__(self, "_module")
+        if module is None:
+            with object.__getattribute__(self, "_lock"):
+                module = object.__getattribute__(self, "_module")
+                if module is None:
+                    module = importlib.import_module(self._name)
+                    object.__setattr__(self, "_module", module)
+        return module
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __setattr__(self, attribute, value):
+        setattr(self._load(), attribute, value)
+
+    def __delattr__(self, attribute):
+        delattr(self._load(), attribute)
+
+    def __repr__(self):
+        return f"<lazy module {self._name!r}>"
@@ -0,0 +1,328 @@
+import json
+import os
+import threading
+import time
+
+from cache import link_or_copy
+from manifest import file_checksum
+
+# Name of the index file kept in every playlist's library directory
+INDEX_FILENAME = "index.json"
+
+# Name of the index of stored media kept in every output directory, e.g. downloads
+MEDIA_INDEX_FILENAME = ".media.json"
+
+# Directory inside an output directory that holds the media index's own copies of the
+# stored files; callers get hard-linked copies of them next to it
+MEDIA_STORE_DIRNAME = ".media"
+
+# Total size of the media index's own copies before the least recently used ones are
+# evicted; callers' copies are hard links, so they keep their data either way
+MEDIA_STORE_MAX_BYTES = 2 * 1024**3
+
+# Media indexes that are open, keyed by directory
+media_indexes = {}
+media_indexes_lock = threading.Lock()
+
+
+def reserve_path(directory, filename):
+    """
+    Reserves a path in a directory that no other job is using.
+
+    If the name is taken, a counter is appended (e.g. "Song (2).mp3"). The path is
+    reserved by creating an empty placeholder file, so concurrent jobs never get the
+    same path.
+
+    Args:
+        directory (str): The directory, which is created if needed.
+        filename (str): The desired file name.
+
+    Returns:
+        str: The reserved path.
+    """
+    os.makedirs(directory, exist_ok=True)
+    base, ext = os.path.splitext(filename)
+    counter = 1
+    while True:
+        name = filename if counter == 1 else f"{base} ({counter}){ext}"
+        path = os.path.join(directory, name)
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return path
+        except FileExistsError:
+            counter += 1
+
+
+def media_index(directory):
+    """Returns the shared media index of a directory, opening it on first use."""
+    key = os.path.abspath(directory)
+    with media_indexes_lock:
+        index = media_indexes.get(key)
+        if index is None:
+            index = media_indexes[key] = MediaIndex(directory)
+        return index
+
+
+class PlaylistLibrary:
+    """
+    A local copy of a playlist: its tracks in one directory, plus an index of which
+    playlist entry each file belongs to.
+
+    Comparing the index with a fresh flat listing of the playlist tells which entries were
+    added or removed since the last sync, so only those need any work.
+    """
+
+    def __init__(self, directory):
+        """
+        Opens the library, loading its index if it already exists.
+
+        Args:
+            directory (str): The directory holding the playlist's tracks and index.
+        """
+        self.directory = directory
+        self.index_path = os.path.join(directory, INDEX_FILENAME)
+        self._lock = threading.Lock()
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as index_file:
+                self.tracks = json.load(index_file)["tracks"]
+        except (FileNotFoundError, ValueError):
+            self.tracks = {}
+
+    def save(self):
+        """Writes the index to disk."""
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            temp_path = self.index_path + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as index_file:
+                json.dump({"tracks": self.tracks}, index_file, indent=1)
+            os.replace(temp_path, self.index_path)
+
+    def diff(self, entry_ids):
+        """
+        Compares the library with the playlist's current entries.
+
+        Args:
+            entry_ids (list): The IDs of the playlist's entries, in playlist order.
+
+        Returns:
+            tuple: The IDs of entries missing from the library, and the IDs of tracks in
+            the library that are no longer in the playlist.
+        """
+        with self._lock:
+            current = set(entry_ids)
+            added = [entry_id for entry_id in entry_ids if entry_id not in self.tracks]
+            removed = [entry_id for entry_id in self.tracks if entry_id not in current]
+        return added, removed
+
+    def path(self, entry_id):
+        """Returns the path of an entry's file in the library."""
+        return os.path.join(self.directory, self.tracks[entry_id]["filename"])
+
+    def add(self, entry_id, file_path, track_number):
+        """
+        Moves a finished track into the library and records it in the index.
+
+        Args:
+            entry_id (str): The ID of the playlist entry.
+            file_path (str): The path of the finished file, on the same filesystem.
+            track_number (int): The entry's position in the playlist.
+
+        Returns:
+            str: The path of the file in the library.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        base, ext = os.path.splitext(os.path.basename(file_path))
+        with self._lock:
+            taken = {track["filename"] for track in self.tracks.values()}
+            filename, counter = base + ext, 1
+            while filename in taken or filename == INDEX_FILENAME:
+                counter += 1
+                filename = f"{base} ({counter}){ext}"
+            os.replace(file_path, os.path.join(self.directory, filename))
+            self.tracks[entry_id] = {"filename": filename, "track_number": track_number}
+        return os.path.join(self.directory, filename)
+
+    def remove(self, entry_id):
+        """Deletes a track from the library and the index."""
+        with self._lock:
+            track = self.tracks.pop(entry_id)
+        try:
+            os.remove(os.path.join(self.directory, track["filename"]))
+        except FileNotFoundError:
+            pass
+
+    def ordered_paths(self):
+        """Returns the paths of all tracks, ordered by track number."""
+        with self._lock:
+            tracks = sorted(
+                self.tracks.values(), key=lambda track: track["track_number"]
+            )
+        return [os.path.join(self.directory, track["filename"]) for track in tracks]
+
+
+class MediaIndex:
+    """
+    An index of the media files stored in a directory, by video and by content.
+
+    Every stored file is recorded with its SHA-256 checksum, so a file whose content is
+    already stored (e.g. the same video downloaded from music.youtube.com and
+    youtube.com) is kept once. Files are also recorded under a key describing what was
+    downloaded, e.g. a video ID and format, so a repeated download can be answered from
+    storage without doing any work. Files that were edited or deleted since they were
+    recorded are detected by their size and modification time, and forgotten. When the
+    stored files grow beyond a size limit, the least recently used ones are evicted.
+
+    The index keeps its copies in a hidden subdirectory, and every caller gets its own
+    hard-linked copy in the directory itself, so one caller tagging, serving or deleting
+    its file never affects another's. Tags must be written through tagging.write_tags,
+    which gives the file its own data first.
+    """
+
+    def __init__(self, directory, max_bytes=MEDIA_STORE_MAX_BYTES):
+        """
+        Opens the index, loading it if it already exists.
+
+        Args:
+            directory (str): The directory holding the media files.
+            max_bytes (int, optional): The maximum total size of the stored files.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(directory, MEDIA_INDEX_FILENAME)
+        self._lock = threading.Lock()
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as index_file:
+                index = json.load(index_file)
+            self.files, self.keys = index["files"], index["keys"]
+        except (FileNotFoundError, ValueError, KeyError):
+            self.files, self.keys = {}, {}
+
+    def _save(self):
+        # Called with the lock held
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = self.index_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as index_file:
+            json.dump({"files": self.files, "keys": self.keys}, index_file, indent=1)
+        os.replace(temp_path, self.index_path)
+
+    def _intact(self, filename):
+        # Called with the lock held; forgets files that changed since they were stored
+        record = self.files.get(filename)
+        if record is None:
+            return False
+        try:
+            stat = os.stat(os.path.join(self.directory, filename))
+            if (stat.st_size, stat.st_mtime_ns) == (record["size"], record["mtime_ns"]):
+                return True
+        except FileNotFoundError:
+            pass
+        self._drop(filename)
+        return False
+
+    def _drop(self, filename):
+        # Called with the lock held; forgets a stored file and every key stored under it
+        del self.files[filename]
+        for key in [
+            key for key, entry in self.keys.items() if entry["file"] == filename
+        ]:
+            del self.keys[key]
+
+    def _evict(self):
+        # Called with the lock held; removes least recently used files over the limit
+        total = sum(record["size"] for record in self.files.values())
+        for filename, record in sorted(
+            self.files.items(), key=lambda item: item[1].get("last_used", 0)
+        ):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                pass
+            self._drop(filename)
+            total -= record["size"]
+
+    def _checkout(self, stored, filename):
+        # A new copy of a stored file for one caller, linked to the stored copy
+        path = reserve_path(self.directory, filename)
+        temp_path = path + ".tmp"
+        link_or_copy(os.path.join(self.directory, stored), temp_path)
+        os.replace(temp_path, path)  # Replaces the placeholder in one step
+        return path
+
+    def owns(self, filename):
+        """Returns whether a file in the directory is recorded in the index."""
+        with self._lock:
+            return filename in self.files
+
+    def find(self, key):
+        """
+        Looks up the file stored under a key.
+
+        Args:
+            key (str): The key the file was stored under.
+
+        Returns:
+            dict: The details stored with the file, plus the "path" of the caller's own
+            copy of it, or None if nothing intact is stored under the key.
+        """
+        with self._lock:
+            entry = self.keys.get(key)
+            if entry is None:
+                return None
+            if not self._intact(entry["file"]):
+                self._save()
+                return None
+            stored = entry["file"]
+            self.files[stored]["last_used"] = time.time()
+            self._save()
+            # Linked with the lock held, so a concurrent store can't evict it first
+            path = self._checkout(stored, os.path.basename(stored))
+        return dict(entry["details"], path=path)
+
+    def store(self, work_file, filename, key=None, details=None):
+        """
+        Moves a finished file into the index, unless the same content is stored.
+
+        Args:
+            work_file (str): The path of the finished file, on the same filesystem.
+            filename (str): The desired file name; a counter is appended if it is taken.
+            key (str, optional): A key to record the file under, see find.
+            details (dict, optional): Details returned by find along with the path.
+
+        Returns:
+            str: The path of the caller's own copy of the stored file.
+        """
+        checksum = file_checksum(work_file)
+        with self._lock:
+            existing = next(
+                (
+                    name
+                    for name, record in list(self.files.items())
+                    if record["sha256"] == checksum and self._intact(name)
+                ),
+                None,
+            )
+            if existing:
+                os.remove(work_file)
+                stored = existing
+            else:
+                path = reserve_path(
+                    os.path.join(self.directory, MEDIA_STORE_DIRNAME), filename
+                )
+                os.replace(work_file, path)  # Replaces the placeholder in one step
+                stored = os.path.join(MEDIA_STORE_DIRNAME, os.path.basename(path))
+                stat = os.stat(path)
+                self.files[stored] = {
+                    "sha256": checksum,
+                    "size": stat.st_size,
+                    "mtime_ns": stat.st_mtime_ns,
+                }
+            self.files[stored]["last_used"] = time.time()
+            if key is not None:
+                self.keys[key] = {"file": stored, "details": details or {}}
+            # The caller's copy is linked before the stored file can be evicted
+            path = self._checkout(stored, filename)
+            self._evict()
+            self._save()
+        return path
@@ -0,0 +1,286 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+# Size of the blocks read when computing checksums
+CHECKSUM_BLOCK_SIZE = 1024 * 1024
+
+# Seconds between checks whether another job has released a manifest
+LOCK_POLL_INTERVAL = 0.5
+
+
+def file_checksum(path):
+    """Returns the SHA-256 checksum of a file as a hex string."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(CHECKSUM_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def process_running(pid):
+    """Returns whether the process with the given ID is still running."""
+    if os.name == "nt":
+        import ctypes
+
+        # PROCESS_QUERY_LIMITED_INFORMATION; os.kill would terminate the process
+        handle = ctypes.windll.kernel32.OpenProcess(0x1000, False, pid)
+        if not handle:
+            return False
+        ctypes.windll.kernel32.CloseHandle(handle)
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # Running, as another user
+    return True
+
+
+class PlaylistManifest:
+    """
+    An on-disk record of which entries of a playlist job are finished.
+
+    The manifest records every entry's status, output path and checksum. A job that is
+    restarted after a crash skips the entries that are recorded as done and whose output
+    is still intact. Each entry also gets a stable work directory, so yt-dlp can resume
+    its partial download.
+
+    Changes are appended to a journal, so recording one costs the same however many
+    entries the playlist has; the journal is folded into a JSON snapshot when the
+    manifest is closed. Entries that are no longer needed, e.g. tracks that are zipped
+    and removed, can be forgotten to keep memory use flat.
+
+    Only one job at a time can have a manifest open: it is locked with a lock file next to
+    it, and a second job for the same playlist waits until the first one closes it, then
+    picks up the entries the first one finished. Use the manifest as a context manager,
+    or call close, so the lock is released.
+    """
+
+    def __init__(self, directory, key):
+        """
+        Opens the manifest, loading it if it already exists.
+
+        Waits until no other job has the manifest open. A lock left behind by a process
+        that is no longer running is taken over.
+
+        Args:
+            directory (str): The directory holding manifests and their work directories.
+            key (str): A name identifying the job, e.g. "audio-<playlist id>".
+        """
+        self.directory = directory
+        self.key = key
+        self.path = os.path.join(directory, f"{key}.json")
+        self.lock_path = os.path.join(directory, f"{key}.lock")
+        self.journal_path = os.path.join(directory, f"{key}.journal")
+        self._lock = threading.Lock()
+        self._locked = False
+        self._journal = None
+        self._acquire()
+        try:
+            with open(self.path, "r", encoding="utf-8") as manifest_file:
+                self.entries = json.load(manifest_file)["entries"]
+        except (FileNotFoundError, ValueError):
+            self.entries = {}
+        self._replay()
+
+    def _replay(self):
+        # Apply the changes a crashed job journaled since the last snapshot, and fold them
+        # into the snapshot so new changes aren't appended to a cut-off line
+        try:
+            with open(self.journal_path, "r", encoding="utf-8") as journal:
+                for line in journal:
+                    try:
+                        change = json.loads(line)
+                    except ValueError:
+                        break  # The last line was cut short by the crash
+                    self._apply(change)
+        except FileNotFoundError:
+            return
+        self._save()
+        os.remove(self.journal_path)
+
+    def _apply(self, change):
+        entry_id = change.pop("id")
+        if change.pop("forget", False):
+            self.entries.pop(entry_id, None)
+            return
+        entry = self.entries.setdefault(entry_id, {})
+        for name, value in change.items():
+            if value is None:
+                entry.pop(name, None)
+            else:
+                entry[name] = value
+
+    def _record(self, entry_id, **changes):
+        # Called with the lock held; a None value deletes the field
+        if self._journal is None:
+            self._journal = open(self.journal_path, "a", encoding="utf-8")
+        self._journal.write(json.dumps(dict(changes, id=entry_id)) + "\n")
+        self._journal.flush()
+        self._apply(dict(changes, id=entry_id))
+
+    def _acquire(self):
+        os.makedirs(self.directory, exist_ok=True)
+        while True:
+            try:
+                lock_file = os.open(
+                    self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY
+                )
+            except FileExistsError:
+                if self._lock_is_stale():
+                    try:
+                        os.remove(self.lock_path)
+                    except FileNotFoundError:
+                        pass
+                else:
+                    time.sleep(LOCK_POLL_INTERVAL)
+                continue
+            with os.fdopen(lock_file, "w") as lock:
+                lock.write(str(os.getpid()))
+            self._locked = True
+            return
+
+    def _lock_is_stale(self):
+        try:
+            with open(self.lock_path, "r") as lock:
+                content = lock.read()
+            age = time.time() - os.path.getmtime(self.lock_path)
+        except FileNotFoundError:
+            return False
+        if not content.isdigit():
+            # Not written yet, or cut short by a crash
+            return age > 10 * LOCK_POLL_INTERVAL
+        return not process_running(int(content))
+
+    def close(self):
+        """
+        Writes the manifest's snapshot and releases it, so another job for the playlist
+        can open it.
+        """
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+                self._save()
+                os.remove(self.journal_path)
+            if self._locked:
+                self._locked = False
+                os.remove(self.lock_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _save(self):
+        # Write the snapshot to a temporary file first so a crash never leaves a truncated
+        # manifest
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as manifest_file:
+            json.dump({"key": self.key, "entries": self.entries}, manifest_file)
+        os.replace(temp_path, self.path)
+
+    def add_entries(self, entries, start=1):
+        """
+        Records the playlist's entries, keeping the state of entries seen before.
+
+        Args:
+            entries (list): (entry ID, URL) pairs in playlist order.
+            start (int, optional): The track number of the first entry, for playlists that
+                are recorded a page at a time. Defaults to 1.
+        """
+        with self._lock:
+            for track_number, (entry_id, url) in enumerate(entries, start=start):
+                status = self.entries.get(entry_id, {}).get("status", "pending")
+                self._record(
+                    entry_id, status=status, url=url, track_number=track_number
+                )
+
+    def finished_output(self, entry_id):
+        """
+        Claims the output of a finished entry, if it is still intact on disk.
+
+        The output is moved into the entry's work directory, keeping its file name, so it
+        belongs to the caller alone: the caller may zip and delete it, and no other job
+        can hand out or delete the same path. The work directory is removed with the
+        manifest, so move the file out if it should be kept.
+
+        Args:
+            entry_id (str): The ID of the entry.
+
+        Returns:
+            str: The path of the claimed output, or None if the entry must be processed.
+        """
+        with self._lock:
+            entry = self.entries.get(entry_id, {})
+            if entry.get("status") != "done" or not os.path.exists(entry["output"]):
+                return None
+            if file_checksum(entry["output"]) != entry["sha256"]:
+                return None  # The file was changed or only partly written
+            claimed = os.path.join(
+                self.work_directory(entry_id), os.path.basename(entry["output"])
+            )
+            if entry["output"] != claimed:
+                try:
+                    os.replace(entry["output"], claimed)
+                except FileNotFoundError:
+                    return None  # Claimed by someone else in the meantime
+                self._record(entry_id, output=claimed)
+            return claimed
+
+    def work_directory(self, entry_id):
+        """Returns the entry's work directory, which is kept until the entry is done."""
+        work_dir = os.path.join(self.directory, self.key, entry_id)
+        os.makedirs(work_dir, exist_ok=True)
+        return work_dir
+
+    def mark_done(self, entry_id, output_path):
+        """Records an entry as finished and removes its work directory."""
+        checksum = file_checksum(output_path)
+        with self._lock:
+            self._record(
+                entry_id, status="done", output=output_path, sha256=checksum, error=None
+            )
+        shutil.rmtree(os.path.join(self.directory, self.key, entry_id), True)
+
+    def mark_failed(self, entry_id, error):
+        """Records that an entry failed; its work directory is kept for the next attempt."""
+        with self._lock:
+            self._record(entry_id, status="failed", error=str(error))
+
+    def forget(self, entry_id):
+        """
+        Drops an entry that needs no more work, e.g. a track whose output was zipped and
+        removed, along with its work directory. A rerun treats it as a new entry.
+        """
+        with self._lock:
+            self._record(entry_id, forget=True)
+        shutil.rmtree(os.path.join(self.directory, self.key, entry_id), True)
+
+    def remove(self):
+        """
+        Deletes the manifest and its entries' work directories once the job is complete,
+        and releases it.
+        """
+        with self._lock:
+            job_dir = os.path.join(self.directory, self.key)
+            for entry_id in self.entries:
+                shutil.rmtree(os.path.join(job_dir, entry_id), True)
+            try:
+                os.rmdir(job_dir)
+            except OSError:
+                pass  # Already gone, or holds files that aren't this manifest's
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            for path in (self.path, self.journal_path):
+                if os.path.exists(path):
+                    os.remove(path)
+        self.close()
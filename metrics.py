@@ -0,0 +1,250 @@
+import contextlib
+import http.server
+import json
+import logging
+import threading
+import time
+
+# Port of the Prometheus metrics endpoint started next to the interface
+METRICS_PORT = 9464
+
+# Upper bounds of the histogram buckets, in seconds
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Type and help text of every metric
+METRICS = {
+    "downloaddynamo_stage_seconds": (
+        "histogram",
+        "Time spent in each pipeline stage.",
+    ),
+    "downloaddynamo_stage_errors_total": (
+        "counter",
+        "Pipeline stages that raised an error.",
+    ),
+    "downloaddynamo_downloaded_bytes_total": (
+        "counter",
+        "Bytes downloaded, by kind of media.",
+    ),
+    "downloaddynamo_cache_hits_total": ("counter", "Cache lookups that hit."),
+    "downloaddynamo_cache_misses_total": ("counter", "Cache lookups that missed."),
+    "downloaddynamo_thumbnail_requests_total": (
+        "counter",
+        "Thumbnail lookups, by how they were answered.",
+    ),
+    "downloaddynamo_jobs_total": ("counter", "Finished background jobs, by status."),
+    "downloaddynamo_job_seconds": ("histogram", "Time background jobs took to run."),
+    "downloaddynamo_job_queue_depth": ("gauge", "Jobs waiting for a free worker."),
+    "downloaddynamo_ffmpeg_wait_seconds": (
+        "histogram",
+        "Time ffmpeg work waited for a free slot.",
+    ),
+    "downloaddynamo_ffmpeg_cpu_seconds_total": (
+        "counter",
+        "CPU time used by ffmpeg processes.",
+    ),
+    "downloaddynamo_ffmpeg_queue_depth": ("gauge", "ffmpeg work waiting for a slot."),
+    "downloaddynamo_ffmpeg_running": ("gauge", "ffmpeg work running."),
+    "downloaddynamo_retries_total": (
+        "counter",
+        "Requests retried after a transient failure, by host.",
+    ),
+    "downloaddynamo_throttle_seconds_total": (
+        "counter",
+        "Time spent waiting for per-host request and bandwidth limits.",
+    ),
+    "downloaddynamo_playlist_failures_total": (
+        "counter",
+        "Playlist entries skipped because they failed.",
+    ),
+    "downloaddynamo_served_bytes_total": (
+        "counter",
+        "Bytes of stored downloads sent by the file server.",
+    ),
+}
+
+# Structured log records, one JSON object per message
+logger = logging.getLogger("downloaddynamo")
+
+
+def label_key(labels):
+    """Turns keyword labels into a hashable, ordered key."""
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def format_labels(key, extra=()):
+    """Formats a label key in the Prometheus text format, e.g. {stage="zip"}."""
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Registry:
+    """
+    Holds counters and histograms in memory and renders them for Prometheus.
+
+    Values that other modules already track, like cache hit counters, are read through
+    callbacks when the metrics are rendered instead of being counted twice.
+    """
+
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        """Adds value to a counter."""
+        key = (name, label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Records a value, e.g. a duration in seconds, in a histogram."""
+        key = (name, label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {
+                    "buckets": [0] * len(DURATION_BUCKETS),
+                    "sum": 0.0,
+                    "count": 0,
+                }
+            for index, bound in enumerate(DURATION_BUCKETS):
+                if value <= bound:
+                    histogram["buckets"][index] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def register_callback(self, name, function, **labels):
+        """Reports the number returned by function as the value of a metric."""
+        with self._lock:
+            self._callbacks.append((name, label_key(labels), function))
+
+    def value(self, name, **labels):
+        """Returns a counter's value, or a histogram's count. Used by tests."""
+        key = (name, label_key(labels))
+        with self._lock:
+            if key in self._histograms:
+                return self._histograms[key]["count"]
+            return self._counters.get(key, 0)
+
+    def render(self):
+        """
+        Renders every metric in the Prometheus text exposition format.
+
+        Returns:
+            str: The metrics, one sample per line.
+        """
+        # Series of each metric, as (label key, lines); a histogram's lines stay in
+        # bucket order, with the "+Inf" bucket last
+        with self._lock:
+            samples = {}
+            for (name, key), value in self._counters.items():
+                samples.setdefault(name, []).append(
+                    (key, [f"{name}{format_labels(key)} {value}"])
+                )
+            for (name, key), histogram in self._histograms.items():
+                lines = []
+                samples.setdefault(name, []).append((key, lines))
+                for bound, count in zip(DURATION_BUCKETS, histogram["buckets"]):
+                    labels = format_labels(key, [("le", str(bound))])
+                    lines.append(f"{name}_bucket{labels} {count}")
+                labels = format_labels(key, [("le", "+Inf")])
+                lines.append(f"{name}_bucket{labels} {histogram['count']}")
+                lines.append(f"{name}_sum{format_labels(key)} {histogram['sum']}")
+                lines.append(f"{name}_count{format_labels(key)} {histogram['count']}")
+            callbacks = list(self._callbacks)
+
+        for name, key, function in callbacks:
+            samples.setdefault(name, []).append(
+                (key, [f"{name}{format_labels(key)} {function()}"])
+            )
+
+        output = []
+        for name in sorted(samples):
+            metric_type, help_text = METRICS.get(name, ("untyped", ""))
+            output.append(f"# HELP {name} {help_text}")
+            output.append(f"# TYPE {name} {metric_type}")
+            for _, lines in sorted(samples[name], key=lambda series: series[0]):
+                output.extend(lines)
+        return "\n".join(output) + "\n"
+
+
+# Shared registry that every module reports to
+registry = Registry()
+
+
+def log_event(event, **fields):
+    """Writes a structured log record as a single line of JSON."""
+    logger.info(
+        json.dumps({"time": time.time(), "event": event, **fields}, default=str)
+    )
+
+
+@contextlib.contextmanager
+def timed(stage, **fields):
+    """
+    Measures a pipeline stage, recording it in the stage histogram and the log.
+
+    Args:
+        stage (str): The name of the stage, e.g. "download" or "transcode".
+        **fields: Extra fields for the log record, e.g. the video ID.
+    """
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except BaseException:
+        status = "error"
+        registry.inc("downloaddynamo_stage_errors_total", stage=stage)
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        registry.observe("downloaddynamo_stage_seconds", seconds, stage=stage)
+        log_event(
+            "stage", stage=stage, seconds=round(seconds, 4), status=status, **fields
+        )
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the shared registry at /metrics."""
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass  # Scrapes every few seconds would drown the log
+
+
+def start_metrics_server(port=METRICS_PORT, host="127.0.0.1"):
+    """
+    Serves the metrics at http://host:port/metrics on a background thread.
+
+    Args:
+        port (int, optional): The port to listen on. Defaults to METRICS_PORT.
+        host (str, optional): The address to listen on. Defaults to this machine only.
+
+    Returns:
+        http.server.ThreadingHTTPServer: The running server, or None if the port is taken.
+    """
+    try:
+        server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as error:
+        logger.warning(f"Metrics endpoint not started on port {port}: {error}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,157 @@
+import contextlib
+import os
+import threading
+import time
+
+from metrics import log_event, registry
+
+# Threads each ffmpeg process may use. Audio encoders like LAME are single-threaded, so
+# more threads only help video merges, and those mostly copy streams.
+FFMPEG_THREADS = 1
+
+# Number of ffmpeg processes that run at the same time, across all jobs; together they
+# use about one thread per core. Further work waits for a free slot.
+FFMPEG_PROCESSES = max(1, (os.cpu_count() or 1) // FFMPEG_THREADS)
+
+
+def children_cpu_seconds():
+    """Returns the CPU time used by this process's finished children, or None."""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class FFmpegScheduler:
+    """
+    Runs ffmpeg work, like transcodes and merges, a limited number at a time.
+
+    Every job that runs ffmpeg waits for one of the scheduler's slots first, so parallel
+    downloads don't start more ffmpeg processes than the machine has cores. The time each
+    job waited, its wall time and the CPU time of its ffmpeg processes are recorded.
+
+    The CPU time is the growth of the process's RUSAGE_CHILDREN while the slot is held, so
+    it is approximate: children of other jobs that finish in the same window are counted
+    too.
+    """
+
+    def __init__(self, processes=FFMPEG_PROCESSES, threads=FFMPEG_THREADS):
+        """
+        Args:
+            processes (int, optional): The number of jobs that run at the same time.
+            threads (int, optional): The threads each ffmpeg process may use.
+        """
+        self.processes = processes
+        self.threads = threads
+        self._slots = threading.BoundedSemaphore(processes)
+        self._lock = threading.Lock()
+        self._holding = threading.local()
+        self.waiting = 0
+        self.running = 0
+
+    def ydl_params(self):
+        """Returns yt-dlp options that limit the threads of its ffmpeg postprocessors."""
+        return {"postprocessor_args": {"default": ["-threads", str(self.threads)]}}
+
+    @contextlib.contextmanager
+    def postprocessor_hook(self, **fields):
+        """
+        Yields a yt-dlp postprocessor hook that holds a slot while each ffmpeg
+        postprocessor runs, e.g. the fixups and merges yt-dlp runs after a download.
+
+        Postprocessors that fail never report that they finished, so a slot that is still
+        held is released when the block ends.
+
+        Args:
+            **fields: Extra fields for the log records, e.g. the video ID.
+        """
+        held = []
+
+        def hook(progress):
+            postprocessor = progress.get("postprocessor") or ""
+            if not postprocessor.startswith("FFmpeg"):
+                return
+            if progress.get("status") == "started":
+                if getattr(self._holding, "slot", False):
+                    return  # Already run inside a slot, e.g. by merge_streams
+                slot = self.slot(postprocessor, **fields)
+                slot.__enter__()
+                held.append(slot)
+            elif progress.get("status") == "finished" and held:
+                held.pop().__exit__(None, None, None)
+
+        try:
+            yield hook
+        finally:
+            while held:
+                held.pop().__exit__(None, None, None)
+
+    @contextlib.contextmanager
+    def slot(self, stage, **fields):
+        """
+        Waits for a free slot and holds it while the block runs ffmpeg.
+
+        Args:
+            stage (str): The kind of work, e.g. "transcode" or "merge".
+            **fields: Extra fields for the log record, e.g. the video ID.
+
+        Yields:
+            dict: The job's measurements, filled in when the block ends: "wait_seconds",
+            "seconds" and "cpu_seconds" (approximate, see the class, and None where it
+            can't be measured).
+        """
+        queued = time.perf_counter()
+        with self._lock:
+            self.waiting += 1
+        with self._slots:
+            with self._lock:
+                self.waiting -= 1
+                self.running += 1
+            start = time.perf_counter()
+            cpu_before = children_cpu_seconds()
+            self._holding.slot = True
+            stats = {"wait_seconds": start - queued}
+            try:
+                yield stats
+            finally:
+                self._holding.slot = False
+                cpu_after = children_cpu_seconds()
+                cpu_seconds = None if cpu_before is None else cpu_after - cpu_before
+                with self._lock:
+                    self.running -= 1
+                stats["seconds"] = time.perf_counter() - start
+                stats["cpu_seconds"] = cpu_seconds
+                self._record(stage, stats, fields)
+
+    def _record(self, stage, stats, fields):
+        registry.observe(
+            "downloaddynamo_ffmpeg_wait_seconds", stats["wait_seconds"], stage=stage
+        )
+        if stats["cpu_seconds"] is not None:
+            registry.inc(
+                "downloaddynamo_ffmpeg_cpu_seconds_total",
+                stats["cpu_seconds"],
+                stage=stage,
+            )
+        log_event(
+            "ffmpeg",
+            stage=stage,
+            **{
+                name: round(value, 4)
+                for name, value in stats.items()
+                if value is not None
+            },
+            **fields,
+        )
+
+
+# Shared scheduler for every job
+ffmpeg_scheduler = FFmpegScheduler()
+registry.register_callback(
+    "downloaddynamo_ffmpeg_queue_depth", lambda: ffmpeg_scheduler.waiting
+)
+registry.register_callback(
+    "downloaddynamo_ffmpeg_running", lambda: ffmpeg_scheduler.running
+)
@@ -0,0 +1,250 @@
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+from metrics import log_event, registry
+
+# Requests per second allowed to each host across all jobs, and how many can be made in
+# a burst after a quiet period. YouTube answers with 429s when it gets more.
+HOST_REQUEST_RATE = 4.0
+HOST_REQUEST_BURST = 8
+
+# Bytes per second downloaded from each host across all jobs, or None for no cap
+HOST_BANDWIDTH = None
+
+# Attempts after the first for a request that failed transiently, and the backoff
+# between them: a random wait of up to BACKOFF_BASE * 2^attempt seconds, at most
+# BACKOFF_MAX, so parallel workers don't retry in lockstep
+RETRIES = 4
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 30.0
+
+# Lowercase fragments of error messages that mark a failure as transient
+TRANSIENT_ERRORS = (
+    "http error 429",
+    "too many requests",
+    "http error 5",  # Server errors, e.g. 503 Service Unavailable
+    "timed out",
+    "timeout",
+    "temporarily",
+    "connection reset",
+    "connection aborted",
+    "remote end closed",
+    "incomplete read",
+)
+
+
+class TokenBucket:
+    """
+    Allows rate units per second on average, and up to capacity units at once.
+
+    Units can be requests or bytes. Taking more than the bucket holds doesn't fail; the
+    caller waits until the bucket has refilled enough.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        """
+        Takes amount units from the bucket, waiting until they are available.
+
+        Returns:
+            float: The seconds spent waiting.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            # Take the units now, going into debt if needed, so later callers queue up
+            # behind this one instead of racing it
+            self._tokens -= amount
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class HostLimits:
+    """Request rate and bandwidth limits for every host, shared by all jobs."""
+
+    def __init__(
+        self,
+        request_rate=HOST_REQUEST_RATE,
+        request_burst=HOST_REQUEST_BURST,
+        bandwidth=HOST_BANDWIDTH,
+    ):
+        self.request_rate = request_rate
+        self.request_burst = request_burst
+        self.bandwidth = bandwidth
+        self._requests = {}
+        self._bytes = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, buckets, host, rate, capacity):
+        with self._lock:
+            bucket = buckets.get(host)
+            if bucket is None:
+                bucket = buckets[host] = TokenBucket(rate, capacity)
+            return bucket
+
+    def request(self, url):
+        """Waits until a request to the URL's host is allowed."""
+        host = host_of(url)
+        bucket = self._bucket(
+            self._requests, host, self.request_rate, self.request_burst
+        )
+        waited = bucket.acquire()
+        if waited:
+            registry.inc(
+                "downloaddynamo_throttle_seconds_total", waited, kind="request"
+            )
+
+    def transfer(self, url, size):
+        """Waits until size more bytes may be downloaded from the URL's host."""
+        if not self.bandwidth or not size:
+            return
+        # One second's worth of bytes can be taken at once
+        bucket = self._bucket(self._bytes, host_of(url), self.bandwidth, self.bandwidth)
+        waited = bucket.acquire(size)
+        if waited:
+            registry.inc(
+                "downloaddynamo_throttle_seconds_total", waited, kind="bandwidth"
+            )
+
+    def limit(self, ydl):
+        """
+        Makes a yt-dlp downloader wait for the request limit before every request.
+
+        Extraction requests, streams and every fragment of a stream all go through
+        ydl.urlopen, so each takes a token for its own host (e.g. a googlevideo.com server
+        rather than www.youtube.com) before it is sent.
+
+        Args:
+            ydl (yt_dlp.YoutubeDL): The downloader.
+
+        Returns:
+            yt_dlp.YoutubeDL: The same downloader.
+        """
+        urlopen = ydl.urlopen
+
+        def limited_urlopen(request):
+            self.request(request if isinstance(request, str) else request.url)
+            return urlopen(request)
+
+        ydl.urlopen = limited_urlopen
+        return ydl
+
+    def progress_hook(self):
+        """
+        Returns a yt-dlp progress hook that holds its download to the bandwidth cap.
+
+        Every downloaded byte counts against the cap of the stream's host. yt-dlp calls
+        progress hooks on the downloading thread, so waiting in the hook slows the
+        download down. Requests are limited by limit instead.
+        """
+        downloaded = {}
+
+        def hook(progress):
+            filename = progress.get("filename")
+            if progress.get("status") != "downloading":
+                downloaded.pop(filename, None)  # Finished, or failed and retried anew
+                return
+            info_dict = progress.get("info_dict") or {}
+            total = progress.get("downloaded_bytes") or 0
+            size = total - downloaded.get(filename, 0)
+            downloaded[filename] = total
+            self.transfer(info_dict.get("url") or "", size)
+
+        return hook
+
+    def ydl_params(self, retries=0):
+        """
+        Returns yt-dlp options that retry failed requests in one layer only.
+
+        Calls wrapped in with_retries already retry the whole call, so by default yt-dlp
+        doesn't retry anything itself and doesn't skip fragments that failed.
+        Downloaders whose requests can't be wrapped, e.g. one reading a playlist's pages
+        lazily, pass retries=RETRIES and back off between retries like with_retries.
+
+        Args:
+            retries (int, optional): yt-dlp's retries for extraction requests, downloads
+                and fragments.
+        """
+
+        def sleep(n):
+            return backoff_delay(n)
+
+        return {
+            "extractor_retries": retries,
+            "retries": retries,
+            "fragment_retries": retries,
+            "skip_unavailable_fragments": False,
+            "retry_sleep_functions": {
+                "http": sleep,
+                "fragment": sleep,
+                "extractor": sleep,
+            },
+        }
+
+
+# Shared limits for every job
+host_limits = HostLimits()
+
+
+def host_of(url):
+    """Returns the host part of a URL, e.g. "www.youtube.com"."""
+    return urlsplit(url).netloc
+
+
+def is_transient(error):
+    """Returns whether an error is worth retrying, e.g. a 429 or a timeout."""
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    message = str(error).lower()
+    return any(fragment in message for fragment in TRANSIENT_ERRORS)
+
+
+def backoff_delay(attempt):
+    """Returns a jittered wait before retry attempt (0-based), in seconds."""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+
+
+def with_retries(function, *args, url=None, retries=RETRIES, **kwargs):
+    """
+    Calls a function that makes network requests, retrying transient failures.
+
+    Failures that are not transient (see is_transient) are raised right away. The
+    function's requests wait for the rate limit themselves, see HostLimits.limit.
+
+    Args:
+        function (callable): The function to call with args and kwargs.
+        url (str, optional): The URL the function requests, for the logs and metrics.
+        retries (int, optional): The number of retries. Defaults to RETRIES.
+
+    Returns:
+        The function's result.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return function(*args, **kwargs)
+        except Exception as error:
+            if attempt == retries or not is_transient(error):
+                raise
+            delay = backoff_delay(attempt)
+            registry.inc("downloaddynamo_retries_total", host=host_of(url or ""))
+            log_event(
+                "retry",
+                url=url,
+                attempt=attempt + 1,
+                delay=round(delay, 3),
+                error=str(error),
+            )
+            time.sleep(delay)
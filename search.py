@@ -1,9 +1,46 @@
-import yt_dlp
+import atexit
 import os
-import requests
-from PIL import Image
 from io import BytesIO
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from cache import download_cache, info_cache
+from downloader import ALLOWED_EXTRACTORS, download_extracted, media_key, progress_hooks
+from lazy import LazyModule
+from library import media_index
+from metrics import registry, timed
+from ratelimit import host_limits
+from thumbnails import fetch_thumbnail
+
+# Heavy modules are imported on first use, so importing this module stays fast
+yt_dlp = LazyModule("yt_dlp")
+Image = LazyModule("PIL.Image")
+
+# Number of top results whose audio is downloaded in the background after a lazy search
+PREFETCH_RESULTS = 1
+
+# Number of search downloads (audio and thumbnails) that run at the same time, across all
+# searches; a search for three results downloads six files
+SEARCH_WORKERS = 6
+
+# Finished prefetches that are remembered until they are used; older ones are forgotten
+# and their audio is found again through the media index
+AUDIO_DOWNLOADS_KEPT = 64
+
+# Audio downloads started by download_audio or prefetch_audio, keyed by URL and folder.
+# An entry is removed once download_audio has handed out its result.
+audio_downloads = {}
+audio_downloads_lock = threading.Lock()
+
+# Threads that run every search download. Each owns its yt-dlp instances (see
+# shared_ydl), so they are reused from one search to the next.
+search_pool = ThreadPoolExecutor(max_workers=SEARCH_WORKERS)
+
+# Per-thread yt-dlp instances, see shared_ydl, and every instance created, so they can
+# be closed on shutdown
+thread_state = threading.local()
+ydl_instances = []
+ydl_instances_lock = threading.Lock()
 
 
 def sanitize_title(title):
@@ -16,6 +53,27 @@ def sanitize_title(title):
 
 
 def get_video_info(search_query, num_results=5, output_folder="downloads"):
+    # Collect the streamed results and return them in search order
+    results = sorted(
+        iter_video_info(search_query, num_results, output_folder),
+        key=lambda item: item[0],
+    )
+    return [video_info for _, video_info in results]
+
+
+def iter_video_info(search_query, num_results=5, output_folder="downloads"):
+    """
+    Searches YouTube and downloads the audio and thumbnail of every result concurrently.
+
+    Args:
+        search_query (str): The text to search for.
+        num_results (int, optional): The number of results to fetch. Defaults to 5.
+        output_folder (str, optional): The folder to save audio and thumbnails in.
+
+    Yields:
+        tuple: The index of the result in the search and its video info dictionary, as
+        soon as both its audio and thumbnail are downloaded.
+    """
     # Ensure the output folder exists
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
@@ -25,17 +83,21 @@ def get_video_info(search_query, num_results=5, output_folder="downloads"):
         "format": "bestaudio/best",  # Best quality audio format
         "noplaylist": True,  # Only download single video
         "skip_download": True,  # Do not download anything
+        "allowed_extractors": ALLOWED_EXTRACTORS,
+        **host_limits.ydl_params(),
     }
 
-    # Use yt-dlp to search for the query
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        search_results = ydl.extract_info(
-            f"ytsearch{num_results}:{search_query}", download=False
-        )["entries"]
+    # Use yt-dlp to search for the query; repeated searches are answered from the cache
+    with host_limits.limit(yt_dlp.YoutubeDL(ydl_opts)) as ydl:
+        search_results = info_cache.extract_info(
+            ydl, f"ytsearch{num_results}:{search_query}"
+        )["entries"][:num_results]
 
     video_data = []
+    futures = {}
 
-    for result in search_results[:num_results]:
+    # Audio and thumbnail downloads of all results run at the same time
+    for index, result in enumerate(search_results):
         video_info = {
             "title": result.get("title", "N/A"),
             "artist": result.get("uploader", "N/A"),
@@ -47,6 +109,10 @@ def get_video_info(search_query, num_results=5, output_folder="downloads"):
             "thumbnail_output": result.get("thumbnail", "N/A"),
             "url": result.get("webpage_url", "N/A"),
         }
+        video_data.append(video_info)
+
+        # Remember the extracted video in case it is downloaded from another tab
+        info_cache.add(result["webpage_url"], result)
 
         # Sanitize the title for safe file naming
         sanitized_title = sanitize_title(video_info["title"])
@@ -57,37 +123,237 @@ def get_video_info(search_query, num_results=5, output_folder="downloads"):
             output_folder, f"{sanitized_title}.jpg"
         )  # Path for thumbnail
 
-        # Download audio
-        audio_opts = {
-            "format": "bestaudio/best",
-            "outtmpl": audio_output,  # Set the output template for audio
-        }
+        audio_future = search_pool.submit(download_result_audio, result, audio_output)
+        futures[audio_future] = (index, "audio_output")
+        thumbnail_future = search_pool.submit(
+            download_thumbnail, video_info["thumbnail_output"], thumbnail_output
+        )
+        futures[thumbnail_future] = (index, "thumbnail_output")
+
+    # Hand out each result as soon as both of its downloads are done
+    remaining = [2] * len(search_results)
+    for future in as_completed(futures):
+        index, key = futures[future]
+        video_data[index][key] = future.result()
+        remaining[index] -= 1
+        if remaining[index] == 0:
+            yield index, video_data[index]
+
 
-        with yt_dlp.YoutubeDL(audio_opts) as ydl:
-            ydl.download([result["webpage_url"]])  # Download the audio file
+def download_thumbnail(thumbnail_url, thumbnail_output):
+    # Download the thumbnail image; returns None in case of an unsuccessful response
+    with timed("thumbnail", source="search"):
+        thumbnail_data = fetch_thumbnail(thumbnail_url)  # Get the thumbnail
+    if not thumbnail_data:
+        return None
+    img = Image.open(BytesIO(thumbnail_data))
+    img.save(thumbnail_output)  # Save the image in the output folder
+    return thumbnail_output
 
-        video_info["audio_output"] = (
-            audio_output  # Store the path of the downloaded audio
+
+def shared_ydl(**options):
+    # One YoutubeDL per search_pool thread and set of extra options, reused for every
+    # result the thread handles. Its options are fixed once it is created.
+    instances = getattr(thread_state, "ydls", None)
+    if instances is None:
+        instances = thread_state.ydls = {}
+    key = repr(sorted(options.items()))
+    ydl = instances.get(key)
+    if ydl is None:
+        ydl = host_limits.limit(
+            yt_dlp.YoutubeDL(
+                {
+                    "quiet": True,
+                    "format": "bestaudio/best",
+                    "allowed_extractors": ALLOWED_EXTRACTORS,
+                    "progress_hooks": progress_hooks(),
+                    **host_limits.ydl_params(),
+                    **options,
+                }
+            )
         )
+        instances[key] = ydl
+        with ydl_instances_lock:
+            ydl_instances.append(ydl)
+    return ydl
+
+
+def close_shared_ydls():
+    # Wait for running downloads, then close every thread's yt-dlp instances
+    search_pool.shutdown(wait=True)
+    with ydl_instances_lock:
+        for ydl in ydl_instances:
+            ydl.close()
+        ydl_instances.clear()
 
-        # Download the thumbnail image
-        response = requests.get(video_info["thumbnail_output"])  # Get the thumbnail
-        if response.status_code == 200:
-            img = Image.open(BytesIO(response.content))
-            img.save(thumbnail_output)  # Save the image in the downloads directory
-        else:
-            thumbnail_output = None  # In case of an unsuccessful response
 
-        video_info["thumbnail_output"] = (
-            thumbnail_output  # Store the path of the thumbnail
+atexit.register(close_shared_ydls)
+
+
+def download_result_audio(result, audio_output):
+    # Download the audio of an already extracted video; returns the path of the audio,
+    # which is audio_output unless that name is taken by another video
+    output_folder, filename = os.path.split(audio_output)
+    index = media_index(output_folder)
+    key = media_key("search", result["id"], "bestaudio")
+    stored = index.find(key)
+    if stored:
+        return stored["path"]  # Stored by an earlier search
+
+    # Download next to the output and let the index pick a free name for it. The
+    # template only depends on the folder, so the thread's instance is reused for it.
+    work_template = os.path.join(
+        output_folder.replace("%", "%%"), f".%(id)s-{threading.get_ident()}.part"
+    )
+    work_file = os.path.join(
+        output_folder, f".{result['id']}-{threading.get_ident()}.part"
+    )
+    # Reuse the audio from the download cache if this video was fetched before
+    if not download_cache.get(result["id"], "bestaudio", "best", work_file):
+        ydl = shared_ydl(outtmpl={"default": work_template})
+        # The video is already extracted, so download without extracting again
+        with timed("download", video_id=result["id"], source="search"):
+            download_extracted(ydl, result, result.get("webpage_url"))
+        registry.inc(
+            "downloaddynamo_downloaded_bytes_total",
+            os.path.getsize(work_file),
+            kind="audio",
         )
+        download_cache.put(result["id"], "bestaudio", "best", work_file)
+    return index.store(work_file, filename, key)
+
+
+def search_metadata(search_query, num_results=5):
+    """
+    Searches YouTube and returns the results' metadata without downloading anything.
 
-        video_data.append(video_info)  # Append the video info to the list
+    Only the flat search result page is fetched, so this returns in about a second. Use
+    download_audio to fetch the audio of a result once it is selected.
 
+    Args:
+        search_query (str): The text to search for.
+        num_results (int, optional): The number of results to return. Defaults to 5.
+
+    Returns:
+        list: A dictionary per result with the title, artist, release_year, thumbnail_url
+        and url of the video.
+    """
+    ydl_opts = {
+        "quiet": True,  # Suppresses all yt-dlp output
+        "extract_flat": True,  # Don't resolve the individual results
+        "allowed_extractors": ALLOWED_EXTRACTORS,
+        **host_limits.ydl_params(),
+    }
+    with host_limits.limit(yt_dlp.YoutubeDL(ydl_opts)) as ydl:
+        search_results = info_cache.extract_info(
+            ydl, f"ytsearch{num_results}:{search_query}"
+        )["entries"]
+
+    video_data = []
+    for result in search_results[:num_results]:
+        # Flat results list thumbnails from smallest to largest
+        thumbnails = result.get("thumbnails") or [{"url": result.get("thumbnail")}]
+        release_date = result.get("release_date") or result.get("upload_date")
+        video_data.append(
+            {
+                "title": result.get("title", "N/A"),
+                "artist": result.get("uploader") or result.get("channel") or "N/A",
+                "release_year": release_date[:4] if release_date else "N/A",
+                "thumbnail_url": thumbnails[-1]["url"],
+                "url": result.get("url", "N/A"),
+            }
+        )
     return video_data
 
 
-def search_videos(keyword):
+def download_audio(url, output_folder="downloads"):
+    """
+    Downloads the audio of a single search result, e.g. when the user selects it.
+
+    If the same audio is already being prefetched, this waits for that download instead of
+    starting another one.
+
+    Args:
+        url (str): The URL of the video.
+        output_folder (str, optional): The folder to save the audio in.
+
+    Returns:
+        str: The path to the downloaded audio file.
+    """
+    future = start_audio_download(url, output_folder)
+    try:
+        return future.result()
+    finally:
+        with audio_downloads_lock:
+            if audio_downloads.get((url, output_folder)) is future:
+                del audio_downloads[(url, output_folder)]
+
+
+def prefetch_audio(urls, output_folder="downloads"):
+    """Starts downloading the audio of search results in the background."""
+    for url in urls:
+        start_audio_download(url, output_folder)
+
+
+def start_audio_download(url, output_folder):
+    # Share one download per URL between prefetching and on-demand requests
+    with audio_downloads_lock:
+        future = audio_downloads.get((url, output_folder))
+        if (
+            future is not None
+            and future.done()
+            and (future.exception() is not None or not os.path.exists(future.result()))
+        ):
+            future = None  # Retry failed downloads and deleted files
+        if future is None:
+            future = search_pool.submit(fetch_result_audio, url, output_folder)
+            audio_downloads[(url, output_folder)] = future
+            # Forget the oldest finished prefetches that were never used
+            finished = [key for key, other in audio_downloads.items() if other.done()]
+            for key in finished[: max(0, len(audio_downloads) - AUDIO_DOWNLOADS_KEPT)]:
+                del audio_downloads[key]
+        return future
+
+
+def fetch_result_audio(url, output_folder):
+    # Extract a single search result and download its audio
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+
+    result = info_cache.extract_info(shared_ydl(), url)
+
+    audio_output = os.path.join(output_folder, f"{sanitize_title(result['title'])}.mp3")
+    return download_result_audio(result, audio_output)
+
+
+def stream_search_videos(keyword, num_results=3):
+    # Yield the same outputs as search_videos, filling in each result as it finishes
+    outputs = tuple([None] * num_results for _ in range(6))
+    for index, video in iter_video_info(keyword, num_results=num_results):
+        titles, artists, release_years, audio_paths, thumbnails, urls = outputs
+        titles[index] = video["title"]
+        artists[index] = video["artist"]
+        release_years[index] = video["release_year"]
+        audio_paths[index] = video["audio_output"]  # Path to the downloaded audio
+        thumbnails[index] = video["thumbnail_output"]  # Path to the thumbnail
+        urls[index] = video["url"]
+        yield outputs
+
+
+def search_videos(keyword, lazy=False):
+    # Only fetch metadata and leave the audio to be loaded on demand
+    if lazy:
+        video_info = search_metadata(keyword, num_results=3)
+        prefetch_audio([video["url"] for video in video_info[:PREFETCH_RESULTS]])
+        return (
+            [video["title"] for video in video_info],
+            [video["artist"] for video in video_info],
+            [video["release_year"] for video in video_info],
+            [None for video in video_info],  # Audio is loaded with download_audio
+            [video["thumbnail_url"] for video in video_info],
+            [video["url"] for video in video_info],
+        )
+
     # Get the top 3 video information
     video_info = get_video_info(keyword, num_results=3)
 
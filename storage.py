@@ -0,0 +1,543 @@
+import contextlib
+import errno
+import http.server
+import mimetypes
+import os
+import posixpath
+import shutil
+import threading
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+
+from lazy import LazyModule
+from library import media_index, reserve_path
+from metrics import logger, registry
+
+boto3 = LazyModule("boto3")
+
+# Where finished downloads are kept, see open_storage. None keeps them in the downloads
+# directory they were written to.
+STORAGE = None
+
+# Port and address of the file server that serves finished downloads next to the
+# interface. It has no authentication, so it only listens on this machine by default.
+FILES_PORT = 9465
+FILES_HOST = "127.0.0.1"
+
+# Address browsers reach the file server at, e.g. a load balancer in front of the nodes.
+# None is http://localhost:<FILES_PORT>.
+FILES_URL = None
+
+# Bucket of the local object storage stand-in, see LocalObjectClient
+LOCAL_BUCKET = "downloads"
+
+# Seconds a presigned object storage URL stays valid
+PRESIGNED_URL_EXPIRY = 3600
+
+# Size of the blocks streamed from object storage, in bytes
+STREAM_BLOCK_SIZE = 1024 * 1024
+
+# Backends that are open, keyed by storage and downloads directory
+storages = {}
+storages_lock = threading.Lock()
+
+# Archives that are still being written, keyed by storage name, see serve_while_growing
+growing_archives = {}
+growing_archives_lock = threading.Lock()
+
+
+class LocalStorage:
+    """
+    Keeps finished downloads in a directory on this machine.
+
+    Downloads are written straight into the directory, so storing a file that is already
+    there costs nothing; anything else is moved in.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def name_of(self, path):
+        """Returns the name of a stored path, or None if the path is outside the storage."""
+        relative = os.path.relpath(os.path.abspath(path), os.path.abspath(self.root))
+        if relative == os.curdir or relative.startswith(os.pardir):
+            return None
+        return relative.replace(os.sep, "/")
+
+    def local_path(self, name):
+        """Returns the path of a stored file, or None if the name is not valid."""
+        if not is_valid_name(name):
+            return None
+        return os.path.join(self.root, *name.split("/"))
+
+    def put(self, path):
+        """
+        Stores a finished file and takes ownership of it.
+
+        Args:
+            path (str): The path to the file.
+
+        Returns:
+            str: The name of the stored file.
+        """
+        name = self.name_of(path)
+        if name is not None:
+            return name
+        target = reserve_path(self.root, os.path.basename(path))
+        try:
+            os.replace(path, target)  # Replaces the placeholder in one step
+        except OSError as error:
+            if error.errno != errno.EXDEV:
+                raise
+            # A different file system, e.g. a mounted volume
+            temp_path = target + ".part"
+            shutil.copyfile(path, temp_path)
+            self._sync(temp_path)
+            os.replace(temp_path, target)
+            os.remove(path)
+        return self.name_of(target)
+
+    def _sync(self, path):
+        pass
+
+    def size(self, name):
+        """Returns the size of a stored file in bytes."""
+        return os.path.getsize(self.local_path(name))
+
+    def url(self, name):
+        """Returns a URL that serves the file without the file server, or None."""
+        return None
+
+    def location(self, name):
+        """Returns where a stored file is, for people and other programs."""
+        return os.path.abspath(self.local_path(name))
+
+    def remove(self, name):
+        """Removes a stored file."""
+        os.remove(self.local_path(name))
+
+
+class SharedVolumeStorage(LocalStorage):
+    """
+    Keeps finished downloads on a volume mounted on every worker node, e.g. over NFS.
+
+    Files are flushed to the volume before they get their final name, so other nodes
+    never see a partly written file, and any node's file server can serve any download.
+    """
+
+    def _sync(self, path):
+        with open(path, "rb") as stored_file:
+            os.fsync(stored_file.fileno())
+
+    def put(self, path):
+        name = self.name_of(path)
+        if name is not None:
+            self._sync(path)  # Written in place, e.g. a zip built on the volume
+            return name
+        return super().put(path)
+
+
+class LocalObjectClient:
+    """
+    A stand-in for an S3 client that keeps objects in a local directory.
+
+    It implements the part of boto3's S3 client that ObjectStorage uses, with a
+    subdirectory per bucket, so object storage can be used and tested without a server.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, Bucket, Key):
+        if not is_valid_name(Key):
+            raise ValueError(f"Invalid object key {Key!r}")
+        return os.path.join(self.directory, Bucket, *Key.split("/"))
+
+    def upload_file(self, Filename, Bucket, Key):
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + ".part"
+        shutil.copyfile(Filename, temp_path)
+        os.replace(temp_path, path)
+
+    def head_object(self, Bucket, Key):
+        path = self._path(Bucket, Key)
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"No object {Key!r} in {Bucket!r}")
+        return {"ContentLength": os.path.getsize(path)}
+
+    def get_object(self, Bucket, Key, Range=None):
+        path = self._path(Bucket, Key)
+        size = self.head_object(Bucket, Key)["ContentLength"]
+        start, end = (0, size - 1) if Range is None else parse_range(Range, size)
+        body = open(path, "rb")
+        body.seek(start)
+        return {"Body": RangeReader(body, end - start + 1), "ContentLength": size}
+
+    def delete_object(self, Bucket, Key):
+        try:
+            os.remove(self._path(Bucket, Key))
+        except FileNotFoundError:
+            pass
+
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn):
+        return None  # Nothing to redirect to; the file server streams the object
+
+
+class RangeReader:
+    """Reads at most size bytes from a file object, like the body of a ranged GET."""
+
+    def __init__(self, file, size):
+        self._file = file
+        self._left = size
+
+    def read(self, amount=-1):
+        if amount < 0 or amount > self._left:
+            amount = self._left
+        data = self._file.read(amount)
+        self._left -= len(data)
+        return data
+
+    def close(self):
+        self._file.close()
+
+
+class ObjectStorage:
+    """
+    Keeps finished downloads in an S3-compatible bucket, shared by every worker node.
+
+    Files are uploaded once they are finished and removed locally, unless the downloads
+    directory still needs them: files kept by its media index and synced library files
+    (including the library zips) stay, and are uploaded under a fixed key that each
+    upload overwrites, so re-syncing a playlist doesn't add objects. Browsers are sent
+    to a presigned URL, so the bucket serves the bytes; without one (e.g. with
+    LocalObjectClient) the file server streams the object.
+    """
+
+    def __init__(self, bucket, prefix="", client=None, downloads_dir=None):
+        """
+        Args:
+            bucket (str): The bucket.
+            prefix (str, optional): A prefix for every key, e.g. "downloads/".
+            client (optional): An S3 client. Defaults to a boto3 client.
+            downloads_dir (str, optional): Names of files in this directory keep their
+                relative path, e.g. "library/<playlist>/Song.mp3".
+        """
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = client if client is not None else boto3.client("s3")
+        self.downloads_dir = downloads_dir
+
+    def _key(self, name):
+        if not is_valid_name(name):
+            raise ValueError(f"Invalid storage name {name!r}")
+        return self.prefix + name
+
+    def _exists(self, name):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(name))
+            return True
+        except Exception:
+            return False
+
+    def local_path(self, name):
+        return None
+
+    def _owned(self, name):
+        # Whether the downloads directory still uses the file with this name
+        if self.downloads_dir is None:
+            return False
+        if name.startswith("library/"):
+            return True
+        return "/" not in name and media_index(self.downloads_dir).owns(name)
+
+    def put(self, path):
+        name = self.downloads_dir and LocalStorage(self.downloads_dir).name_of(path)
+        name = name or os.path.basename(path)
+        owned = self._owned(name)
+        if not owned:
+            base, ext = posixpath.splitext(name)
+            counter = 1
+            while self._exists(name):
+                counter += 1
+                name = f"{base} ({counter}){ext}"
+        self.client.upload_file(Filename=path, Bucket=self.bucket, Key=self._key(name))
+        if not owned:
+            os.remove(path)
+        return name
+
+    def size(self, name):
+        return self.client.head_object(Bucket=self.bucket, Key=self._key(name))[
+            "ContentLength"
+        ]
+
+    def open_range(self, name, start, end):
+        """Returns a readable body with bytes start to end (inclusive) of an object."""
+        return self.client.get_object(
+            Bucket=self.bucket, Key=self._key(name), Range=f"bytes={start}-{end}"
+        )["Body"]
+
+    def url(self, name):
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": self._key(name)},
+            ExpiresIn=PRESIGNED_URL_EXPIRY,
+        )
+
+    def location(self, name):
+        return f"s3://{self.bucket}/{self._key(name)}"
+
+    def remove(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(name))
+
+
+def is_valid_name(name):
+    """Returns whether a storage name is a plain relative path outside hidden files."""
+    parts = name.split("/")
+    return bool(name) and all(part and not part.startswith(".") for part in parts)
+
+
+def open_storage(spec, downloads_dir):
+    """
+    Opens a storage backend.
+
+    Args:
+        spec (str): Where to keep downloads: None or "local" for the downloads directory,
+            "shared:<path>" for a volume mounted on every node, "s3://<bucket>/<prefix>"
+            (with an optional "?endpoint_url=" for S3-compatible servers) for object
+            storage, or "s3-local:<path>" for the local object storage stand-in.
+        downloads_dir (str): The directory downloads are written to.
+
+    Returns:
+        The backend.
+
+    Raises:
+        ValueError: If the spec is not one of the above.
+    """
+    if not spec or spec == "local":
+        return LocalStorage(downloads_dir)
+    if spec.startswith("shared:"):
+        return SharedVolumeStorage(spec[len("shared:") :])
+    if spec.startswith("s3-local:"):
+        client = LocalObjectClient(spec[len("s3-local:") :])
+        return ObjectStorage(LOCAL_BUCKET, client=client, downloads_dir=downloads_dir)
+    if spec.startswith("s3://"):
+        parts = urlsplit(spec)
+        options = {name: values[-1] for name, values in parse_qs(parts.query).items()}
+        prefix = parts.path.lstrip("/")
+        if prefix and not prefix.endswith("/"):
+            prefix += "/"
+        client = boto3.client("s3", endpoint_url=options.get("endpoint_url"))
+        return ObjectStorage(parts.netloc, prefix, client, downloads_dir)
+    raise ValueError(f"Unknown storage {spec!r}")
+
+
+def get_storage(downloads_dir, spec=None):
+    """Returns the shared backend for spec (STORAGE by default), opening it on first use."""
+    spec = spec or STORAGE
+    key = (spec, os.path.abspath(downloads_dir))
+    with storages_lock:
+        storage = storages.get(key)
+        if storage is None:
+            storage = storages[key] = open_storage(spec, downloads_dir)
+        return storage
+
+
+def parse_range(header, size):
+    """
+    Parses a single byte range of an HTTP Range header, e.g. "bytes=0-1023".
+
+    Returns:
+        tuple: The inclusive (start, end) of the range, or None for a header that asks for
+        several ranges or isn't understood, which is answered with the whole file.
+
+    Raises:
+        ValueError: If the range is outside the file.
+    """
+    unit, _, ranges = header.partition("=")
+    if unit.strip() != "bytes" or "," in ranges:
+        return None
+    first, _, last = ranges.strip().partition("-")
+    try:
+        if not first:
+            start, end = max(0, size - int(last)), size - 1  # The last bytes
+        else:
+            start, end = int(first), min(int(last) if last else size - 1, size - 1)
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        raise ValueError(f"Range {header!r} is outside a file of {size} bytes")
+    return start, end
+
+
+def file_url(name, base_url=None):
+    """Returns the file server URL of a stored file."""
+    base_url = base_url or FILES_URL or f"http://localhost:{FILES_PORT}"
+    return f"{base_url.rstrip('/')}/files/{quote(name)}"
+
+
+@contextlib.contextmanager
+def serve_while_growing(name, archive):
+    """
+    Lets the file server stream an archive to clients while it is still being written.
+
+    Args:
+        name (str): The archive's storage name.
+        archive (archive.StreamingZip): The archive. Requests for the name are answered
+            from its iter_bytes until the context exits.
+    """
+    with growing_archives_lock:
+        growing_archives[name] = archive
+    try:
+        yield
+    finally:
+        with growing_archives_lock:
+            growing_archives.pop(name, None)
+
+
+class FilesHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves stored downloads at /files/<name>, with support for Range requests.
+
+    Local files are sent with sendfile, straight from the page cache to the socket;
+    nothing is copied into another cache first. Archives that are still being written
+    (see serve_while_growing) are streamed as they grow, in a chunked response.
+    """
+
+    def do_HEAD(self):
+        self.serve(send_body=False)
+
+    def do_GET(self):
+        self.serve(send_body=True)
+
+    def serve(self, send_body):
+        storage = self.server.storage
+        path = urlsplit(self.path).path
+        if not path.startswith("/files/"):
+            self.send_error(404)
+            return
+        name = unquote(path[len("/files/") :])
+        with growing_archives_lock:
+            archive = growing_archives.get(name)
+        if archive is not None:
+            self.serve_growing(name, archive, send_body)
+            return
+        local_path = storage.local_path(name)
+        if not is_valid_name(name) or (local_path and not os.path.isfile(local_path)):
+            self.send_error(404)
+            return
+
+        if local_path is None:
+            url = storage.url(name)
+            if url:
+                self.send_response(302)
+                self.send_header("Location", url)
+                self.end_headers()
+                return
+        try:
+            size = storage.size(name)
+        except Exception:
+            self.send_error(404)
+            return
+
+        try:
+            byte_range = self.headers.get("Range")
+            byte_range = byte_range and parse_range(byte_range, size)
+        except ValueError:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.end_headers()
+            return
+        start, end = byte_range or (0, size - 1)
+        length = max(0, end - start + 1)
+
+        self.send_response(206 if byte_range else 200)
+        self.send_file_headers(name)
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        if byte_range:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        if not send_body or not length:
+            return
+
+        registry.inc("downloaddynamo_served_bytes_total", length)
+        if local_path:
+            with open(local_path, "rb") as stored_file:
+                self.wfile.flush()
+                self.connection.sendfile(stored_file, start, length)
+            return
+        body = storage.open_range(name, start, end)
+        try:
+            while True:
+                block = body.read(STREAM_BLOCK_SIZE)
+                if not block:
+                    break
+                self.wfile.write(block)
+        finally:
+            body.close()
+
+    def send_file_headers(self, name):
+        content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        self.send_header("Content-Type", content_type)
+        filename = quote(posixpath.basename(name))
+        self.send_header(
+            "Content-Disposition", f"attachment; filename*=UTF-8''{filename}"
+        )
+
+    def serve_growing(self, name, archive, send_body):
+        # The length isn't known yet, so the archive is sent in chunks as it grows. A
+        # failed job ends the connection before the last chunk, so the client sees a
+        # failed download rather than a truncated zip.
+        chunked = self.request_version == "HTTP/1.1"
+        if chunked:
+            self.protocol_version = "HTTP/1.1"
+        self.close_connection = True
+        self.send_response(200)
+        self.send_file_headers(name)
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        if not send_body:
+            return
+
+        try:
+            for chunk in archive.iter_bytes():
+                registry.inc("downloaddynamo_served_bytes_total", len(chunk))
+                if chunked:
+                    chunk = b"%x\r\n%s\r\n" % (len(chunk), chunk)
+                self.wfile.write(chunk)
+        except Exception as error:
+            logger.warning(f"Stopped streaming {name}: {error}")
+            return
+        if chunked:
+            self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, format, *args):
+        pass  # Downloads are counted in the metrics instead
+
+
+def start_file_server(storage, port=None, host=None):
+    """
+    Serves stored downloads on a background thread, see FilesHandler.
+
+    Args:
+        storage: The backend to serve, see get_storage.
+        port (int, optional): The port to listen on. Defaults to FILES_PORT.
+        host (str, optional): The address to listen on. Defaults to FILES_HOST.
+
+    Returns:
+        http.server.ThreadingHTTPServer: The running server, or None if the port is taken.
+    """
+    port = FILES_PORT if port is None else port
+    try:
+        server = http.server.ThreadingHTTPServer(
+            (host or FILES_HOST, port), FilesHandler
+        )
+    except OSError as error:
+        logger.warning(f"File server not started on port {port}: {error}")
+        return None
+    server.storage = storage
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
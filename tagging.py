@@ -0,0 +1,356 @@
+import base64
+import os
+import string
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import unshare_file
+from lazy import LazyModule
+
+# mutagen's format modules are imported on first use
+mutagen = LazyModule("mutagen")
+flac = LazyModule("mutagen.flac")
+id3 = LazyModule("mutagen.id3")
+mp4 = LazyModule("mutagen.mp4")
+
+# Bytes of padding reserved after a new tag, so edited tags can be rewritten in place
+TAG_PADDING = 64 * 1024
+
+# Number of files tagged at the same time by apply_tags; tagging mostly waits for disk
+TAG_WORKERS = 8
+
+# ID3 frames for each tag name
+ID3_FRAMES = {
+    "title": "TIT2",
+    "artist": "TPE1",
+    "album": "TALB",
+    "album_artist": "TPE2",
+    "release_year": "TDRC",
+    "genre": "TCON",
+    "track_number": "TRCK",
+}
+
+# MP4 atoms for each tag name; the track number is stored separately in "trkn"
+MP4_ATOMS = {
+    "title": "\xa9nam",
+    "artist": "\xa9ART",
+    "album": "\xa9alb",
+    "album_artist": "aART",
+    "release_year": "\xa9day",
+    "genre": "\xa9gen",
+}
+
+# Vorbis comment fields for each tag name, used by Ogg Opus, Ogg Vorbis and FLAC
+VORBIS_FIELDS = {
+    "title": "title",
+    "artist": "artist",
+    "album": "album",
+    "album_artist": "albumartist",
+    "release_year": "date",
+    "genre": "genre",
+    "track_number": "tracknumber",
+}
+
+
+def tag_padding(info):
+    """
+    Chooses the padding left after a tag when it is saved.
+
+    Args:
+        info (mutagen.PaddingInfo): The padding the tag would have if saved in place.
+
+    Returns:
+        int: The padding to use.
+    """
+    # Keep the tag in place while it fits, otherwise reserve room for later edits
+    if info.padding >= 0:
+        return info.padding
+    return TAG_PADDING
+
+
+def write_id3_tags(audio_file, tags, cover_art=None):
+    """Writes tags and album art to an MP3 file's ID3 tag in a single save."""
+    # Load the existing tag, or start a new one if the file has none
+    try:
+        audio_tags = id3.ID3(audio_file)
+    except id3.ID3NoHeaderError:
+        audio_tags = id3.ID3()
+
+    # Encoding 3 is UTF-8
+    for name, value in tags.items():
+        frame = getattr(id3, ID3_FRAMES[name])
+        audio_tags.setall(ID3_FRAMES[name], [frame(encoding=3, text=str(value))])
+
+    if cover_art:
+        audio_tags.setall(
+            "APIC",
+            [
+                id3.APIC(
+                    encoding=3,  # UTF-8
+                    mime="image/jpeg",  # Image MIME type
+                    type=3,  # Front cover
+                    desc="Cover",
+                    data=cover_art,
+                )
+            ],
+        )
+
+    audio_tags.save(audio_file, padding=tag_padding)
+
+
+def write_mp4_tags(audio_file, tags, cover_art=None):
+    """Writes tags and album art to an M4A file's metadata atoms in a single save."""
+    audio = mp4.MP4(audio_file)
+    if audio.tags is None:
+        audio.add_tags()
+
+    for name, value in tags.items():
+        if name == "track_number":
+            audio.tags["trkn"] = [(int(value), 0)]
+        else:
+            audio.tags[MP4_ATOMS[name]] = [str(value)]
+
+    if cover_art:
+        audio.tags["covr"] = [
+            mp4.MP4Cover(cover_art, imageformat=mp4.MP4Cover.FORMAT_JPEG)
+        ]
+
+    audio.save(padding=tag_padding)
+
+
+def cover_picture(cover_art):
+    """Wraps JPEG album art in a FLAC picture block, as used by Vorbis comments."""
+    picture = flac.Picture()
+    picture.type = 3  # Front cover
+    picture.mime = "image/jpeg"
+    picture.desc = "Cover"
+    picture.data = cover_art
+    return picture
+
+
+def write_vorbis_tags(audio_file, tags, cover_art=None):
+    """Writes tags and album art to an Ogg Opus or Ogg Vorbis file in a single save."""
+    audio = mutagen.File(audio_file)
+    if audio is None:
+        raise ValueError(f"Unsupported Ogg stream in {audio_file}")
+    if audio.tags is None:
+        audio.add_tags()
+
+    for name, value in tags.items():
+        audio.tags[VORBIS_FIELDS[name]] = [str(value)]
+
+    if cover_art:
+        # Ogg files carry pictures as base64-encoded FLAC picture blocks
+        audio.tags["metadata_block_picture"] = [
+            base64.b64encode(cover_picture(cover_art).write()).decode("ascii")
+        ]
+
+    audio.save(padding=tag_padding)
+
+
+def write_flac_tags(audio_file, tags, cover_art=None):
+    """Writes tags and album art to a FLAC file in a single save."""
+    audio = flac.FLAC(audio_file)
+    if audio.tags is None:
+        audio.add_tags()
+
+    for name, value in tags.items():
+        audio.tags[VORBIS_FIELDS[name]] = [str(value)]
+
+    if cover_art:
+        audio.clear_pictures()
+        audio.add_picture(cover_picture(cover_art))
+
+    audio.save(padding=tag_padding)
+
+
+# Tag writer for each supported file extension
+TAG_WRITERS = {
+    ".mp3": write_id3_tags,
+    ".m4a": write_mp4_tags,
+    ".opus": write_vorbis_tags,
+    ".ogg": write_vorbis_tags,
+    ".flac": write_flac_tags,
+}
+
+
+def write_tags(audio_file, tags, cover_art=None):
+    """
+    Writes tags and album art to an audio file, in the tag format of its container.
+
+    Args:
+        audio_file (str): The path to the audio file.
+        tags (dict): The tags to set: any of "title", "artist", "album", "album_artist",
+            "release_year", "genre" and "track_number". Tags that are None are left as
+            they are.
+        cover_art (bytes, optional): JPEG album art to attach. Defaults to None.
+
+    Raises:
+        ValueError: If the file's container is not supported.
+    """
+    extension = os.path.splitext(audio_file)[1].lower()
+    if extension not in TAG_WRITERS:
+        raise ValueError(f"Can't tag {extension} files")
+    tags = {name: value for name, value in tags.items() if value is not None}
+    # A file handed out by the media index shares its data with the stored copy
+    unshare_file(audio_file)
+    TAG_WRITERS[extension](audio_file, tags, cover_art)
+
+
+def set_track_number(audio_file, track_number):
+    """Rewrites the track number of a tagged audio file in place."""
+    write_tags(audio_file, {"track_number": track_number})
+
+
+def read_id3_tags(audio_file):
+    """Reads the tags of an MP3 file."""
+    try:
+        audio_tags = id3.ID3(audio_file)
+    except id3.ID3NoHeaderError:
+        return {}
+    return {
+        name: str(audio_tags[frame_id].text[0])
+        for name, frame_id in ID3_FRAMES.items()
+        if frame_id in audio_tags and audio_tags[frame_id].text
+    }
+
+
+def read_mp4_tags(audio_file):
+    """Reads the tags of an M4A file."""
+    audio_tags = mp4.MP4(audio_file).tags or {}
+    tags = {
+        name: str(audio_tags[atom][0])
+        for name, atom in MP4_ATOMS.items()
+        if audio_tags.get(atom)
+    }
+    if audio_tags.get("trkn"):
+        tags["track_number"] = str(audio_tags["trkn"][0][0])
+    return tags
+
+
+def read_vorbis_tags(audio_file):
+    """Reads the tags of an Ogg Opus, Ogg Vorbis or FLAC file."""
+    audio = mutagen.File(audio_file)
+    audio_tags = audio.tags if audio is not None and audio.tags is not None else {}
+    return {
+        name: audio_tags[field][0]
+        for name, field in VORBIS_FIELDS.items()
+        if audio_tags.get(field)
+    }
+
+
+# Tag reader for each supported file extension
+TAG_READERS = {
+    ".mp3": read_id3_tags,
+    ".m4a": read_mp4_tags,
+    ".opus": read_vorbis_tags,
+    ".ogg": read_vorbis_tags,
+    ".flac": read_vorbis_tags,
+}
+
+
+def read_tags(audio_file):
+    """
+    Reads the tags of an audio file, by the same names write_tags takes.
+
+    Args:
+        audio_file (str): The path to the audio file.
+
+    Returns:
+        dict: The tags that are set, as strings.
+
+    Raises:
+        ValueError: If the file's container is not supported.
+    """
+    extension = os.path.splitext(audio_file)[1].lower()
+    if extension not in TAG_READERS:
+        raise ValueError(f"Can't read tags of {extension} files")
+    return TAG_READERS[extension](audio_file)
+
+
+def is_template(value):
+    """Returns whether a tag value refers to other fields, e.g. "{artist} - {title}"."""
+    return isinstance(value, str) and any(
+        field is not None for _, field, _, _ in string.Formatter().parse(value)
+    )
+
+
+def check_template(value):
+    """
+    Makes sure a template only substitutes plain fields, like "{artist} - {title}".
+
+    Templates are typed into the interface, so format specs, conversions and attribute or
+    item lookups are refused: "{index:999999999}" would build a huge string, and
+    "{filename.__class__}" would reach into Python objects.
+
+    Raises:
+        ValueError: If the template uses anything but plain {field} substitutions.
+    """
+    for _, field, format_spec, conversion in string.Formatter().parse(value):
+        if field is None:
+            continue
+        if not field.isidentifier() or format_spec or conversion:
+            raise ValueError(f"Only plain {{field}} substitutions are allowed: {value}")
+
+
+def render_tags(audio_file, index, fields):
+    """Fills in the templates in fields for one file of apply_tags."""
+    if not any(is_template(value) for value in fields.values()):
+        return fields
+
+    # Templates can use the file's current tags, its name and its position in the batch
+    values = dict.fromkeys(ID3_FRAMES, "")
+    values.update(read_tags(audio_file))
+    values["index"] = index
+    values["filename"] = os.path.splitext(os.path.basename(audio_file))[0]
+    try:
+        return {
+            name: value.format_map(values) if is_template(value) else value
+            for name, value in fields.items()
+        }
+    except KeyError as error:
+        raise ValueError(f"Unknown template field {error}")
+
+
+def apply_tags(audio_files, fields, cover_art=None, workers=TAG_WORKERS):
+    """
+    Sets the same tags on many audio files at once, e.g. to fix a playlist's album artist.
+
+    Each file gets a single tag write, and files are tagged in parallel. A value can be a
+    template using the file's current tags and "{index}" (its 1-based position in
+    audio_files) or "{filename}" (its name without extension), e.g. "{artist} - {title}"
+    or "{index}" for the track number. Only plain {field} substitutions are allowed, see
+    check_template. A file that fails doesn't stop the others.
+
+    Args:
+        audio_files (list): The paths of the audio files.
+        fields (dict): The tags to set, by the names write_tags takes. Tags that are None
+            are left as they are.
+        cover_art (bytes, optional): JPEG album art to attach to every file.
+        workers (int, optional): The number of files tagged at the same time.
+
+    Returns:
+        list: A dictionary per file, in input order, with its "file", its "status"
+        ("ok" or "failed") and either the "tags" that were written or the "error".
+
+    Raises:
+        ValueError: If a tag is unknown or a template isn't allowed.
+    """
+    fields = {name: value for name, value in fields.items() if value is not None}
+    unknown = set(fields) - set(ID3_FRAMES)
+    if unknown:
+        raise ValueError(f"Unknown tags: {', '.join(sorted(unknown))}")
+    for value in fields.values():
+        if is_template(value):
+            check_template(value)
+
+    def tag_file(position):
+        index, audio_file = position
+        try:
+            tags = render_tags(audio_file, index, fields)
+            write_tags(audio_file, tags, cover_art)
+            return {"file": audio_file, "status": "ok", "tags": tags}
+        except Exception as error:
+            return {"file": audio_file, "status": "failed", "error": str(error)}
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return list(pool.map(tag_file, enumerate(audio_files, start=1)))
@@ -0,0 +1,31 @@
+import threading
+
+import pytest
+
+import cache
+import downloader
+import fakes
+import ratelimit
+import search
+
+
+@pytest.fixture
+def fake_youtube(tmp_path, monkeypatch):
+    """Routes downloader and search through the offline fakes and temporary directories."""
+    fakes.reset()
+    monkeypatch.setattr(downloader, "DOWNLOADS_DIR", str(tmp_path / "downloads"))
+    download_cache = cache.DownloadCache(str(tmp_path / "cache"))
+    info_cache = cache.InfoCache()
+    for module in (downloader, search):
+        monkeypatch.setattr(module, "download_cache", download_cache)
+        monkeypatch.setattr(module, "info_cache", info_cache)
+    monkeypatch.setattr(search, "audio_downloads", {})
+    monkeypatch.setattr(search, "thread_state", threading.local())
+    monkeypatch.setattr(downloader.yt_dlp, "YoutubeDL", fakes.FakeYoutubeDL)
+    monkeypatch.setattr(downloader, "transcode_audio", fakes.fake_transcode_audio)
+    # The fakes answer instantly, so there is nothing to throttle
+    unlimited = ratelimit.HostLimits(request_rate=1e6, request_burst=1e6)
+    for module in (ratelimit, downloader):
+        monkeypatch.setattr(module, "host_limits", unlimited)
+    yield fakes
+    fakes.reset()
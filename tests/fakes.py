@@ -0,0 +1,210 @@
+"""
+Offline stand-ins for yt-dlp and ffmpeg, so the download pipeline can be exercised
+without network access.
+"""
+
+import copy
+import os
+import struct
+
+from mutagen.id3 import ID3
+from mutagen.ogg import OggPage
+
+# Registered fake videos and playlists, keyed by URL
+VIDEOS = {}
+PLAYLISTS = {}
+SEARCHES = {}
+
+# URLs extracted, IDs of the videos downloaded and lazily read playlist entries so far,
+# in order
+EXTRACTED = []
+DOWNLOADED = []
+ENTRIES_READ = []
+OPEN_INSTANCES = set()
+
+
+def add_video(
+    video_id,
+    title,
+    uploader="Fake Artist",
+    upload_date="20240101",
+    ext="webm",
+    acodec=None,
+):
+    """Registers a fake video and returns its URL."""
+    url = f"https://www.youtube.com/watch?v={video_id}"
+    VIDEOS[url] = {
+        "id": video_id,
+        "title": title,
+        "uploader": uploader,
+        "upload_date": upload_date,
+        "thumbnail": None,
+        "ext": ext,
+        "acodec": acodec,
+        "webpage_url": url,
+    }
+    return url
+
+
+def add_playlist(playlist_id, title, video_urls):
+    """Registers a fake playlist of already registered videos and returns its URL."""
+    url = f"https://www.youtube.com/playlist?list={playlist_id}"
+    PLAYLISTS[url] = {
+        "id": playlist_id,
+        "title": title,
+        "entries": [
+            {
+                "url": video_url,
+                "id": VIDEOS[video_url]["id"],
+                "title": VIDEOS[video_url]["title"],
+            }
+            for video_url in video_urls
+        ],
+    }
+    return url
+
+
+def add_search(query, video_urls):
+    """Registers the results of a fake search for already registered videos."""
+    SEARCHES[query] = list(video_urls)
+
+
+def reset():
+    """Forgets every registered video and playlist."""
+    VIDEOS.clear()
+    PLAYLISTS.clear()
+    SEARCHES.clear()
+    EXTRACTED.clear()
+    DOWNLOADED.clear()
+    ENTRIES_READ.clear()
+    OPEN_INSTANCES.clear()
+
+
+def iter_entries(entries):
+    """Yields playlist entries one at a time, recording which ones were read."""
+    for entry in entries:
+        ENTRIES_READ.append(entry["id"])
+        yield dict(entry)
+
+
+class FakeYoutubeDL:
+    """A minimal yt_dlp.YoutubeDL replacement serving the registered fakes."""
+
+    def __init__(self, params=None):
+        self.params = params or {}
+        OPEN_INSTANCES.add(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
+
+    def close(self):
+        OPEN_INSTANCES.discard(self)
+
+    def extract_info(self, url, download=True, process=True, ie_key=None):
+        EXTRACTED.append(url)
+        if url in PLAYLISTS:
+            playlist = dict(PLAYLISTS[url])
+            if not process:
+                # Like yt-dlp, hand out the entries lazily as they are iterated
+                playlist["entries"] = iter_entries(playlist["entries"])
+            return playlist
+        if url.startswith("ytsearch"):
+            return self.search(url)
+        return self.process_ie_result(dict(VIDEOS[url]), download)
+
+    def search(self, url):
+        num_results, query = url[len("ytsearch") :].split(":", 1)
+        videos = [VIDEOS[video_url] for video_url in SEARCHES[query]]
+        videos = videos[: int(num_results)]
+        if self.params.get("extract_flat"):
+            entries = [
+                {
+                    "url": video["webpage_url"],
+                    "id": video["id"],
+                    "title": video["title"],
+                    "uploader": video["uploader"],
+                    "thumbnails": [
+                        {"url": f"https://i.ytimg.com/vi/{video['id']}.jpg"}
+                    ],
+                }
+                for video in videos
+            ]
+        else:
+            entries = [dict(video) for video in videos]
+        return {"id": query, "title": query, "entries": entries}
+
+    def process_ie_result(self, info_dict, download=True):
+        if self.params.get("merge_output_format"):
+            info_dict["ext"] = self.params["merge_output_format"]
+        if download:
+            DOWNLOADED.append(info_dict["id"])
+            source_file = self.prepare_filename(info_dict)
+            if info_dict["ext"] == "m4a":
+                write_fake_m4a(source_file)  # Taggable as downloaded
+            else:
+                with open(source_file, "wb") as source:
+                    source.write(b"fake audio stream for " + info_dict["id"].encode())
+        return info_dict
+
+    def urlopen(self, request):
+        raise NotImplementedError("The fakes make no requests")
+
+    def sanitize_info(self, info_dict):
+        return copy.deepcopy(info_dict)
+
+    def prepare_filename(self, info_dict):
+        outtmpl = self.params["outtmpl"]
+        if isinstance(outtmpl, dict):
+            outtmpl = outtmpl["default"]
+        return outtmpl % info_dict
+
+
+def atom(name, data):
+    """Builds an MP4 atom."""
+    return struct.pack(">I", 8 + len(data)) + name + data
+
+
+def write_fake_m4a(path):
+    """Writes the smallest M4A file mutagen accepts: one second of no audio."""
+    mvhd = atom(b"mvhd", bytes(4) + struct.pack(">IIII", 0, 0, 1000, 1000) + bytes(80))
+    mdhd = atom(b"mdhd", bytes(4) + struct.pack(">IIII", 0, 0, 44100, 44100) + bytes(4))
+    hdlr = atom(b"hdlr", bytes(8) + b"soun" + bytes(13))
+    trak = atom(b"trak", atom(b"mdia", mdhd + hdlr))
+    with open(path, "wb") as m4a:
+        m4a.write(atom(b"ftyp", b"M4A \0\0\0\0M4A isom"))
+        m4a.write(atom(b"moov", mvhd + trak))
+        m4a.write(atom(b"mdat", bytes(16)))
+
+
+def write_fake_opus(path):
+    """Writes the smallest Ogg Opus file mutagen accepts: headers and one audio packet."""
+    head = b"OpusHead" + struct.pack("<BBHIhB", 1, 2, 312, 48000, 0, 0)
+    tags = b"OpusTags" + struct.pack("<I", 4) + b"fake" + struct.pack("<I", 0)
+    packets = [(head, 0), (tags, 0), (b"\xfc" + bytes(20), 48000)]
+    with open(path, "wb") as opus:
+        for sequence, (packet, position) in enumerate(packets):
+            page = OggPage()
+            page.serial = 1
+            page.sequence = sequence
+            page.position = position
+            page.first = sequence == 0
+            page.last = sequence == len(packets) - 1
+            page.packets = [packet]
+            opus.write(page.write())
+
+
+def fake_transcode_audio(info_dict, source_file, audio_format="mp3"):
+    """Replaces ffmpeg: turns the source file into an empty MP3, or remuxes Opus."""
+    if audio_format == "native" and info_dict.get("acodec") == "opus":
+        audio_file = os.path.splitext(source_file)[0] + ".opus"
+        os.remove(source_file)
+        write_fake_opus(audio_file)
+        return audio_file
+    audio_file = os.path.splitext(source_file)[0] + ".mp3"
+    os.rename(source_file, audio_file)
+    ID3().save(audio_file)
+    return audio_file
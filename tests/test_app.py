@@ -0,0 +1,31 @@
+import os
+
+import app
+import downloader
+
+
+def make_output(name):
+    def download(progress_hook=None):
+        os.makedirs(downloader.DOWNLOADS_DIR, exist_ok=True)
+        path = os.path.join(downloader.DOWNLOADS_DIR, name)
+        with open(path, "wb") as output:
+            output.write(b"zip")
+        return path
+
+    return download
+
+
+def test_outputs_are_linked_or_handed_to_the_interface(fake_youtube, monkeypatch):
+    monkeypatch.setattr(app.storage, "FILES_URL", "https://files.example.com")
+
+    # Without a file server, Gradio serves the file itself
+    monkeypatch.setattr(app, "file_server", None)
+    link, path = app.link_output(make_output("playlist.zip"))()
+    assert link == "" and os.path.samefile(
+        path, os.path.join(downloader.DOWNLOADS_DIR, "playlist.zip")
+    )
+
+    monkeypatch.setattr(app, "file_server", object())
+    link, path = app.link_output(make_output("videos.zip"))()
+    assert link == "[videos.zip](https://files.example.com/files/videos.zip)"
+    assert path is None
@@ -0,0 +1,63 @@
+import io
+import threading
+import zipfile
+
+import pytest
+
+from archive import ArchiveDiscarded, StreamingZip, update_zip
+
+
+def test_streaming_zip_can_be_read_while_it_grows(tmp_path):
+    tracks = []
+    for i in range(3):
+        track = tmp_path / f"track{i}.mp3"
+        track.write_bytes(bytes([i]) * 5000)
+        tracks.append(track)
+
+    archive = StreamingZip(str(tmp_path / "playlist.zip"))
+    streamed = []
+    reader = threading.Thread(target=lambda: streamed.extend(archive.iter_bytes(1024)))
+    reader.start()
+    for track in tracks:
+        archive.add(str(track), remove=True)
+    archive.close()
+    reader.join(timeout=5)
+
+    data = b"".join(streamed)
+    assert data == (tmp_path / "playlist.zip").read_bytes()
+    with zipfile.ZipFile(io.BytesIO(data)) as zipf:
+        assert zipf.namelist() == ["track0.mp3", "track1.mp3", "track2.mp3"]
+        assert all(info.compress_type == zipfile.ZIP_STORED for info in zipf.infolist())
+        assert zipf.read("track2.mp3") == bytes([2]) * 5000
+    assert not any(track.exists() for track in tracks)
+
+
+def test_update_zip_appends_and_removes_members(tmp_path):
+    files = []
+    for name in ("a.mp3", "b.mp3", "c.mp3"):
+        path = tmp_path / name
+        path.write_bytes(name.encode() * 100)
+        files.append(str(path))
+    zip_path = str(tmp_path / "library.zip")
+
+    update_zip(zip_path, files[:2])
+    update_zip(zip_path, files[2:], remove_names=["a.mp3"])
+
+    with zipfile.ZipFile(zip_path) as zipf:
+        assert zipf.namelist() == ["b.mp3", "c.mp3"]
+        assert zipf.read("c.mp3") == b"c.mp3" * 100
+
+
+def test_discarded_streaming_zip_stops_its_readers(tmp_path):
+    track = tmp_path / "track.mp3"
+    track.write_bytes(b"x" * 5000)
+    archive = StreamingZip(str(tmp_path / "playlist.zip"))
+    archive.add(str(track))
+    chunks = archive.iter_bytes(1024)
+    assert next(chunks)
+
+    archive.discard()
+
+    with pytest.raises(ArchiveDiscarded):
+        list(chunks)
+    assert not (tmp_path / "playlist.zip").exists()
@@ -0,0 +1,32 @@
+import importlib.util
+import os
+
+BENCHMARK_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(__file__)), "benchmarks", "run.py"
+)
+
+
+def load_benchmarks():
+    spec = importlib.util.spec_from_file_location("benchmarks_run", BENCHMARK_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_playlist_benchmark_reports_every_stage():
+    benchmarks = load_benchmarks()
+    options = {
+        "tracks": 3,
+        "track_bytes": 50000,
+        "bandwidth": 0,
+        "download_workers": 2,
+        "postprocess_workers": 2,
+        "ffmpeg": False,
+    }
+
+    result = benchmarks.run_scenario("playlist", options)
+
+    assert result["tracks"] == 3
+    for stage in ("download", "thumbnail", "cover_art", "transcode", "tag", "zip"):
+        assert result["stages"][stage]["calls"] == 3
+    assert result["peak_disk_bytes"] >= result["final_disk_bytes"] > 0
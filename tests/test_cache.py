@@ -0,0 +1,170 @@
+import copy
+import threading
+import time
+
+import yt_dlp
+
+from cache import DownloadCache, InfoCache
+
+
+def test_least_recently_used_files_are_evicted(tmp_path):
+    download_cache = DownloadCache(str(tmp_path / "cache"), max_bytes=250)
+    for video_id in ("a", "b", "c"):
+        source = tmp_path / f"{video_id}.mp3"
+        source.write_bytes(b"x" * 100)
+        download_cache.put(video_id, "mp3", "192", str(source))
+        # Touch "a" so "b" becomes the least recently used entry
+        download_cache.get("a", "mp3", "192", str(tmp_path / "out.mp3"))
+
+    assert download_cache.get("b", "mp3", "192", str(tmp_path / "b-out.mp3")) is False
+    assert download_cache.get("a", "mp3", "192", str(tmp_path / "a-out.mp3")) is True
+    assert download_cache.stats()["entries"] == 2
+
+    # The index survives a restart
+    reopened = DownloadCache(str(tmp_path / "cache"), max_bytes=250)
+    assert reopened.get("c", "mp3", "192", str(tmp_path / "c-out.mp3")) is True
+    assert reopened.stats() == {"hits": 1, "misses": 0, "entries": 2, "bytes": 200}
+
+
+class CountingYoutubeDL:
+    def __init__(self, params=None):
+        self.params = params or {}
+        self.calls = 0
+
+    def extract_info(self, url, download=True):
+        self.calls += 1
+        return {"id": url[-3:], "title": "Video"}
+
+    def sanitize_info(self, info_dict):
+        return info_dict
+
+
+def test_info_cache_expires_and_persists(tmp_path):
+    ydl = CountingYoutubeDL()
+    info_cache = InfoCache(ttl=60, directory=str(tmp_path / "info"))
+
+    first = info_cache.extract_info(ydl, "https://youtu.be/abc")
+    first["title"] = "Changed by the caller"
+    assert info_cache.extract_info(ydl, "https://youtu.be/abc")["title"] == "Video"
+    assert ydl.calls == 1
+
+    # A new process reads the result back from disk
+    assert InfoCache(ttl=60, directory=str(tmp_path / "info")).extract_info(
+        ydl, "https://youtu.be/abc"
+    ) == {"id": "abc", "title": "Video"}
+    assert ydl.calls == 1
+
+    expired = InfoCache(ttl=-1)
+    expired.extract_info(ydl, "https://youtu.be/abc")
+    expired.extract_info(ydl, "https://youtu.be/abc")
+    assert ydl.calls == 3
+
+
+def test_info_cache_evicts_old_entries_and_expired_files(tmp_path):
+    ydl = CountingYoutubeDL()
+    info_cache = InfoCache(ttl=60, max_entries=4)
+    for video_id in ("aaa", "bbb", "aaa", "ccc"):
+        info_cache.extract_info(ydl, f"https://youtu.be/{video_id}")
+
+    # "bbb" was the least recently used entry, so it is extracted again
+    assert len(info_cache._entries) == 4
+    info_cache.extract_info(ydl, "https://youtu.be/aaa")
+    assert ydl.calls == 3
+    info_cache.extract_info(ydl, "https://youtu.be/bbb")
+    assert ydl.calls == 4
+
+    expired = InfoCache(ttl=-1, directory=str(tmp_path / "info"))
+    expired.extract_info(ydl, "https://youtu.be/abc")
+    assert len(list((tmp_path / "info").iterdir())) == 2
+
+    # Looking up an expired result deletes it from memory and disk
+    assert expired._lookup(("https://youtu.be/abc", True)) is None
+    assert len(list((tmp_path / "info").iterdir())) == 1
+    assert len(expired._entries) == 1
+
+
+class SlowYoutubeDL(CountingYoutubeDL):
+    def extract_info(self, url, download=True):
+        time.sleep(0.2)
+        return super().extract_info(url, download)
+
+
+def test_info_cache_shares_concurrent_extractions():
+    ydl = SlowYoutubeDL()
+    info_cache = InfoCache(ttl=60)
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(
+                info_cache.extract_info(ydl, "https://youtu.be/abc")
+            )
+        )
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert ydl.calls == 1
+    assert results == [{"id": "abc", "title": "Video"}] * 4
+    assert (info_cache.hits, info_cache.misses) == (3, 1)
+
+
+# A video with separate video and audio streams, as YouTube extracts them
+VIDEO_FORMATS = {
+    "id": "abcdefghijk",
+    "title": "Video",
+    "extractor": "youtube",
+    "extractor_key": "Youtube",
+    "webpage_url": "https://www.youtube.com/watch?v=abcdefghijk",
+    "formats": [
+        {
+            "format_id": "251",
+            "url": "https://example.com/251",
+            "ext": "webm",
+            "acodec": "opus",
+            "vcodec": "none",
+            "abr": 130,
+        },
+        {
+            "format_id": "137",
+            "url": "https://example.com/137",
+            "ext": "mp4",
+            "acodec": "none",
+            "vcodec": "avc1",
+            "height": 1080,
+        },
+    ],
+}
+
+
+class SelectingYoutubeDL(yt_dlp.YoutubeDL):
+    # Extracts VIDEO_FORMATS offline, selecting formats like a real extraction does
+    def extract_info(self, url, download=True, **kwargs):
+        return self.process_ie_result(copy.deepcopy(VIDEO_FORMATS), download=False)
+
+
+def test_info_cache_results_are_selected_per_format():
+    info_cache = InfoCache(ttl=60)
+    url = VIDEO_FORMATS["webpage_url"]
+    video_ydl = SelectingYoutubeDL({"quiet": True, "format": "bestvideo+bestaudio"})
+    audio_ydl = SelectingYoutubeDL({"quiet": True, "format": "bestaudio/best"})
+
+    video = video_ydl.process_ie_result(
+        info_cache.extract_info(video_ydl, url), download=False
+    )
+    assert [f["format_id"] for f in video["requested_formats"]] == ["137", "251"]
+
+    # The audio download reuses the extraction, but not the video's streams
+    audio = audio_ydl.process_ie_result(
+        info_cache.extract_info(audio_ydl, url), download=False
+    )
+    assert info_cache.hits == 1
+    assert "requested_formats" not in audio
+    assert (audio["format_id"], audio["url"]) == ("251", "https://example.com/251")
+
+    video = video_ydl.process_ie_result(
+        info_cache.extract_info(video_ydl, url), download=False
+    )
+    assert [f["format_id"] for f in video["requested_formats"]] == ["137", "251"]
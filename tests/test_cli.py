@@ -0,0 +1,30 @@
+import json
+
+import cli
+
+
+def test_batch_writes_a_manifest_and_isolates_failures(fake_youtube, tmp_path):
+    single = fake_youtube.add_video("single", "Single Song")
+    playlist = fake_youtube.add_playlist(
+        "batch",
+        "Batch Playlist",
+        [fake_youtube.add_video(f"track{n}", f"Track {n}") for n in range(2)],
+    )
+    url_file = tmp_path / "urls.txt"
+    url_file.write_text(
+        f"# Nightly batch\n{single}\n\n{playlist}  # the playlist\n"
+        "https://www.youtube.com/watch?v=missing\n"
+    )
+    manifest_path = tmp_path / "results.json"
+
+    exit_code = cli.main(
+        ["--input", str(url_file), "--workers", "2", "--manifest", str(manifest_path)]
+    )
+
+    manifest = json.loads(manifest_path.read_text())
+    assert exit_code == 1
+    assert (manifest["done"], manifest["failed"]) == (2, 1)
+    first, second, third = manifest["results"]
+    assert first["url"] == single and first["output"].endswith("Single Song.mp3")
+    assert second["url"] == playlist and second["output"].endswith(".zip")
+    assert third["status"] == "failed" and third["error"]
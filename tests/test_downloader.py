@@ -1,5 +1,28 @@
+import os
+import threading
+import zipfile
+from io import BytesIO
+
 import pytest
-from downloader import download_audio_and_metadata
+from mutagen.easyid3 import EasyID3
+from mutagen.id3 import ID3
+from mutagen.mp4 import MP4
+from mutagen.oggopus import OggOpus
+from PIL import Image
+from yt_dlp.utils import DownloadCancelled
+
+import downloader
+import manifest
+import storage
+from downloader import (
+    add_metadata,
+    download_audio_and_metadata,
+    prepare_cover_art,
+    process_playlist,
+    publish_output,
+    sync_playlist,
+    video_pipeline,
+)
 
 
 def test_downloader_audio():
@@ -7,7 +30,7 @@ def test_downloader_audio():
     result1 = download_audio_and_metadata(url1)
     expected_result1 = (
         "downloads\\Rick Astley  Never Gonna Give You Up Official Music Video.mp3",
-        "downloads\\thumbnail.jpg",
+        "downloads\\Rick Astley  Never Gonna Give You Up Official Music Video.jpg",
         "Rick Astley - Never Gonna Give You Up (Official Music Video)",
         "Rick Astley",
         "Rick Astley - Never Gonna Give You Up (Official Music Video)",
@@ -21,7 +44,7 @@ def test_downloader_audio():
     result2 = download_audio_and_metadata(url2)
     expected_result2 = (
         "downloads\\Sorting Pebbles Into Correct Heaps  A Short Story By Eliezer Yudkowsky.mp3",
-        "downloads\\thumbnail.jpg",
+        "downloads\\Sorting Pebbles Into Correct Heaps  A Short Story By Eliezer Yudkowsky.jpg",
         "Sorting Pebbles Into Correct Heaps - A Short Story By Eliezer Yudkowsky",
         "Rational Animations",
         "Sorting Pebbles Into Correct Heaps - A Short Story By Eliezer Yudkowsky",
@@ -35,7 +58,7 @@ def test_downloader_audio():
     result3 = download_audio_and_metadata(url3)
     expected_result3 = (
         "downloads\\Charter Cities.mp3",
-        "downloads\\thumbnail.jpg",
+        "downloads\\Charter Cities.jpg",
         "Charter Cities",
         "Epic Mountain",
         "Charter Cities",
@@ -44,3 +67,456 @@ def test_downloader_audio():
         "",
     )
     assert result3 == expected_result3
+
+
+def test_process_playlist_parallel_keeps_track_order(fake_youtube):
+    video_urls = [
+        fake_youtube.add_video(f"vid{i}", f"Song {i}", uploader="Band")
+        for i in range(1, 7)
+    ]
+    playlist_url = fake_youtube.add_playlist("pl1", "Fake Album", video_urls)
+
+    zip_filename = process_playlist(
+        playlist_url, download_workers=3, postprocess_workers=2, keep_files=True
+    )
+
+    with zipfile.ZipFile(zip_filename) as zipf:
+        names = zipf.namelist()
+    assert names == [f"Song {i}.mp3" for i in range(1, 7)]
+
+    downloads_dir = os.path.dirname(zip_filename)
+    for track_number, name in enumerate(names, start=1):
+        tags = EasyID3(os.path.join(downloads_dir, name))
+        assert tags["tracknumber"] == [str(track_number)]
+        assert tags["album"] == ["Fake Album"]
+
+
+def test_playlist_zip_can_be_served_while_it_grows(fake_youtube):
+    video_urls = [fake_youtube.add_video(f"grow{i}", f"Song {i}") for i in (1, 2)]
+    playlist_url = fake_youtube.add_playlist("pl-grow", "Growing", video_urls)
+    served = []
+
+    def progress_hook(progress):
+        if progress["status"] == "archive_started":
+            served.append(storage.growing_archives.get(progress["name"]))
+
+    zip_filename = process_playlist(playlist_url, progress_hook=progress_hook)
+
+    assert len(served) == 1 and served[0].path == zip_filename
+    assert storage.growing_archives == {}
+
+
+def test_same_titles_get_unique_files(fake_youtube):
+    video_urls = [
+        fake_youtube.add_video("first", "Same Song"),
+        fake_youtube.add_video("second", "Same Song"),
+    ]
+    playlist_url = fake_youtube.add_playlist("pl2", "Duplicates", video_urls)
+
+    zip_filename = process_playlist(playlist_url, download_workers=2)
+
+    with zipfile.ZipFile(zip_filename) as zipf:
+        assert sorted(zipf.namelist()) == ["Same Song (2).mp3", "Same Song.mp3"]
+    # No job state is left behind
+    assert os.listdir(os.path.join(os.path.dirname(zip_filename), ".jobs")) == []
+
+
+def test_interrupted_playlist_resumes_from_manifest(fake_youtube, monkeypatch):
+    video_urls = [fake_youtube.add_video(f"res{i}", f"Track {i}") for i in (1, 2, 3)]
+    playlist_url = fake_youtube.add_playlist("pl4", "Resumed", video_urls)
+
+    def cancel_on_second_track(info_dict, source_file, audio_format="mp3"):
+        if info_dict["id"] == "res2":
+            raise DownloadCancelled("job cancelled")
+        return fake_youtube.fake_transcode_audio(info_dict, source_file, audio_format)
+
+    monkeypatch.setattr(downloader, "transcode_audio", cancel_on_second_track)
+    with pytest.raises(DownloadCancelled):
+        process_playlist(playlist_url, download_workers=1, postprocess_workers=1)
+    downloads_dir = downloader.DOWNLOADS_DIR
+    # The incomplete zip is removed, and the zipped track was released right away
+    assert not any(name.endswith(".zip") for name in os.listdir(downloads_dir))
+    assert not os.path.exists(os.path.join(downloads_dir, "Track 1.mp3"))
+
+    monkeypatch.setattr(
+        downloader, "transcode_audio", fake_youtube.fake_transcode_audio
+    )
+    fake_youtube.DOWNLOADED.clear()
+    zip_filename = process_playlist(playlist_url, download_workers=1)
+
+    assert "res1" not in fake_youtube.DOWNLOADED
+    with zipfile.ZipFile(zip_filename) as zipf:
+        assert zipf.namelist() == ["Track 1.mp3", "Track 2.mp3", "Track 3.mp3"]
+    assert not os.path.exists(os.path.join(downloads_dir, "Track 1.mp3"))
+    assert os.listdir(os.path.join(downloads_dir, ".jobs")) == []
+
+
+def test_failed_playlist_track_is_skipped_and_retried(fake_youtube, monkeypatch):
+    video_urls = [fake_youtube.add_video(f"skip{i}", f"Skip {i}") for i in (1, 2, 3)]
+    playlist_url = fake_youtube.add_playlist("pl7", "Skipped", video_urls)
+    events = []
+
+    def fail_second_track(info_dict, source_file, audio_format="mp3"):
+        if info_dict["id"] == "skip2":
+            raise RuntimeError("unavailable")
+        return fake_youtube.fake_transcode_audio(info_dict, source_file, audio_format)
+
+    monkeypatch.setattr(downloader, "transcode_audio", fail_second_track)
+    zip_filename = process_playlist(
+        playlist_url, progress_hook=events.append, download_workers=1
+    )
+
+    with zipfile.ZipFile(zip_filename) as zipf:
+        assert zipf.namelist() == ["Skip 1.mp3", "Skip 3.mp3"]
+    failed = [event for event in events if event.get("status") == "track_failed"]
+    assert [(event["track_number"], event["error"]) for event in failed] == [
+        (2, "unavailable")
+    ]
+    # The manifest is kept, so running the job again fills in the missing track
+    monkeypatch.setattr(
+        downloader, "transcode_audio", fake_youtube.fake_transcode_audio
+    )
+    zip_filename = process_playlist(playlist_url, download_workers=1)
+    with zipfile.ZipFile(zip_filename) as zipf:
+        assert zipf.namelist() == ["Skip 1.mp3", "Skip 2.mp3", "Skip 3.mp3"]
+    jobs_dir = os.path.join(downloader.DOWNLOADS_DIR, ".jobs")
+    assert os.listdir(jobs_dir) == []
+
+
+def test_failed_tracks_are_skipped_by_sync_and_video_playlists(
+    fake_youtube, monkeypatch
+):
+    video_urls = [fake_youtube.add_video(f"iso{i}", f"Isolated {i}") for i in (1, 2)]
+    playlist_url = fake_youtube.add_playlist("pl8", "Isolated", video_urls)
+    events = []
+
+    def fail_first_track(info_dict, source_file, audio_format="mp3"):
+        if info_dict["id"] == "iso1":
+            raise RuntimeError("unavailable")
+        return fake_youtube.fake_transcode_audio(info_dict, source_file, audio_format)
+
+    monkeypatch.setattr(downloader, "transcode_audio", fail_first_track)
+    zip_filename = sync_playlist(playlist_url, progress_hook=events.append)
+    with zipfile.ZipFile(zip_filename) as zipf:
+        assert zipf.namelist() == ["Isolated 2.mp3"]
+
+    # The next sync fills in the track that failed
+    monkeypatch.setattr(
+        downloader, "transcode_audio", fake_youtube.fake_transcode_audio
+    )
+    sync_playlist(playlist_url)
+    with zipfile.ZipFile(zip_filename) as zipf:
+        assert sorted(zipf.namelist()) == ["Isolated 1.mp3", "Isolated 2.mp3"]
+
+    download_video = downloader.download_video
+
+    def fail_second_video(video_url, progress_hook=None, work_dir=None):
+        if video_url == video_urls[1]:
+            raise RuntimeError("unavailable")
+        return download_video(video_url, progress_hook, work_dir)
+
+    monkeypatch.setattr(downloader, "download_video", fail_second_video)
+    zip_filename = downloader.process_video_playlist(
+        playlist_url, progress_hook=events.append
+    )
+    with zipfile.ZipFile(zip_filename) as zipf:
+        assert zipf.namelist() == ["Isolated 1.mp4"]
+
+    failed = [event for event in events if event.get("status") == "track_failed"]
+    assert [(event["track_number"], event["tracks"]) for event in failed] == [
+        (1, 2),
+        (2, 2),
+    ]
+
+
+def test_concurrent_jobs_for_one_playlist_take_turns(fake_youtube, monkeypatch):
+    monkeypatch.setattr(manifest, "LOCK_POLL_INTERVAL", 0.01)
+    video_urls = [fake_youtube.add_video(f"turn{i}", f"Turn {i}") for i in (1, 2, 3)]
+    playlist_url = fake_youtube.add_playlist("pl10", "Turns", video_urls)
+    zip_filenames = []
+
+    threads = [
+        threading.Thread(
+            target=lambda: zip_filenames.append(process_playlist(playlist_url))
+        )
+        for _ in range(2)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Each job gets a complete zip, and neither deletes the other's files
+    assert len(zip_filenames) == 2
+    for zip_filename in zip_filenames:
+        with zipfile.ZipFile(zip_filename) as zipf:
+            assert zipf.namelist() == ["Turn 1.mp3", "Turn 2.mp3", "Turn 3.mp3"]
+    assert os.listdir(os.path.join(downloader.DOWNLOADS_DIR, ".jobs")) == []
+
+
+def test_playlist_entries_are_read_and_processed_in_a_bounded_window(
+    fake_youtube, monkeypatch
+):
+    monkeypatch.setattr(downloader, "PLAYLIST_PAGE_SIZE", 4)
+    video_urls = [fake_youtube.add_video(f"long{i}", f"Long {i}") for i in range(12)]
+    playlist_url = fake_youtube.add_playlist("pl6", "Long Playlist", video_urls)
+    in_flight, read_ahead, remembered, tracks = [], [], [], []
+    manifests = []
+
+    class RecordingManifest(manifest.PlaylistManifest):
+        def __init__(self, *args):
+            super().__init__(*args)
+            manifests.append(self)
+
+    monkeypatch.setattr(downloader, "PlaylistManifest", RecordingManifest)
+
+    def track_done(progress):
+        if progress.get("status") == "track_done":
+            zipped = progress["track_number"]
+            in_flight.append(len(fake_youtube.DOWNLOADED) - zipped)
+            read_ahead.append(len(fake_youtube.ENTRIES_READ) - zipped)
+            remembered.append(len(manifests[0].entries))
+            tracks.append(progress["tracks"])
+            # Every zipped track is removed right away
+            assert not os.path.exists(
+                os.path.join(downloader.DOWNLOADS_DIR, progress["filename"])
+            )
+
+    zip_filename = process_playlist(
+        playlist_url, download_workers=2, progress_hook=track_done, window=3
+    )
+
+    with zipfile.ZipFile(zip_filename) as zipf:
+        assert zipf.namelist() == [f"Long {i}.mp3" for i in range(12)]
+    assert len(in_flight) == 12 and max(in_flight) <= 3
+    assert max(read_ahead) <= 3 + 4  # The window plus one page of entries
+    # Zipped tracks are forgotten, so the manifest holds no more than what was read ahead
+    assert max(remembered) <= 3 + 4
+    # The playlist doesn't tell its length, so it is counted as the entries are read
+    assert tracks[0] >= 4 and tracks[-1] == 12
+    assert fake_youtube.OPEN_INSTANCES == set()
+
+
+def test_sync_playlist_only_downloads_changes(fake_youtube):
+    video_urls = [fake_youtube.add_video(f"sync{i}", f"Daily {i}") for i in range(1, 5)]
+    playlist_url = fake_youtube.add_playlist("pl5", "Daily Mix", video_urls[:3])
+
+    zip_filename = sync_playlist(playlist_url)
+    with zipfile.ZipFile(zip_filename) as zipf:
+        assert zipf.namelist() == ["Daily 1.mp3", "Daily 2.mp3", "Daily 3.mp3"]
+
+    # The first video leaves the playlist and a new one is added
+    fake_youtube.add_playlist("pl5", "Daily Mix", video_urls[1:])
+    downloader.info_cache.clear()
+    fake_youtube.DOWNLOADED.clear()
+    events = []
+    assert (
+        sync_playlist(playlist_url, prune=True, progress_hook=events.append)
+        == zip_filename
+    )
+
+    assert fake_youtube.DOWNLOADED == ["sync4"]
+    # Progress reports the new track's position in the playlist
+    done = [event for event in events if event.get("status") == "track_done"]
+    assert [(event["track_number"], event["tracks"]) for event in done] == [(3, 3)]
+    with zipfile.ZipFile(zip_filename) as zipf:
+        assert sorted(zipf.namelist()) == ["Daily 2.mp3", "Daily 3.mp3", "Daily 4.mp3"]
+        # Tracks that moved up are renumbered, in the library and in the zip
+        tags = ID3(BytesIO(zipf.read("Daily 2.mp3")))
+    assert tags["TRCK"].text == ["1"]
+    library_dir = os.path.dirname(zip_filename)
+    assert not os.path.exists(os.path.join(library_dir, "Daily 1.mp3"))
+    assert EasyID3(os.path.join(library_dir, "Daily 4.mp3"))["tracknumber"] == ["3"]
+
+
+def test_sync_playlist_repairs_a_zip_left_behind_by_a_failed_sync(
+    fake_youtube, monkeypatch
+):
+    video_urls = [fake_youtube.add_video(f"rep{i}", f"Repair {i}") for i in (1, 2, 3)]
+    playlist_url = fake_youtube.add_playlist("pl9", "Repair", video_urls[:2])
+    zip_filename = sync_playlist(playlist_url)
+
+    # The library takes the new track, but the zip update fails
+    fake_youtube.add_playlist("pl9", "Repair", video_urls)
+    downloader.info_cache.clear()
+
+    update_zip = downloader.update_zip
+
+    def broken_update_zip(*args):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(downloader, "update_zip", broken_update_zip)
+    with pytest.raises(OSError):
+        sync_playlist(playlist_url)
+    monkeypatch.setattr(downloader, "update_zip", update_zip)
+
+    # Nothing is new to the library, but the zip is brought in line with it
+    fake_youtube.DOWNLOADED.clear()
+    sync_playlist(playlist_url)
+    assert fake_youtube.DOWNLOADED == []
+    with zipfile.ZipFile(zip_filename) as zipf:
+        assert zipf.namelist() == ["Repair 1.mp3", "Repair 2.mp3", "Repair 3.mp3"]
+
+
+def test_native_format_keeps_source_codec(fake_youtube, monkeypatch):
+    opus_url = fake_youtube.add_video("nat1", "Opus Song", acodec="opus")
+    aac_url = fake_youtube.add_video("nat2", "AAC Song", ext="m4a", acodec="mp4a.40.2")
+    transcoded = []
+
+    def recording_transcode(info_dict, source_file, audio_format="mp3"):
+        transcoded.append(info_dict["id"])
+        return fake_youtube.fake_transcode_audio(info_dict, source_file, audio_format)
+
+    monkeypatch.setattr(downloader, "transcode_audio", recording_transcode)
+
+    opus_file = download_audio_and_metadata(
+        opus_url, album="Native", audio_format="native"
+    )[0]
+    aac_file = download_audio_and_metadata(
+        aac_url, track_number=2, album="Native", audio_format="native"
+    )[0]
+
+    # AAC is already in a taggable container, so ffmpeg isn't needed at all
+    assert transcoded == ["nat1"]
+    assert opus_file.endswith("Opus Song.opus")
+    assert OggOpus(opus_file).tags["album"] == ["Native"]
+    assert aac_file.endswith("AAC Song.m4a")
+    tags = MP4(aac_file).tags
+    assert tags["\xa9nam"] == ["AAC Song"]
+    assert tags["trkn"] == [(2, 0)]
+
+
+def test_native_format_rejects_unknown_codecs():
+    assert downloader.output_extension({"acodec": "vorbis"}, "native") == "ogg"
+    assert downloader.output_extension({"acodec": "ec-3"}, "mp3") == "mp3"
+    with pytest.raises(ValueError):
+        downloader.output_extension({"acodec": "ec-3"}, "native")
+
+
+def test_repeated_download_is_served_from_cache(fake_youtube):
+    url = fake_youtube.add_video("cached", "Popular Song")
+
+    first = download_audio_and_metadata(url, album="First")
+    second = download_audio_and_metadata(url, album="Second")
+
+    assert fake_youtube.DOWNLOADED == ["cached"]
+    assert downloader.download_cache.stats()["hits"] == 1
+    assert EasyID3(first[0])["album"] == ["First"]
+    assert EasyID3(second[0])["album"] == ["Second"]
+
+
+def test_same_video_from_another_url_is_stored_once(fake_youtube):
+    url = fake_youtube.add_video("stored", "Stored Song")
+    music_url = "https://music.youtube.com/watch?v=stored"
+    fake_youtube.VIDEOS[music_url] = dict(fake_youtube.VIDEOS[url])
+
+    first = download_audio_and_metadata(url)
+    second = download_audio_and_metadata(music_url)
+
+    # Each caller gets its own copy of the one stored file
+    assert second[1:] == first[1:]
+    assert os.path.basename(second[0]) == "Stored Song (2).mp3"
+    assert os.path.samefile(second[0], first[0])
+    assert fake_youtube.DOWNLOADED == ["stored"]
+    stored_dir = os.path.join(downloader.DOWNLOADS_DIR, ".media")
+    assert os.listdir(stored_dir) == ["Stored Song.mp3"]
+
+
+def test_stored_audio_is_found_without_extracting(fake_youtube):
+    url = fake_youtube.add_video("dQw4w9WgXcQ", "Known Song")
+    first = download_audio_and_metadata(url, album="Mine")
+    downloader.info_cache.clear()
+    fake_youtube.EXTRACTED.clear()
+
+    second = download_audio_and_metadata(url, album="Mine")
+
+    # The video ID is read from the URL, so nothing is extracted
+    assert fake_youtube.EXTRACTED == []
+    assert second[1:] == first[1:]
+
+    # Retagging one caller's copy leaves the other's alone
+    add_metadata(second[0], "Edited", "Artist", "Mine", "Artist", "2024", "", None)
+    assert EasyID3(first[0])["title"] == ["Known Song"]
+
+
+def test_different_songs_with_the_same_title_are_both_kept(fake_youtube):
+    first = download_audio_and_metadata(fake_youtube.add_video("one", "Same Title"))
+    second = download_audio_and_metadata(fake_youtube.add_video("two", "Same Title"))
+
+    assert os.path.basename(first[0]) == "Same Title.mp3"
+    assert os.path.basename(second[0]) == "Same Title (2).mp3"
+    assert os.path.exists(first[0]) and os.path.exists(second[0])
+
+
+def test_video_pipeline_extracts_each_url_once(fake_youtube):
+    video_urls = [fake_youtube.add_video(f"clip{i}", f"Clip {i}") for i in (1, 2)]
+    playlist_url = fake_youtube.add_playlist("pl3", "Clips", video_urls)
+
+    zip_filename = video_pipeline(playlist_url)
+
+    with zipfile.ZipFile(zip_filename) as zipf:
+        assert zipf.namelist() == ["Clip 1.mp4", "Clip 2.mp4"]
+    assert fake_youtube.EXTRACTED == [playlist_url, *video_urls]
+
+
+def test_add_metadata_rewrites_tags_in_place(tmp_path):
+    audio_file = str(tmp_path / "song.mp3")
+    with open(audio_file, "wb") as audio:
+        audio.write(b"\xff\xfb" + b"\x00" * 4096)  # Stand-in for MPEG audio frames
+    thumbnail_file = str(tmp_path / "cover.jpg")
+    with open(thumbnail_file, "wb") as thumbnail:
+        thumbnail.write(b"\xff\xd8cover")
+
+    add_metadata(
+        audio_file, "Song", "Artist", "Album", "Artist", "2024", "", thumbnail_file, 7
+    )
+    size = os.path.getsize(audio_file)
+    add_metadata(
+        audio_file, "Song", "Artist", "New Album", "Artist", "2024", "Pop", None
+    )
+
+    assert os.path.getsize(audio_file) == size
+    tags = ID3(audio_file)
+    assert str(tags["TALB"]) == "New Album"
+    assert str(tags["TCON"]) == "Pop"
+    assert str(tags["TRCK"]) == "7"
+    assert tags.getall("APIC")[0].data == b"\xff\xd8cover"
+
+
+def test_prepare_cover_art_produces_small_square_jpeg():
+    source = BytesIO()
+    Image.new("RGBA", (1280, 720), (255, 0, 0, 128)).save(source, format="PNG")
+
+    cover_art = prepare_cover_art(source.getvalue(), square=True, max_size=300)
+
+    img = Image.open(BytesIO(cover_art))
+    assert img.format == "JPEG"
+    assert img.size == (300, 300)
+
+
+def test_published_downloads_are_removed_after_the_retention(fake_youtube, monkeypatch):
+    video_urls = [fake_youtube.add_video(f"old{i}", f"Old {i}") for i in (1, 2)]
+    playlist_url = fake_youtube.add_playlist("pl12", "Old", video_urls)
+    downloads = downloader.DOWNLOADS_DIR
+
+    # Without a retention nothing is recorded or removed
+    kept_zip = publish_output(process_playlist(playlist_url))
+    assert downloader.prune_outputs(max_age=-1) == 0
+
+    monkeypatch.setattr(downloader, "OUTPUT_RETENTION", 60)
+    zip_names = [publish_output(process_playlist(playlist_url)) for _ in range(2)]
+    library_zip = sync_playlist(playlist_url)
+    publish_output(library_zip)
+    assert zip_names == ["playlist (2).zip", "playlist (3).zip"]
+    mine = os.path.join(downloads, "mine.mp3")
+    with open(mine, "wb") as user_file:
+        user_file.write(b"not from this app")
+
+    # Recent downloads are kept
+    assert downloader.prune_outputs() == 0
+    assert downloader.prune_outputs(max_age=-1) == 2
+
+    assert not any(os.path.exists(os.path.join(downloads, n)) for n in zip_names)
+    for path in (os.path.join(downloads, kept_zip), library_zip, mine):
+        assert os.path.exists(path)
+    assert downloader.read_published() == []
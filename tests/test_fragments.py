@@ -0,0 +1,193 @@
+import http.server
+import os
+import threading
+import time
+
+import pytest
+import requests
+
+import downloader
+from fragments import HostLimiter, RangesNotSupported, StreamProgress, download_ranges
+
+# Served file, large enough to be split into several fragments
+PAYLOAD = os.urandom(100_000)
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves PAYLOAD, honouring Range headers unless the path is /no-ranges. On /broken,
+    the fragment at offset 0 fails and the others are slow.
+    """
+
+    requests = []
+
+    def do_GET(self):
+        header = self.headers.get("Range")
+        RangeHandler.requests.append(header)
+        if header and self.path == "/broken":
+            if header.startswith("bytes=0-"):
+                self.send_error(404)
+                return
+            time.sleep(0.5)
+        if header and self.path != "/no-ranges":
+            start, end = (int(n) for n in header.split("=")[1].split("-"))
+            body = PAYLOAD[start : end + 1]
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(PAYLOAD)}")
+        else:
+            body = PAYLOAD
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    RangeHandler.requests = []
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_ranged_download_reassembles_fragments(server, tmp_path):
+    path = str(tmp_path / "stream.webm")
+    progress = []
+
+    download_ranges(
+        server + "/stream",
+        path,
+        len(PAYLOAD),
+        workers=3,
+        fragment_size=16_384,
+        progress_hook=progress.append,
+    )
+
+    with open(path, "rb") as stream:
+        assert stream.read() == PAYLOAD
+    assert len(RangeHandler.requests) == 7
+    assert progress[-1] == {
+        "status": "finished",
+        "filename": path,
+        "downloaded_bytes": len(PAYLOAD),
+        "total_bytes": len(PAYLOAD),
+    }
+
+
+def test_ranged_download_refuses_servers_without_ranges(server, tmp_path):
+    path = str(tmp_path / "stream.webm")
+
+    with pytest.raises(RangesNotSupported):
+        download_ranges(server + "/no-ranges", path, len(PAYLOAD))
+
+    assert not os.path.exists(path)
+
+
+def test_failed_fragment_stops_the_others(server, tmp_path):
+    path = str(tmp_path / "stream.webm")
+    start = time.perf_counter()
+
+    with pytest.raises(requests.HTTPError):
+        download_ranges(
+            server + "/broken", path, len(PAYLOAD), workers=2, fragment_size=10_000
+        )
+
+    # Only the fragments that had already started are waited for, not all ten
+    assert time.perf_counter() - start < 2
+    assert len(RangeHandler.requests) <= 3
+    assert not os.path.exists(path)
+
+
+def test_stream_progress_reports_one_total():
+    reports = []
+    progress = StreamProgress(reports.append)
+    progress.expect("video.webm", 300)
+    progress.expect("audio.webm", 100)
+
+    progress(
+        {"status": "downloading", "filename": "audio.webm", "downloaded_bytes": 50}
+    )
+    progress({"status": "finished", "filename": "audio.webm", "downloaded_bytes": 100})
+    progress({"status": "finished", "filename": "video.webm", "downloaded_bytes": 300})
+
+    assert [(r["downloaded_bytes"], r["total_bytes"]) for r in reports] == [
+        (50, 400),
+        (100, 400),
+        (400, 400),
+    ]
+    assert [report["status"] for report in reports] == [
+        "downloading",
+        "downloading",
+        "finished",
+    ]
+
+
+def test_host_limiter_caps_connections_per_host():
+    limiter = HostLimiter(2)
+    open_connections = []
+    peak = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(2)
+
+    def connect():
+        with limiter.connection("https://cdn.example/stream"):
+            with lock:
+                open_connections.append(1)
+                peak.append(len(open_connections))
+            try:
+                barrier.wait(timeout=0.2)
+            except threading.BrokenBarrierError:
+                pass
+            with lock:
+                open_connections.pop()
+
+    threads = [threading.Thread(target=connect) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert max(peak) == 2
+
+
+def test_video_and_audio_streams_download_in_parallel(server, tmp_path, monkeypatch):
+    class StreamingYoutubeDL:
+        params = {}
+
+        def process_ie_result(self, info_dict, download=True):
+            return dict(
+                info_dict,
+                requested_formats=[
+                    {
+                        "format_id": format_id,
+                        "ext": "webm",
+                        "protocol": "http",
+                        "url": f"{server}/{format_id}",
+                        "filesize": len(PAYLOAD),
+                    }
+                    for format_id in ("248", "251")
+                ],
+            )
+
+    def concatenate(ydl, info_dict, stream_files, video_file):
+        with open(video_file, "wb") as video:
+            for stream_file in stream_files:
+                with open(stream_file, "rb") as stream:
+                    video.write(stream.read())
+
+    monkeypatch.setattr(downloader, "PARALLEL_MIN_SIZE", 1)
+    monkeypatch.setattr(downloader, "merge_streams", concatenate)
+
+    video_file = downloader.download_video_streams(
+        StreamingYoutubeDL(), {"id": "video"}, str(tmp_path)
+    )
+
+    assert video_file == str(tmp_path / "video.mp4")
+    with open(video_file, "rb") as video:
+        assert video.read() == PAYLOAD * 2
+    assert all(header for header in RangeHandler.requests)
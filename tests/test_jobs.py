@@ -0,0 +1,65 @@
+import threading
+
+import pytest
+
+from jobs import JobManager, JobQueueFull, follow_job
+
+
+def download(count, progress_hook=None):
+    progress_hook({"status": "archive_started", "name": "playlist.zip"})
+    for done in range(1, count + 1):
+        progress_hook({"status": "track_done", "track_number": done, "tracks": count})
+    return "playlist.zip"
+
+
+def test_jobs_report_progress_and_results():
+    job = JobManager(workers=1).submit("playlist", download, 3)
+
+    progress = list(follow_job(job, poll_interval=0.01))
+
+    assert job.status == "done"
+    assert job.result == job.partial_output == "playlist.zip"
+    assert progress[-1] == "Done (3 tracks done)"
+
+
+def test_cancelled_jobs_stop_at_the_next_progress_update():
+    started = threading.Event()
+
+    def endless_download(progress_hook=None):
+        while True:
+            progress_hook({"status": "downloading", "filename": "audio.webm"})
+            started.set()
+
+    job = JobManager(workers=1).submit("audio", endless_download)
+    started.wait(5)
+    job.cancel()
+
+    assert job.wait(5)
+    assert job.status == "cancelled"
+
+
+def test_full_queue_refuses_jobs():
+    release = threading.Event()
+    job_manager = JobManager(workers=1, max_queued=1)
+    job_manager.submit("playlist", lambda progress_hook=None: release.wait(5))
+    # The first job may still be waiting in the queue, so fill the queue for sure
+    with pytest.raises(JobQueueFull):
+        for _ in range(3):
+            job_manager.submit("playlist", lambda progress_hook=None: None)
+    release.set()
+
+
+def test_quick_jobs_dont_wait_behind_long_jobs():
+    release = threading.Event()
+    job_manager = JobManager(workers=1, quick_workers=1)
+    playlists = [
+        job_manager.submit("playlist", lambda progress_hook=None: release.wait(5))
+        for _ in range(2)
+    ]
+
+    single = job_manager.submit("audio", lambda progress_hook=None: "song.mp3")
+
+    assert single.wait(5) and single.result == "song.mp3"
+    assert not any(job.finished for job in playlists)
+    release.set()
+    assert all(job.wait(5) for job in playlists)
@@ -0,0 +1,77 @@
+import os
+import pathlib
+
+from library import MediaIndex
+from tagging import write_tags
+
+
+def write(path, content):
+    with open(path, "wb") as file:
+        file.write(content)
+    return str(path)
+
+
+def test_media_index_stores_identical_content_once(tmp_path):
+    index = MediaIndex(str(tmp_path / "media"))
+
+    first = index.store(write(tmp_path / "a.mp3", b"same"), "Song.mp3", "audio:a")
+    second = index.store(write(tmp_path / "b.mp3", b"same"), "Other.mp3", "audio:b")
+    third = index.store(write(tmp_path / "c.mp3", b"different"), "Song.mp3")
+
+    # Every caller gets its own copy, and identical content is stored once
+    assert os.path.basename(first) == "Song.mp3"
+    assert os.path.basename(second) == "Other.mp3"
+    assert os.path.basename(third) == "Song (2).mp3"
+    assert sorted(os.listdir(tmp_path / "media" / ".media")) == [
+        "Song (2).mp3",
+        "Song.mp3",
+    ]
+    assert os.path.samefile(first, second)
+    # The index survives a restart
+    again = MediaIndex(str(tmp_path / "media")).find("audio:b")["path"]
+    assert os.path.basename(again) == "Song (3).mp3"
+    assert pathlib.Path(again).read_bytes() == b"same"
+
+
+def test_media_index_forgets_edited_and_deleted_files(tmp_path):
+    index = MediaIndex(str(tmp_path / "media"))
+    index.store(write(tmp_path / "a.mp3", b"audio"), "Song.mp3", "audio:a")
+    index.store(write(tmp_path / "b.mp3", b"more"), "Other.mp3", "audio:b")
+
+    with open(tmp_path / "media" / ".media" / "Song.mp3", "ab") as file:
+        file.write(b" edited")
+    os.remove(tmp_path / "media" / ".media" / "Other.mp3")
+
+    assert index.find("audio:a") is None
+    assert index.find("audio:b") is None
+
+
+def test_media_index_copies_are_tagged_and_deleted_independently(tmp_path):
+    index = MediaIndex(str(tmp_path / "media"))
+    audio = b"\xff\xfb" + b"\x00" * 4096  # Stand-in for MPEG audio frames
+    first = index.store(write(tmp_path / "a.mp3", audio), "Song.mp3", "audio:a")
+    second = index.find("audio:a")["path"]
+
+    write_tags(first, {"title": "Mine"})
+    os.remove(second)
+
+    # The other caller's copy and the stored copy are untouched
+    assert pathlib.Path(index.find("audio:a")["path"]).read_bytes() == audio
+    assert pathlib.Path(first).read_bytes() != audio
+
+
+def test_media_index_evicts_least_recently_used_files(tmp_path):
+    index = MediaIndex(str(tmp_path / "media"), max_bytes=12)
+    copies = {}
+    for name in ("a", "b"):
+        work_file = write(tmp_path / f"{name}.part", name.encode() * 6)
+        copies[name] = index.store(work_file, f"{name}.mp3", key=name)
+    assert index.find("a")  # "b" is now the least recently used
+
+    index.store(write(tmp_path / "c.part", b"c" * 6), "c.mp3", key="c")
+
+    assert index.find("b") is None
+    assert index.find("a") and index.find("c")
+    assert sorted(os.listdir(tmp_path / "media" / ".media")) == ["a.mp3", "c.mp3"]
+    # Callers' copies outlive the stored file
+    assert pathlib.Path(copies["b"]).read_bytes() == b"b" * 6
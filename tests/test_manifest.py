@@ -0,0 +1,97 @@
+import os
+import threading
+
+import manifest
+from manifest import PlaylistManifest
+
+
+def test_changed_output_is_not_treated_as_finished(tmp_path):
+    output = tmp_path / "song.mp3"
+    output.write_bytes(b"finished audio")
+    with PlaylistManifest(str(tmp_path / "jobs"), "audio-pl") as playlist_manifest:
+        playlist_manifest.add_entries(
+            [("a", "https://example.com/a"), ("b", "https://example.com/b")]
+        )
+        playlist_manifest.mark_done("a", str(output))
+
+    # The state survives a restart, and the output is claimed by the job resuming it
+    reopened = PlaylistManifest(str(tmp_path / "jobs"), "audio-pl")
+    claimed = reopened.finished_output("a")
+    assert claimed == str(tmp_path / "jobs" / "audio-pl" / "a" / "song.mp3")
+    assert not output.exists()
+    assert reopened.finished_output("b") is None
+
+    with open(claimed, "wb") as claimed_file:
+        claimed_file.write(b"truncated")
+    assert reopened.finished_output("a") is None
+
+    reopened.remove()
+    assert not (tmp_path / "jobs" / "audio-pl.json").exists()
+    assert not (tmp_path / "jobs" / "audio-pl.lock").exists()
+
+
+def test_second_job_waits_for_the_manifest(tmp_path, monkeypatch):
+    monkeypatch.setattr(manifest, "LOCK_POLL_INTERVAL", 0.01)
+    jobs_dir = str(tmp_path / "jobs")
+    first = PlaylistManifest(jobs_dir, "audio-pl")
+    first.add_entries([("a", "https://example.com/a")])
+    first.work_directory("a")
+    # Another job's files next to this manifest's aren't touched
+    os.makedirs(os.path.join(jobs_dir, "audio-pl", "other"))
+    opened = threading.Event()
+
+    def second_job():
+        with PlaylistManifest(jobs_dir, "audio-pl") as second:
+            assert second.entries == {}
+            opened.set()
+
+    thread = threading.Thread(target=second_job)
+    thread.start()
+    assert not opened.wait(0.1)
+    first.remove()
+    thread.join(5)
+
+    assert opened.is_set()
+    assert os.listdir(os.path.join(jobs_dir, "audio-pl")) == ["other"]
+
+
+def test_lock_of_a_dead_process_is_taken_over(tmp_path, monkeypatch):
+    monkeypatch.setattr(manifest, "process_running", lambda pid: False)
+    (tmp_path / "jobs").mkdir()
+    (tmp_path / "jobs" / "audio-pl.lock").write_text("12345")
+
+    with PlaylistManifest(str(tmp_path / "jobs"), "audio-pl"):
+        lock = tmp_path / "jobs" / "audio-pl.lock"
+        assert lock.read_text() == str(os.getpid())
+
+
+def test_changes_are_journaled_and_survive_a_crash(tmp_path):
+    jobs_dir = tmp_path / "jobs"
+    output = tmp_path / "song.mp3"
+    output.write_bytes(b"finished audio")
+    playlist_manifest = PlaylistManifest(str(jobs_dir), "audio-pl")
+    playlist_manifest.add_entries(
+        [("a", "https://example.com/a"), ("b", "https://example.com/b")]
+    )
+    playlist_manifest.mark_done("a", str(output))
+    playlist_manifest.mark_failed("b", "HTTP Error 403")
+    playlist_manifest.forget("b")
+
+    # Only the journal is written while the job runs
+    assert not (jobs_dir / "audio-pl.json").exists()
+    assert len((jobs_dir / "audio-pl.journal").read_text().splitlines()) == 5
+
+    # A crash leaves the journal and a stale lock behind
+    with open(jobs_dir / "audio-pl.journal", "a") as journal:
+        journal.write('{"id": "a", "sta')
+    (jobs_dir / "audio-pl.lock").unlink()
+    reopened = PlaylistManifest(str(jobs_dir), "audio-pl")
+    assert list(reopened.entries) == ["a"]
+    assert reopened.entries["a"]["status"] == "done"
+
+    # Reopening folds the journal into the snapshot
+    reopened.close()
+    assert (jobs_dir / "audio-pl.json").exists()
+    assert not (jobs_dir / "audio-pl.journal").exists()
+    with PlaylistManifest(str(jobs_dir), "audio-pl") as again:
+        assert again.entries == reopened.entries
@@ -0,0 +1,65 @@
+import requests
+
+from downloader import download_audio_and_metadata
+from metrics import Registry, registry, start_metrics_server, timed
+
+
+def test_registry_renders_prometheus_text():
+    metrics = Registry()
+    metrics.inc("downloaddynamo_downloaded_bytes_total", 512, kind="audio")
+    metrics.observe("downloaddynamo_stage_seconds", 0.3, stage="zip")
+    metrics.register_callback("downloaddynamo_job_queue_depth", lambda: 4)
+
+    text = metrics.render()
+
+    assert "# TYPE downloaddynamo_stage_seconds histogram" in text
+    assert 'downloaddynamo_downloaded_bytes_total{kind="audio"} 512' in text
+    assert 'downloaddynamo_stage_seconds_bucket{stage="zip",le="0.25"} 0' in text
+    assert 'downloaddynamo_stage_seconds_bucket{stage="zip",le="0.5"} 1' in text
+    assert 'downloaddynamo_stage_seconds_count{stage="zip"} 1' in text
+    assert "downloaddynamo_job_queue_depth 4" in text
+    # Buckets are listed in increasing order, ending with +Inf
+    bounds = [
+        line.split('le="')[1].split('"')[0]
+        for line in text.splitlines()
+        if line.startswith("downloaddynamo_stage_seconds_bucket")
+    ]
+    assert bounds[-1] == "+Inf"
+    assert [float(bound) for bound in bounds[:-1]] == sorted(
+        float(bound) for bound in bounds[:-1]
+    )
+
+
+def test_pipeline_stages_are_timed_and_served(fake_youtube):
+    url = fake_youtube.add_video("metered", "Metered Song")
+    before = {
+        stage: registry.value("downloaddynamo_stage_seconds", stage=stage)
+        for stage in ("extract", "download", "transcode", "tag")
+    }
+
+    download_audio_and_metadata(url)
+
+    for stage, count in before.items():
+        assert registry.value("downloaddynamo_stage_seconds", stage=stage) == count + 1
+
+    server = start_metrics_server(port=0, host="127.0.0.1")
+    try:
+        response = requests.get(
+            f"http://127.0.0.1:{server.server_address[1]}/metrics", timeout=5
+        )
+    finally:
+        server.shutdown()
+    assert 'downloaddynamo_stage_seconds_count{stage="transcode"}' in response.text
+    assert 'downloaddynamo_cache_misses_total{cache="download"}' in response.text
+
+
+def test_failed_stage_is_counted():
+    before = registry.value("downloaddynamo_stage_errors_total", stage="test")
+    try:
+        with timed("test"):
+            raise ValueError("boom")
+    except ValueError:
+        pass
+    assert (
+        registry.value("downloaddynamo_stage_errors_total", stage="test") == before + 1
+    )
@@ -0,0 +1,60 @@
+import subprocess
+import sys
+import threading
+import time
+
+from postprocessing import FFmpegScheduler
+
+# A child process that burns a little CPU, standing in for ffmpeg
+BUSY_CHILD = [sys.executable, "-c", "sum(i * i for i in range(2_000_000))"]
+
+
+def test_scheduler_caps_concurrent_work():
+    scheduler = FFmpegScheduler(processes=2, threads=1)
+    peak = []
+
+    def work():
+        with scheduler.slot("transcode"):
+            peak.append(scheduler.running)
+            time.sleep(0.05)
+
+    threads = [threading.Thread(target=work) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert max(peak) == 2
+    assert scheduler.ydl_params() == {
+        "postprocessor_args": {"default": ["-threads", "1"]}
+    }
+
+
+def test_scheduler_records_the_cpu_time_of_its_processes():
+    scheduler = FFmpegScheduler(processes=1)
+
+    with scheduler.slot("transcode") as stats:
+        subprocess.run(BUSY_CHILD, stdout=subprocess.PIPE, check=True)
+
+    assert stats["cpu_seconds"] > 0.05
+
+
+def test_postprocessor_hook_holds_a_slot_while_ffmpeg_runs():
+    scheduler = FFmpegScheduler(processes=1)
+
+    with scheduler.postprocessor_hook(video_id="v") as hook:
+        hook({"status": "started", "postprocessor": "FFmpegFixupM4a"})
+        assert scheduler.running == 1
+        hook({"status": "finished", "postprocessor": "FFmpegFixupM4a"})
+        assert scheduler.running == 0
+        hook({"status": "started", "postprocessor": "MoveFiles"})
+        assert scheduler.running == 0  # Not ffmpeg work
+
+        # A postprocessor that fails never reports that it finished
+        hook({"status": "started", "postprocessor": "FFmpegMerger"})
+    assert scheduler.running == 0
+
+    # Work that already holds a slot doesn't wait for a second one
+    with scheduler.slot("merge"), scheduler.postprocessor_hook() as hook:
+        hook({"status": "started", "postprocessor": "FFmpegMerger"})
+        assert scheduler.running == 1
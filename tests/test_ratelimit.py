@@ -0,0 +1,108 @@
+import types
+
+import pytest
+
+import ratelimit
+from ratelimit import HostLimits, TokenBucket, is_transient, with_retries
+
+
+def test_token_bucket_waits_once_the_burst_is_used(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(ratelimit.time, "sleep", sleeps.append)
+    bucket = TokenBucket(rate=10, capacity=2)
+
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == 0
+    # The third request has to wait for a token to refill, about 1/rate seconds
+    assert 0.05 < bucket.acquire() <= 0.1
+    assert len(sleeps) == 1
+
+
+def test_transient_errors_are_retried(monkeypatch):
+    monkeypatch.setattr(ratelimit, "BACKOFF_BASE", 0)
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise OSError("HTTP Error 429: Too Many Requests")
+        return "ok"
+
+    assert with_retries(flaky, url="https://www.youtube.com/watch?v=x") == "ok"
+    assert len(calls) == 3
+
+
+def test_permanent_errors_are_not_retried(monkeypatch):
+    monkeypatch.setattr(ratelimit, "BACKOFF_BASE", 0)
+    calls = []
+
+    def missing():
+        calls.append(1)
+        raise ValueError("HTTP Error 404: Not Found")
+
+    with pytest.raises(ValueError):
+        with_retries(missing, retries=3)
+    assert len(calls) == 1
+    assert is_transient(TimeoutError())
+    assert not is_transient(ValueError("Video unavailable"))
+
+
+def test_requests_are_limited_by_their_host_before_they_are_sent():
+    host_limits = HostLimits(request_rate=1, request_burst=10, bandwidth=1e9)
+    sent = []
+
+    class Downloader:
+        def urlopen(self, request):
+            # The token is taken before the request is sent
+            sent.append(host_limits._requests[ratelimit.host_of(request.url)]._tokens)
+            return request.url
+
+    ydl = host_limits.limit(Downloader())
+    stream = types.SimpleNamespace(url="https://rr1.googlevideo.com/videoplayback")
+    assert ydl.urlopen(stream) == stream.url
+    ydl.urlopen(stream)
+
+    # Each request counts against the stream's host, not www.youtube.com
+    assert list(host_limits._requests) == ["rr1.googlevideo.com"]
+    assert 8 <= sent[-1] < 8.5
+
+
+def test_progress_hook_caps_bandwidth_and_forgets_finished_files(monkeypatch):
+    host_limits = HostLimits(bandwidth=1e9)
+    transfers = []
+    monkeypatch.setattr(
+        host_limits, "transfer", lambda url, size: transfers.append((url, size))
+    )
+    hook = host_limits.progress_hook()
+    stream = {"url": "https://rr1.googlevideo.com/videoplayback?id=x"}
+
+    def progress(status, downloaded=None):
+        hook(
+            {
+                "status": status,
+                "filename": "video.f137.mp4",
+                "info_dict": stream,
+                "downloaded_bytes": downloaded,
+            }
+        )
+
+    progress("downloading", 100)
+    progress("downloading", 300)
+    # A finished file is forgotten, so downloading it again counts from the start
+    progress("finished")
+    progress("downloading", 50)
+
+    assert [size for _, size in transfers] == [100, 200, 50]
+    assert {url for url, _ in transfers} == {stream["url"]}
+
+
+def test_yt_dlp_retries_in_one_layer_only():
+    # Calls wrapped in with_retries aren't retried by yt-dlp as well
+    params = HostLimits().ydl_params()
+    assert params["extractor_retries"] == params["fragment_retries"] == 0
+    assert params["skip_unavailable_fragments"] is False
+    params = HostLimits().ydl_params(retries=ratelimit.RETRIES)
+    assert params["retries"] == ratelimit.RETRIES
+    assert (
+        0 <= params["retry_sleep_functions"]["http"](n=2) <= 4 * ratelimit.BACKOFF_BASE
+    )
@@ -0,0 +1,79 @@
+import os
+
+import search
+
+
+def test_lazy_search_downloads_audio_on_demand(fake_youtube, tmp_path, monkeypatch):
+    monkeypatch.setattr(search, "PREFETCH_RESULTS", 0)
+    video_urls = [
+        fake_youtube.add_video(f"hit{i}", f"Hit {i}", uploader="Singer")
+        for i in range(4)
+    ]
+    fake_youtube.add_search("hits", video_urls)
+
+    titles, artists, _, audio_paths, thumbnails, urls = search.search_videos(
+        "hits", lazy=True
+    )
+
+    assert titles == ["Hit 0", "Hit 1", "Hit 2"]
+    assert artists == ["Singer"] * 3
+    assert audio_paths == [None] * 3
+    assert thumbnails[0] == "https://i.ytimg.com/vi/hit0.jpg"
+    assert fake_youtube.DOWNLOADED == []
+
+    output_folder = str(tmp_path / "search")
+    audio_file = search.download_audio(urls[1], output_folder)
+    assert audio_file == os.path.join(output_folder, "Hit 1.mp3")
+    # The second caller gets its own copy of the stored audio
+    again = search.download_audio(urls[1], output_folder)
+    assert again == os.path.join(output_folder, "Hit 1 (2).mp3")
+    assert os.path.samefile(again, audio_file)
+    assert fake_youtube.DOWNLOADED == ["hit1"]
+
+
+def test_prefetched_audio_is_not_downloaded_twice(fake_youtube, tmp_path):
+    url = fake_youtube.add_video("hit", "Hit")
+    output_folder = str(tmp_path / "search")
+
+    search.prefetch_audio([url], output_folder)
+    search.download_audio(url, output_folder)
+
+    assert fake_youtube.DOWNLOADED == ["hit"]
+    assert search.audio_downloads == {}  # Handed out, so no longer remembered
+
+
+def test_unused_prefetches_are_capped(fake_youtube, tmp_path, monkeypatch):
+    monkeypatch.setattr(search, "AUDIO_DOWNLOADS_KEPT", 2)
+    urls = [fake_youtube.add_video(f"pre{i}", f"Pre {i}") for i in range(4)]
+    output_folder = str(tmp_path / "search")
+
+    for url in urls:
+        search.prefetch_audio([url], output_folder)
+        search.audio_downloads[(url, output_folder)].result()
+
+    assert len(search.audio_downloads) <= 2
+
+
+def test_streamed_results_fill_in_every_row(fake_youtube, monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    video_urls = [fake_youtube.add_video(f"song{i}", f"Song {i}") for i in range(3)]
+    fake_youtube.add_search("songs", video_urls)
+
+    *_, (titles, _, _, audio_paths, _, urls) = search.stream_search_videos("songs")
+
+    assert titles == ["Song 0", "Song 1", "Song 2"]
+    assert urls == video_urls
+    assert audio_paths == [os.path.join("downloads", f"Song {i}.mp3") for i in range(3)]
+    assert sorted(fake_youtube.DOWNLOADED) == ["song0", "song1", "song2"]
+
+
+def test_pool_threads_reuse_their_ydl_instances(fake_youtube):
+    options = {"outtmpl": {"default": "downloads/.%(id)s.part"}}
+    ydls = {
+        id(search.search_pool.submit(search.shared_ydl, **options).result())
+        for _ in range(20)
+    }
+
+    assert len(ydls) <= search.SEARCH_WORKERS
+    other = search.search_pool.submit(search.shared_ydl).result()
+    assert "outtmpl" not in other.params  # Options never leak into other instances
@@ -0,0 +1,44 @@
+import os
+import subprocess
+import sys
+
+from lazy import LazyModule
+
+# Seconds the pipeline modules may take to import, far above the ~0.1s they need
+STARTUP_BUDGET = 1.0
+
+# Modules that must only be imported once they are used
+DEFERRED_MODULES = ("yt_dlp", "PIL.Image", "mutagen.id3", "requests")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_pipeline_modules_import_without_heavy_dependencies():
+    script = (
+        "import sys, time\n"
+        "start = time.perf_counter()\n"
+        "import downloader, search, jobs, tagging, thumbnails\n"
+        "print(time.perf_counter() - start)\n"
+        f"print(','.join(m for m in {DEFERRED_MODULES!r} if m in sys.modules))\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    seconds, loaded = result.stdout.splitlines()
+
+    assert loaded == ""
+    assert float(seconds) < STARTUP_BUDGET
+
+
+def test_lazy_module_imports_on_first_use():
+    module = LazyModule("json")
+
+    assert module.dumps([1]) == "[1]"
+    module.marker = True  # Attributes are set on the real module
+    assert sys.modules["json"].marker
+    del module.marker
+    assert not hasattr(sys.modules["json"], "marker")
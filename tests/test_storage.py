@@ -0,0 +1,175 @@
+import http.client
+import pathlib
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from archive import StreamingZip
+from storage import (
+    LocalObjectClient,
+    LocalStorage,
+    ObjectStorage,
+    file_url,
+    parse_range,
+    serve_while_growing,
+    start_file_server,
+)
+
+
+def fetch(server, name, headers=None):
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    request = urllib.request.Request(file_url(name, base_url), headers=headers or {})
+    with urllib.request.urlopen(request) as response:
+        return response.status, dict(response.headers), response.read()
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def serve(storage):
+        server = start_file_server(storage, port=0, host="127.0.0.1")
+        servers.append(server)
+        return server
+
+    yield serve
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_local_storage_serves_files_in_place_with_ranges(tmp_path, serve):
+    root = tmp_path / "downloads"
+    (root / "library").mkdir(parents=True)
+    video = root / "library" / "Big Video.mp4"
+    video.write_bytes(bytes(range(256)) * 4)
+    (root / ".media.json").write_text("{}")
+    storage = LocalStorage(str(root))
+
+    # A file written into the storage is stored as it is
+    assert storage.put(str(video)) == "library/Big Video.mp4"
+    assert video.exists()
+    server = serve(storage)
+
+    status, headers, body = fetch(server, "library/Big Video.mp4")
+    assert status == 200 and body == video.read_bytes()
+    assert headers["Accept-Ranges"] == "bytes"
+    status, headers, body = fetch(
+        server, "library/Big Video.mp4", {"Range": "bytes=1000-"}
+    )
+    assert status == 206 and body == video.read_bytes()[1000:]
+    assert headers["Content-Range"] == "bytes 1000-1023/1024"
+
+    for name in (".media.json", "../outside.txt", "missing.mp4"):
+        with pytest.raises(urllib.error.HTTPError) as error:
+            fetch(server, name)
+        assert error.value.code == 404
+    with pytest.raises(urllib.error.HTTPError) as error:
+        fetch(server, "library/Big Video.mp4", {"Range": "bytes=5000-"})
+    assert error.value.code == 416
+
+
+def test_growing_archives_are_streamed_until_they_are_finished(tmp_path, serve):
+    root = tmp_path / "downloads"
+    root.mkdir()
+    track = tmp_path / "track.mp3"
+    track.write_bytes(b"music" * 1000)
+    server = serve(LocalStorage(str(root)))
+
+    def fetch_in_background(name):
+        results = []
+
+        def run():
+            try:
+                results.append(fetch(server, name)[2])
+            except (OSError, http.client.HTTPException) as error:
+                results.append(error)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread, results
+
+    archive = StreamingZip(str(root / "playlist.zip"))
+    with serve_while_growing("playlist.zip", archive):
+        thread, results = fetch_in_background("playlist.zip")
+        archive.add(str(track), "Track 1.mp3")
+        archive.add(str(track), "Track 2.mp3")
+        archive.close()
+        thread.join(10)
+    assert results == [(root / "playlist.zip").read_bytes()]
+
+    # A discarded archive ends the download before it's complete
+    archive = StreamingZip(str(root / "failed.zip"))
+    with serve_while_growing("failed.zip", archive):
+        thread, results = fetch_in_background("failed.zip")
+        archive.add(str(track), "Track 1.mp3")
+        archive.discard()
+        thread.join(10)
+    assert isinstance(results[0], http.client.IncompleteRead)
+
+
+def test_local_storage_moves_other_files_in(tmp_path):
+    storage = LocalStorage(str(tmp_path / "downloads"))
+    (tmp_path / "downloads").mkdir()
+    (tmp_path / "downloads" / "song.mp3").write_bytes(b"old")
+    outside = tmp_path / "song.mp3"
+    outside.write_bytes(b"new")
+
+    name = storage.put(str(outside))
+
+    assert name == "song (2).mp3"
+    assert not outside.exists()
+    assert pathlib.Path(storage.local_path(name)).read_bytes() == b"new"
+
+
+def test_object_storage_uploads_and_streams(tmp_path, serve):
+    downloads = tmp_path / "downloads"
+    downloads.mkdir()
+    archive = downloads / "playlist.zip"
+    archive.write_bytes(b"0123456789" * 10)
+    client = LocalObjectClient(str(tmp_path / "objects"))
+    storage = ObjectStorage("media", "outputs/", client, str(downloads))
+
+    name = storage.put(str(archive))
+
+    # The upload owns the file now, and a second file doesn't overwrite it
+    assert name == "playlist.zip" and not archive.exists()
+    assert storage.location(name) == "s3://media/outputs/playlist.zip"
+    archive.write_bytes(b"other")
+    assert storage.put(str(archive)) == "playlist (2).zip"
+    assert storage.size(name) == 100
+
+    server = serve(storage)
+    status, headers, body = fetch(server, name, {"Range": "bytes=-5"})
+    assert (status, body) == (206, b"56789")
+    assert headers["Content-Type"] == "application/zip"
+
+
+def test_parse_range():
+    assert parse_range("bytes=0-99", 1000) == (0, 99)
+    assert parse_range("bytes=900-", 1000) == (900, 999)
+    assert parse_range("bytes=-100", 1000) == (900, 999)
+    assert parse_range("bytes=990-2000", 1000) == (990, 999)
+    # Several ranges are answered with the whole file
+    assert parse_range("bytes=0-1,5-6", 1000) is None
+    with pytest.raises(ValueError):
+        parse_range("bytes=1000-", 1000)
+
+
+def test_object_storage_overwrites_library_files_and_keeps_them(tmp_path):
+    library = tmp_path / "downloads" / "library" / "pl"
+    library.mkdir(parents=True)
+    archive = library / "Playlist.zip"
+    archive.write_bytes(b"first sync")
+    client = LocalObjectClient(str(tmp_path / "objects"))
+    storage = ObjectStorage("media", "", client, str(tmp_path / "downloads"))
+
+    assert storage.put(str(archive)) == "library/pl/Playlist.zip"
+    archive.write_bytes(b"second sync")
+    assert storage.put(str(archive)) == "library/pl/Playlist.zip"
+
+    # The library keeps its zip, and the bucket has a single, up to date copy
+    assert archive.exists()
+    assert storage.size("library/pl/Playlist.zip") == len(b"second sync")
@@ -0,0 +1,105 @@
+import os
+import zipfile
+from io import BytesIO
+
+import pytest
+from mutagen.id3 import ID3
+
+import downloader
+import fakes
+from downloader import retag_folder, sync_playlist
+from tagging import apply_tags, read_tags, write_tags
+
+
+def make_files(tmp_path):
+    mp3 = str(tmp_path / "b.mp3")
+    ID3().save(mp3)
+    write_tags(mp3, {"title": "Second", "artist": "Band"})
+    m4a = str(tmp_path / "a.m4a")
+    fakes.write_fake_m4a(m4a)
+    write_tags(m4a, {"title": "First", "artist": "Band"})
+    opus = str(tmp_path / "c.opus")
+    fakes.write_fake_opus(opus)
+    return [m4a, mp3, opus]
+
+
+def test_apply_tags_fills_templates_per_file(tmp_path):
+    audio_files = make_files(tmp_path)
+    broken = str(tmp_path / "broken.m4a")
+    with open(broken, "wb") as file:
+        file.write(b"not audio")
+
+    results = apply_tags(
+        audio_files + [broken],
+        {
+            "album_artist": "Band",
+            "title": "{artist} - {title}",
+            "track_number": "{index}",
+        },
+    )
+
+    assert [result["status"] for result in results] == ["ok", "ok", "ok", "failed"]
+    assert read_tags(audio_files[0]) == {
+        "title": "Band - First",
+        "artist": "Band",
+        "album_artist": "Band",
+        "track_number": "1",
+    }
+    assert read_tags(audio_files[1])["title"] == "Band - Second"
+    assert read_tags(audio_files[2]) == {
+        "title": " - ",
+        "album_artist": "Band",
+        "track_number": "3",
+    }
+    assert results[3]["error"]
+
+
+@pytest.mark.parametrize(
+    "template",
+    ["{index:999999999}", "{filename.__class__}", "{title[0]}", "{artist!r}", "{}"],
+)
+def test_apply_tags_refuses_templates_beyond_plain_fields(tmp_path, template):
+    audio_files = make_files(tmp_path)
+
+    with pytest.raises(ValueError, match="plain"):
+        apply_tags(audio_files, {"title": template})
+    assert read_tags(audio_files[0])["title"] == "First"
+
+
+def test_retag_folder_reports_every_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(downloader, "DOWNLOADS_DIR", str(tmp_path))
+    make_files(tmp_path)
+
+    rows = retag_folder(str(tmp_path), "", "", "", "", "", "Pop", "")
+
+    assert [row[:2] for row in rows] == [
+        ["a.m4a", "ok"],
+        ["b.mp3", "ok"],
+        ["c.opus", "ok"],
+    ]
+    assert rows[0][2] == "genre=Pop"
+    assert read_tags(str(tmp_path / "b.mp3"))["genre"] == "Pop"
+
+
+def test_retag_folder_only_edits_downloads(fake_youtube, tmp_path):
+    outside = tmp_path / "elsewhere"
+    outside.mkdir()
+    hidden = tmp_path / "downloads" / ".media"
+    hidden.mkdir(parents=True)
+
+    for folder in (outside, hidden, tmp_path / "downloads" / ".." / "elsewhere"):
+        with pytest.raises(ValueError):
+            retag_folder(str(folder), "", "", "", "", "", "Pop", "")
+
+
+def test_retag_library_folder_updates_its_zip(fake_youtube):
+    video_urls = [fake_youtube.add_video(f"tag{i}", f"Tagged {i}") for i in (1, 2)]
+    playlist_url = fake_youtube.add_playlist("pl11", "Tagged", video_urls)
+    zip_filename = sync_playlist(playlist_url)
+
+    retag_folder(os.path.dirname(zip_filename), "", "", "", "", "", "Pop", "")
+
+    with zipfile.ZipFile(zip_filename) as zipf:
+        assert sorted(zipf.namelist()) == ["Tagged 1.mp3", "Tagged 2.mp3"]
+        tags = ID3(BytesIO(zipf.read("Tagged 2.mp3")))
+    assert tags["TCON"].text == ["Pop"]
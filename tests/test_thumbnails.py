@@ -0,0 +1,79 @@
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import thumbnails
+
+
+class ThumbnailHandler(BaseHTTPRequestHandler):
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.headers.get("If-None-Match"))
+        if self.headers.get("If-None-Match") == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", '"v1"')
+        self.send_header("Content-Length", "5")
+        self.end_headers()
+        self.wfile.write(b"image")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def thumbnail_server():
+    ThumbnailHandler.requests = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ThumbnailHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+def test_thumbnails_are_cached_and_revalidated(thumbnail_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(thumbnails, "THUMBNAIL_CACHE_DIR", str(tmp_path))
+    urls = [f"{thumbnail_server}/vi/{i}.jpg" for i in range(4)]
+
+    assert thumbnails.fetch_thumbnails(urls) == [b"image"] * 4
+    assert thumbnails.fetch_thumbnail(urls[0]) == b"image"
+    assert ThumbnailHandler.requests == [None] * 4  # The second fetch hit the disk
+
+    # Once stale, the thumbnail is revalidated instead of downloaded again
+    monkeypatch.setattr(thumbnails, "THUMBNAIL_MAX_AGE", -1)
+    assert thumbnails.fetch_thumbnail(urls[0]) == b"image"
+    assert ThumbnailHandler.requests[-1] == '"v1"'
+
+
+def test_corrupt_metadata_counts_as_stale(thumbnail_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(thumbnails, "THUMBNAIL_CACHE_DIR", str(tmp_path))
+    url = f"{thumbnail_server}/vi/partial.jpg"
+    assert thumbnails.fetch_thumbnail(url) == b"image"
+    meta_path = next(tmp_path.glob("*.json"))
+    meta_path.write_text('{"url": "cut short"}')
+
+    assert thumbnails.fetch_thumbnail(url) == b"image"
+    assert len(ThumbnailHandler.requests) == 2  # Fetched again, not served as fresh
+
+
+def test_cache_is_trimmed_by_age_and_size(tmp_path):
+    now = time.time()
+    for number, age in enumerate((0, 10, 20, 40 * 24 * 60 * 60)):
+        image_path = tmp_path / f"thumb{number}"
+        image_path.write_bytes(b"x" * 100)
+        (tmp_path / f"thumb{number}.json").write_text("{}")
+        os.utime(image_path, (now - age, now - age))
+
+    # The thumbnail unused for 40 days goes, then the least recently used one
+    assert thumbnails.prune_thumbnail_cache(str(tmp_path), max_size=250) == 2
+    assert sorted(os.listdir(tmp_path)) == [
+        "thumb0",
+        "thumb0.json",
+        "thumb1",
+        "thumb1.json",
+    ]
@@ -0,0 +1,253 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from lazy import LazyModule
+from metrics import registry
+
+# requests is imported on first use, so importing this module stays fast
+requests = LazyModule("requests")
+
+# Directory holding downloaded thumbnails and their validators
+THUMBNAIL_CACHE_DIR = os.path.join("downloads", ".cache", "thumbnails")
+
+# How long a cached thumbnail is used without asking the server if it changed, in seconds
+THUMBNAIL_MAX_AGE = 24 * 60 * 60
+
+# Size the thumbnail cache is trimmed to, in bytes, and how long a thumbnail that isn't
+# used stays in it, in seconds. The least recently used thumbnails are removed first.
+THUMBNAIL_CACHE_SIZE = 200 * 1024 * 1024
+THUMBNAIL_CACHE_AGE = 30 * 24 * 60 * 60
+
+# Seconds between two trims of the same cache directory
+PRUNE_INTERVAL = 60
+
+# Connect and read timeouts for thumbnail requests, in seconds
+REQUEST_TIMEOUT = (5, 15)
+
+# Retries for failed requests; the wait doubles from BACKOFF_FACTOR seconds each time
+RETRIES = 3
+BACKOFF_FACTOR = 0.5
+
+# Number of keep-alive connections kept open per host
+POOL_SIZE = 16
+
+session = None
+session_lock = threading.Lock()
+
+# When each cache directory was last trimmed, see prune_thumbnail_cache
+last_pruned = {}
+prune_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Returns the shared HTTP session, creating it on first use.
+
+    The session keeps connections alive between requests, so thumbnails from the same host
+    don't pay for a new TCP and TLS handshake each, and retries failed requests with
+    exponential backoff.
+
+    Returns:
+        requests.Session: The shared session.
+    """
+    global session
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    with session_lock:
+        if session is None:
+            retry = Retry(
+                total=RETRIES,
+                backoff_factor=BACKOFF_FACTOR,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=("GET", "HEAD"),
+            )
+            adapter = HTTPAdapter(
+                pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry
+            )
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        return session
+
+
+def fetch_thumbnail(thumbnail_url, cache_dir=None):
+    """
+    Downloads a thumbnail, using the on-disk thumbnail cache where possible.
+
+    A cached thumbnail younger than THUMBNAIL_MAX_AGE is returned without a request. An
+    older one is revalidated with its ETag or Last-Modified date, so an unchanged image is
+    not downloaded again.
+
+    Args:
+        thumbnail_url (str): The URL of the thumbnail.
+        cache_dir (str, optional): The directory of the thumbnail cache. Defaults to
+            THUMBNAIL_CACHE_DIR.
+
+    Returns:
+        bytes: The image data, or None if the thumbnail could not be downloaded.
+    """
+    if not thumbnail_url:
+        return None
+
+    cache_dir = cache_dir or THUMBNAIL_CACHE_DIR
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_name = hashlib.sha1(thumbnail_url.encode()).hexdigest()
+    image_path = os.path.join(cache_dir, cache_name)
+    meta_path = image_path + ".json"
+
+    # Look up the cached copy and its validators
+    try:
+        with open(meta_path, "r", encoding="utf-8") as meta_file:
+            meta = json.load(meta_file)
+        with open(image_path, "rb") as image_file:
+            cached = image_file.read()
+    except (FileNotFoundError, ValueError):
+        meta, cached = {}, None
+    if not isinstance(meta, dict):
+        meta = {}  # A corrupt metadata file; the thumbnail is revalidated
+
+    # A partly written metadata file has no fetch time and counts as stale
+    if cached is not None and time.time() - meta.get("fetched", 0) < THUMBNAIL_MAX_AGE:
+        registry.inc("downloaddynamo_thumbnail_requests_total", result="cached")
+        touch(image_path)
+        return cached
+
+    headers = {}
+    if cached is not None and meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if cached is not None and meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+
+    try:
+        response = get_session().get(
+            thumbnail_url, headers=headers, timeout=REQUEST_TIMEOUT
+        )
+    except requests.RequestException:
+        registry.inc("downloaddynamo_thumbnail_requests_total", result="failed")
+        return cached  # Better a stale thumbnail than none
+
+    if response.status_code == 304 and cached is not None:
+        registry.inc("downloaddynamo_thumbnail_requests_total", result="not_modified")
+        data = cached
+    elif response.status_code == 200:
+        registry.inc("downloaddynamo_thumbnail_requests_total", result="downloaded")
+        data = response.content
+        registry.inc(
+            "downloaddynamo_downloaded_bytes_total", len(data), kind="thumbnail"
+        )
+        temp_path = f"{image_path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as image_file:
+            image_file.write(data)
+        os.replace(temp_path, image_path)
+        maybe_prune(cache_dir)
+    else:
+        registry.inc("downloaddynamo_thumbnail_requests_total", result="failed")
+        return cached
+
+    # Remember when the thumbnail was last confirmed and how to revalidate it
+    meta = {
+        "url": thumbnail_url,
+        "fetched": time.time(),
+        "etag": response.headers.get("ETag", meta.get("etag")),
+        "last_modified": response.headers.get(
+            "Last-Modified", meta.get("last_modified")
+        ),
+    }
+    temp_path = f"{meta_path}.{threading.get_ident()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as meta_file:
+        json.dump(meta, meta_file)
+    os.replace(temp_path, meta_path)
+    touch(image_path)
+    return data
+
+
+def touch(path):
+    """Marks a cached thumbnail as used, so it is trimmed last."""
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def maybe_prune(cache_dir):
+    """Trims a cache directory, unless it was trimmed in the last PRUNE_INTERVAL."""
+    now = time.monotonic()
+    with prune_lock:
+        if now - last_pruned.get(cache_dir, -PRUNE_INTERVAL) < PRUNE_INTERVAL:
+            return
+        last_pruned[cache_dir] = now
+    prune_thumbnail_cache(cache_dir)
+
+
+def prune_thumbnail_cache(
+    cache_dir=None, max_size=THUMBNAIL_CACHE_SIZE, max_age=THUMBNAIL_CACHE_AGE
+):
+    """
+    Removes thumbnails that weren't used for max_age, then the least recently used ones
+    until the cache is no larger than max_size.
+
+    Args:
+        cache_dir (str, optional): The directory of the thumbnail cache. Defaults to
+            THUMBNAIL_CACHE_DIR.
+        max_size (int, optional): The size to trim the cache to, in bytes.
+        max_age (float, optional): The longest a thumbnail is kept unused, in seconds.
+
+    Returns:
+        int: The number of thumbnails removed.
+    """
+    cache_dir = cache_dir or THUMBNAIL_CACHE_DIR
+    entries = []
+    try:
+        names = os.listdir(cache_dir)
+    except FileNotFoundError:
+        return 0
+    for name in names:
+        if "." in name:
+            continue  # Metadata and temporary files go with their thumbnail
+        try:
+            stat = os.stat(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, name))
+
+    # Most recently used first
+    entries.sort(reverse=True)
+    now = time.time()
+    total = 0
+    removed = 0
+    for used, size, name in entries:
+        total += size
+        if total <= max_size and now - used <= max_age:
+            continue
+        image_path = os.path.join(cache_dir, name)
+        for path in (image_path, image_path + ".json"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        removed += 1
+    return removed
+
+
+def fetch_thumbnails(thumbnail_urls, max_workers=POOL_SIZE):
+    """
+    Downloads several thumbnails at the same time.
+
+    Args:
+        thumbnail_urls (list): The URLs of the thumbnails.
+        max_workers (int, optional): The number of concurrent requests.
+
+    Returns:
+        list: The image data of each thumbnail, in the same order, or None for thumbnails
+        that could not be downloaded.
+    """
+    thumbnail_urls = list(thumbnail_urls)
+    if not thumbnail_urls:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(thumbnail_urls))) as pool:
+        return list(pool.map(fetch_thumbnail, thumbnail_urls))